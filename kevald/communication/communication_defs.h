@@ -12,7 +12,10 @@ enum class RequestType : uint8_t
     READ_BYTES,
     WRITE_BYTES,
     ALLOCATE,
-    FREE
+    FREE,
+    RESOLVE_ROUTINE,
+    CALL_ADDRESS,
+    READ_MANY
 };
 
 enum class FfiType : uint8_t
@@ -52,12 +55,45 @@ struct RequestCallFunction
     Vector<void*> argumentAddresses;
 };
 
+/**
+    A request to find the address of a function, so it can be called with `RequestCallAddress` without being looked
+    up again.
+*/
+struct RequestResolveRoutine
+{
+    String moduleName;
+    String functionName;
+    const void** outAddress;
+};
+
+/**
+    A request to call a function by its address, as returned by `RequestResolveRoutine`.
+*/
+struct RequestCallAddress
+{
+    const void* address;
+    FfiType returnType;
+    Vector<FfiType> argumentTypes;
+    void* returnValueAddress;
+    Vector<void*> argumentAddresses;
+};
+
 struct RequestReadBytes
 {
     std::byte* address;
     std::span<std::byte> outData;
 };
 
+/**
+    A request to read many ranges of memory. A range that can't be read doesn't fail the request, its status is
+    written instead.
+*/
+struct RequestReadMany
+{
+    Vector<RequestReadBytes> entries;
+    NTSTATUS* outStatuses;
+};
+
 struct RequestWriteBytes
 {
     std::byte* address;
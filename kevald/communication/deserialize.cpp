@@ -77,6 +77,24 @@ RequestReadBytes deserializeReadBytes(BufferDeserializer& data)
     return RequestReadBytes{.address = data.read<std::byte*>(), .outData = deserializeBufferView(data)};
 }
 
+RequestReadMany deserializeReadMany(BufferDeserializer& data)
+{
+    const auto count = data.read<uint32_t>();
+    constexpr auto entrySize = sizeof(std::byte*) + sizeof(std::byte*) + sizeof(uint32_t);
+    if (count > data.bytesLeft() / entrySize) {
+        throw DeserializeException();
+    }
+
+    RequestReadMany result;
+    result.entries.reserve(count);
+    for (uint32_t i = 0; i < count; ++i) {
+        result.entries.push_back(deserializeReadBytes(data));
+    }
+    result.outStatuses = data.read<NTSTATUS*>();
+
+    return result;
+}
+
 RequestWriteBytes deserializeWriteBytes(BufferDeserializer& data)
 {
     return RequestWriteBytes{.address = data.read<std::byte*>(), .data = deserializeBufferView(data)};
@@ -92,4 +110,22 @@ RequestFree deserializeFree(BufferDeserializer& data)
     return RequestFree{.address = data.read<void*>()};
 }
 
+RequestResolveRoutine deserializeResolveRoutine(BufferDeserializer& data)
+{
+    return RequestResolveRoutine{
+        .moduleName = deserializeString(data),
+        .functionName = deserializeString(data),
+        .outAddress = data.read<const void**>()};
+}
+
+RequestCallAddress deserializeCallAddress(BufferDeserializer& data)
+{
+    return RequestCallAddress{
+        .address = data.read<const void*>(),
+        .returnType = data.read<FfiType>(),
+        .argumentTypes = deserializeArray<FfiType>(data),
+        .returnValueAddress = data.read<void*>(),
+        .argumentAddresses = deserializeArray<void*>(data)};
+}
+
 }  // namespace keval::communication
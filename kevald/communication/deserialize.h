@@ -9,10 +9,16 @@ RequestCallFunction deserializeCallFunction(BufferDeserializer& data);
 
 RequestReadBytes deserializeReadBytes(BufferDeserializer& data);
 
+RequestReadMany deserializeReadMany(BufferDeserializer& data);
+
 RequestWriteBytes deserializeWriteBytes(BufferDeserializer& data);
 
 RequestAllocate deserializeAllocate(BufferDeserializer& data);
 
 RequestFree deserializeFree(BufferDeserializer& data);
 
+RequestResolveRoutine deserializeResolveRoutine(BufferDeserializer& data);
+
+RequestCallAddress deserializeCallAddress(BufferDeserializer& data);
+
 }
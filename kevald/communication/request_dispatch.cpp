@@ -29,6 +29,12 @@ void dispatchRequest(const std::span<std::byte>& requestBytes)
             handler.handle(request);
             break;
         }
+        case RequestType::READ_MANY: {
+            DEBUG_LOG("Got request to read many");
+            auto request = deserializeReadMany(buffer);
+            handler.handle(request);
+            break;
+        }
         case RequestType::WRITE_BYTES: {
             DEBUG_LOG("Got request to write bytes");
             auto request = deserializeWriteBytes(buffer);
@@ -47,6 +53,18 @@ void dispatchRequest(const std::span<std::byte>& requestBytes)
             handler.handle(request);
             break;
         }
+        case RequestType::RESOLVE_ROUTINE: {
+            DEBUG_LOG("Got request to resolve routine");
+            auto request = deserializeResolveRoutine(buffer);
+            handler.handle(request);
+            break;
+        }
+        case RequestType::CALL_ADDRESS: {
+            DEBUG_LOG("Got request to call address");
+            auto request = deserializeCallAddress(buffer);
+            handler.handle(request);
+            break;
+        }
         default:
             DEBUG_LOG("Unknown request %d", requestType);
             throw UnknownRequestException(requestType);
@@ -25,6 +25,24 @@ std::pair<const ffi_type*, Vector<const ffi_type*>> getActualTypes(
     return {actualReturnType, actualArgumentTypes};
 }
 
+/**
+    Calls a routine and writes its return value to the user.
+*/
+void callRoutine(const void* routineAddress,
+                 FfiType returnType,
+                 const Vector<FfiType>& argumentTypes,
+                 void* returnValueAddress,
+                 Vector<void*>& argumentAddresses)
+{
+    auto [actualReturnType, actualArgumentTypes] = getActualTypes(returnType, argumentTypes);
+    ffi::Cif cif(actualReturnType, std::move(actualArgumentTypes));
+
+    auto callResult = cif.call(routineAddress, argumentAddresses);
+    // Note - if you got a BSOD near this line, it's probably because you declared your function incorrectly.
+
+    std::ranges::copy(callResult, static_cast<std::byte*>(returnValueAddress));
+}
+
 }  // anonymous namespace
 
 void RequestHandler::handle(RequestCallFunction& request)
@@ -32,16 +50,23 @@ void RequestHandler::handle(RequestCallFunction& request)
     // 1. Find the function,
     const auto routineAddress = m_routineFinder.find(request.moduleName, request.functionName);
 
-    auto [returnType, argumentTypes] = getActualTypes(request.returnType, request.argumentTypes);
-    ffi::Cif cif(returnType, std::move(argumentTypes));
-
-    // 2. Call the function,
+    // 2. Call it and write the return value back to the user.
     DEBUG_LOG("Calling %s", request.functionName.c_str());
-    auto callResult = cif.call(routineAddress, request.argumentAddresses);
-    // Note - if you got a BSOD near this line, it's probably because you declared your function incorrectly.
+    callRoutine(routineAddress, request.returnType, request.argumentTypes, request.returnValueAddress,
+                request.argumentAddresses);
+}
 
-    // 3. And write the return value back to the user.
-    std::ranges::copy(callResult, static_cast<std::byte*>(request.returnValueAddress));
+void RequestHandler::handle(RequestResolveRoutine& request)
+{
+    *request.outAddress = m_routineFinder.find(request.moduleName, request.functionName);
+}
+
+void RequestHandler::handle(RequestCallAddress& request)
+{
+    // The address was resolved by an earlier request, so the module doesn't have to be looked up again.
+    DEBUG_LOG("Calling %p", request.address);
+    callRoutine(request.address, request.returnType, request.argumentTypes, request.returnValueAddress,
+                request.argumentAddresses);
 }
 
 void RequestHandler::handle(RequestReadBytes& request)
@@ -49,6 +74,30 @@ void RequestHandler::handle(RequestReadBytes& request)
     std::copy_n(request.address, request.outData.size_bytes(), request.outData.data());
 }
 
+void RequestHandler::handle(RequestReadMany& request)
+{
+    // MmCopyMemory fails on memory that isn't mapped instead of crashing, but it must copy to non-paged memory.
+    NonPagedBuffer buffer;
+    for (size_t i = 0; i < request.entries.size(); ++i) {
+        const auto& entry = request.entries[i];
+        buffer.resize(entry.outData.size_bytes());
+
+        MM_COPY_ADDRESS source{};
+        source.VirtualAddress = entry.address;
+        SIZE_T bytesCopied = 0;
+        auto status =
+            MmCopyMemory(buffer.data(), source, buffer.size(), MM_COPY_MEMORY_VIRTUAL, &bytesCopied);
+        if (NT_SUCCESS(status) && bytesCopied != buffer.size()) {
+            status = STATUS_PARTIAL_COPY;
+        }
+
+        if (NT_SUCCESS(status)) {
+            std::ranges::copy(buffer, entry.outData.data());
+        }
+        request.outStatuses[i] = status;
+    }
+}
+
 void RequestHandler::handle(RequestWriteBytes& request)
 {
     std::ranges::copy(request.data, request.address);
@@ -15,12 +15,18 @@ public:
 
     void handle(RequestReadBytes& request);
 
+    void handle(RequestReadMany& request);
+
     void handle(RequestWriteBytes& request);
 
     void handle(RequestAllocate& request);
 
     void handle(RequestFree& request);
 
+    void handle(RequestResolveRoutine& request);
+
+    void handle(RequestCallAddress& request);
+
 private:
     routines::RoutineFinder m_routineFinder;
 };
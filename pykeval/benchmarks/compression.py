@@ -0,0 +1,144 @@
+"""
+Measures compression of the remote broker protocol on payloads like those of memory dumps, and estimates how long
+dumping them takes over links of different speeds.
+
+Each payload is sent in 1 MiB messages over a local socket pair with `messaging.send()` and `messaging.receive()`, so
+the measured time is the cost of framing, compressing and decompressing. The time on a link adds the time the bytes
+that were actually sent would take at the link's bandwidth.
+
+Run with `python benchmarks/compression.py` from the `pykeval` directory.
+"""
+
+import _ctypes
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from typing import Callable, Dict, Optional
+
+from pykeval.broker.messaging import send, receive_header, receive_body
+from pykeval.broker.remote_protocol import Compression
+
+PAYLOAD_SIZE = 0x400000
+MESSAGE_SIZE = 0x100000
+LEVELS = (None, 1, 6, 9)
+# In bits per second
+LINKS = {
+    "vpn 10Mb": 10e6,
+    "wan 100Mb": 100e6,
+    "lan 1Gb": 1e9,
+}
+
+
+def _fit(data: bytes) -> bytes:
+    return (data * (PAYLOAD_SIZE // len(data) + 1))[:PAYLOAD_SIZE]
+
+
+def _zeroed_pool(generator: random.Random) -> bytes:
+    """
+    Freshly allocated pool: zeroed blocks, each behind a pool header with a tag.
+    """
+
+    data = bytearray(PAYLOAD_SIZE)
+    offset = 0
+    while offset < PAYLOAD_SIZE - 0x10:
+        size = generator.choice((0x20, 0x40, 0x80, 0x100, 0x200))
+        tag = generator.choice((b"Proc", b"Thre", b"File", b"Even", b"MmSt"))
+        struct.pack_into("<HH4sQ", data, offset, size >> 4, 0x0200, tag, 0)
+        offset += size
+    return bytes(data)
+
+
+def _pool_objects(generator: random.Random) -> bytes:
+    """
+    Pool in use: structures full of kernel pointers, small integers, flags and some high-entropy fields.
+    """
+
+    words = []
+    for _ in range(PAYLOAD_SIZE // 8):
+        kind = generator.random()
+        if kind < 0.35:
+            words.append(0)
+        elif kind < 0.65:
+            words.append(0xFFFF800000000000 | generator.randrange(1 << 28) << 4)
+        elif kind < 0.9:
+            words.append(generator.randrange(0x100))
+        else:
+            words.append(generator.randrange(1 << 64))
+    return struct.pack(f"<{len(words)}Q", *words)
+
+
+def _driver_image(generator: random.Random) -> bytes:
+    """
+    Native code and data, from a native extension module as a stand-in for a driver image.
+    """
+
+    with open(getattr(_ctypes, "__file__", sys.executable), "rb") as image:
+        return _fit(image.read(PAYLOAD_SIZE))
+
+
+def _random(generator: random.Random) -> bytes:
+    """
+    Memory that doesn't compress at all, such as encrypted buffers.
+    """
+
+    return generator.randbytes(PAYLOAD_SIZE) if hasattr(generator, "randbytes") else bytes(
+        generator.getrandbits(8) for _ in range(PAYLOAD_SIZE))
+
+
+PAYLOADS = {
+    "zeroed_pool": _zeroed_pool,
+    "pool_objects": _pool_objects,
+    "driver_image": _driver_image,
+    "random": _random,
+}  # type: Dict[str, Callable[[random.Random], bytes]]
+
+
+def _transfer(payload: bytes, compression: Optional[Compression]):
+    """
+    :return: The number of bytes that were sent, and the time the transfer took in seconds.
+    """
+
+    sender, receiver = socket.socketpair()
+    sent = 0
+    with sender, receiver:
+        def send_all():
+            view = memoryview(payload)
+            for offset in range(0, len(payload), MESSAGE_SIZE):
+                send(sender, view[offset:offset + MESSAGE_SIZE], compression=compression)
+
+        start = time.perf_counter()
+        thread = threading.Thread(target=send_all)
+        thread.start()
+        for _ in range(0, len(payload), MESSAGE_SIZE):
+            size, compressed = receive_header(receiver, compression)
+            sent += size
+            receive_body(receiver, size, compressed)
+        thread.join()
+
+        return sent, time.perf_counter() - start
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Transfers of each payload, of which the fastest "
+                                                                     "is kept")
+    args = parser.parse_args()
+
+    print(f"{'payload':<16}{'level':>6}{'sent B':>10}{'ratio':>8}{'cpu ms':>9}"
+          + "".join(f"{name + ' ms':>14}" for name in LINKS))
+    for payload_name, create_payload in PAYLOADS.items():
+        payload = create_payload(random.Random(0))
+        for level in LEVELS:
+            compression = Compression(level) if level is not None else None
+            sent, elapsed = min((_transfer(payload, compression) for _ in range(args.repeat)), key=lambda r: r[1])
+            link_times = "".join(f"{(elapsed + sent * 8 / bandwidth) * 1e3:>14.1f}" for bandwidth in LINKS.values())
+            print(f"{payload_name:<16}{level or 'off':>6}{sent:>10}{len(payload) / sent:>8.1f}{elapsed * 1e3:>9.1f}"
+                  f"{link_times}")
+
+
+if "__main__" == __name__:
+    main()
@@ -0,0 +1,118 @@
+"""
+Checks how long importing pykeval takes for common uses, using `python -X importtime`, against a budget for each.
+Also checks that heavy dependencies which a use doesn't need (libclang, IPython, the IOCTL stack, asyncio) are not
+imported at all.
+
+Exits with a non-zero status if any use is over its budget or imports something it shouldn't, so it can be used as a
+regression check. Budgets are generous, since import times vary between machines. Use `--scale` on slow machines.
+
+Run with `python benchmarks/import_time.py` from the `pykeval` directory.
+"""
+
+import json
+import statistics
+import subprocess
+import sys
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from typing import List, Tuple
+
+_MARKER = "--pykeval-imports--"
+
+
+@dataclass
+class Scenario:
+    name: str
+    statement: str
+    budget_ms: float
+    # Modules that must not be imported by the statement
+    forbidden_modules: List[str]
+
+
+SCENARIOS = [
+    Scenario("remote client",
+             "from pykeval.broker import RemoteBroker; from pykeval.frontend import Client",
+             budget_ms=150,
+             forbidden_modules=["clang", "IPython", "asyncio", "pykeval.broker.local", "pykeval.broker.ioctl"]),
+    Scenario("async remote client",
+             "from pykeval.broker import AsyncRemoteBroker; from pykeval.frontend import AsyncClient",
+             budget_ms=200,
+             forbidden_modules=["clang", "IPython", "pykeval.broker.local", "pykeval.broker.ioctl"]),
+    Scenario("keval-server",
+             "import pykeval.server",
+             budget_ms=120,
+             forbidden_modules=["clang", "IPython", "asyncio", "pykeval.frontend"]),
+    Scenario("ikeval (before the shell starts)",
+             "import pykeval.interactive_shell",
+             budget_ms=180,
+             forbidden_modules=["clang", "IPython"]),
+]
+
+
+def _measure(statement: str) -> Tuple[float, List[str]]:
+    """
+    :return: The time the statement spent importing modules in milliseconds, and the modules that were imported.
+    :raises ImportError if the statement fails.
+    """
+
+    code = (f"import sys; sys.stderr.write({_MARKER!r} + '\\n'); {statement}; "
+            f"sys.stdout.write(__import__('json').dumps(sorted(sys.modules)))")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise ImportError(result.stderr.strip().splitlines()[-1])
+
+    # Lines look like "import time: <self us> | <cumulative us> | <indented module name>". Modules imported by the
+    # statement itself are the ones that aren't indented.
+    total_us = 0
+    lines = result.stderr.splitlines()
+    for line in lines[lines.index(_MARKER) + 1:]:
+        if not line.startswith("import time:"):
+            continue
+
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit() and not name.startswith("  "):
+            total_us += int(cumulative)
+
+    return total_us / 1000, json.loads(result.stdout)
+
+
+def _is_imported(module: str, modules: List[str]) -> bool:
+    return any(imported == module or imported.startswith(module + ".") for imported in modules)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-r", "--runs", help="The number of times to measure each use.", type=int, default=7)
+    parser.add_argument("-s", "--scale", help="A factor to scale all budgets by.", type=float, default=1.0)
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'use':<36}{'median ms':>12}{'budget ms':>12}  result")
+    for scenario in SCENARIOS:
+        try:
+            measurements = [_measure(scenario.statement) for _ in range(args.runs)]
+        except ImportError as e:
+            print(f"{scenario.name:<36}{'-':>12}{'-':>12}  failed: {e}")
+            failed = True
+            continue
+
+        median_ms = statistics.median(time_ms for time_ms, _ in measurements)
+        budget_ms = scenario.budget_ms * args.scale
+
+        imported = measurements[0][1]
+        unexpected = [module for module in scenario.forbidden_modules if _is_imported(module, imported)]
+
+        problems = []
+        if median_ms > budget_ms:
+            problems.append("over budget")
+        if len(unexpected) != 0:
+            problems.append(f"imported {', '.join(unexpected)}")
+        failed |= len(problems) != 0
+
+        print(f"{scenario.name:<36}{median_ms:>12.1f}{budget_ms:>12.0f}  {'; '.join(problems) or 'ok'}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
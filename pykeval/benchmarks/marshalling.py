@@ -0,0 +1,77 @@
+"""
+Measures the client-side cost of marshalling `ex_call` arguments: translating them to their native types, and reading
+them back. The broker is simulated without any latency, so only the marshalling is measured.
+
+Each case is run with the native type cache, and with it cleared before every call (the way native types were created
+before they were cached).
+
+Run with `python benchmarks/marshalling.py` from the `pykeval` directory.
+"""
+
+import ctypes
+import timeit
+
+from pykeval.broker.interface import Broker
+from pykeval.broker.simulated import SimulatedBroker
+from pykeval.frontend.ctypes_shim import native
+from pykeval.frontend.ctypes_shim.translate import TranslatedArgs
+
+
+class UNICODE_STRING(ctypes.Structure):
+    _fields_ = [("Length", ctypes.c_ushort),
+                ("MaximumLength", ctypes.c_ushort),
+                ("Buffer", ctypes.c_wchar_p)]
+
+
+class OBJECT_ATTRIBUTES(ctypes.Structure):
+    _fields_ = [("Length", ctypes.c_ulong),
+                ("RootDirectory", ctypes.c_void_p),
+                ("ObjectName", ctypes.POINTER(UNICODE_STRING)),
+                ("Attributes", ctypes.c_ulong),
+                ("SecurityDescriptor", ctypes.c_void_p),
+                ("SecurityQualityOfService", ctypes.c_void_p)]
+
+
+def _make_object_attributes_args():
+    name = UNICODE_STRING(0, 0, None)
+    attributes = OBJECT_ATTRIBUTES(ctypes.sizeof(OBJECT_ATTRIBUTES), None, ctypes.pointer(name), 0x40, None, None)
+    return [ctypes.pointer(ctypes.c_void_p()), ctypes.c_ulong(0x1F0003), ctypes.pointer(attributes)]
+
+
+def _make_unicode_string_args():
+    return [ctypes.pointer(UNICODE_STRING()), "Hello\0".encode("UTF-16LE")]
+
+
+CASES = {
+    "ZwOpenEvent-like": _make_object_attributes_args,
+    "RtlInitUnicodeString-like": _make_unicode_string_args,
+}
+
+
+def _marshal(broker: Broker, args, cached: bool):
+    if not cached:
+        native._native_types.clear()
+
+    translated_args = TranslatedArgs(broker, *args)
+    translated_args.read_back()
+    for allocation in translated_args.allocations:
+        allocation.free()
+
+
+def _time_per_call(function, number: int) -> float:
+    return min(timeit.repeat(function, number=number, repeat=5)) / number
+
+
+def main(number: int = 2000):
+    broker = SimulatedBroker()
+    print(f"{'arguments':<28}{'uncached us':>14}{'cached us':>14}{'speedup':>11}")
+
+    for name, make_args in CASES.items():
+        args = make_args()
+        uncached_time = _time_per_call(lambda: _marshal(broker, args, cached=False), number)
+        cached_time = _time_per_call(lambda: _marshal(broker, args, cached=True), number)
+        print(f"{name:<28}{uncached_time * 1e6:>14.2f}{cached_time * 1e6:>14.2f}{uncached_time / cached_time:>10.2f}x")
+
+
+if __name__ == "__main__":
+    main()
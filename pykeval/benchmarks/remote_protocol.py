@@ -0,0 +1,69 @@
+"""
+Compares the binary remote broker protocol with the pickle encoding it replaced.
+
+Run with `python benchmarks/remote_protocol.py` from the `pykeval` directory.
+"""
+
+import pickle
+import timeit
+
+from pykeval.broker.remote_protocol import encode_request, decode_request, encode_response, decode_response
+from pykeval.broker.requests import (BrokerRequest, BrokerRequestType, BrokerResponse, BrokerResponseType,
+                                     CallFunction, ReadBytes, WriteBytes, Allocate, Free)
+from pykeval.shared.ffi import FfiType, FfiArgument
+
+REQUESTS = {
+    "call_function": BrokerRequest(BrokerRequestType.CALL_FUNCTION, CallFunction(
+        "ntoskrnl", "RtlCompareMemory", FfiType.UINT64,
+        [FfiArgument(FfiType.POINTER, 0xFFFF800012340000),
+         FfiArgument(FfiType.POINTER, 0xFFFF800012350000),
+         FfiArgument(FfiType.UINT64, 0x100)])),
+    "read_bytes": BrokerRequest(BrokerRequestType.READ_BYTES, ReadBytes(0xFFFF800012340000, 0x1000)),
+    "write_bytes_16": BrokerRequest(BrokerRequestType.WRITE_BYTES, WriteBytes(0xFFFF800012340000, b"\x41" * 16)),
+    "write_bytes_64k": BrokerRequest(BrokerRequestType.WRITE_BYTES, WriteBytes(0xFFFF800012340000, b"\x41" * 0x10000)),
+    "allocate": BrokerRequest(BrokerRequestType.ALLOCATE, Allocate(0x40)),
+    "free": BrokerRequest(BrokerRequestType.FREE, Free(0xFFFF800012340000)),
+}
+
+RESPONSES = {
+    "call_function": BrokerResponse(BrokerResponseType.SUCCESS, 0x100),
+    "read_bytes_4k": BrokerResponse(BrokerResponseType.SUCCESS, bytes(range(256)) * 16),
+    "read_bytes_1m": BrokerResponse(BrokerResponseType.SUCCESS, bytes(range(256)) * 4096),
+    "allocate": BrokerResponse(BrokerResponseType.SUCCESS, 0xFFFF800012340000),
+    "write_bytes": BrokerResponse(BrokerResponseType.SUCCESS, None),
+}
+
+
+def _time_per_operation(function, number: int) -> float:
+    return min(timeit.repeat(function, number=number, repeat=5)) / number
+
+
+def _report(name: str, pickled: bytes, encoded: bytes, pickle_round_trip, binary_round_trip, number: int):
+    pickle_time = _time_per_operation(pickle_round_trip, number)
+    binary_time = _time_per_operation(binary_round_trip, number)
+    print(f"{name:<24}{len(pickled):>10}{len(encoded):>10}"
+          f"{pickle_time * 1e6:>14.2f}{binary_time * 1e6:>14.2f}{pickle_time / binary_time:>10.2f}x")
+
+
+def main(number: int = 10000):
+    print(f"{'message':<24}{'pickle B':>10}{'binary B':>10}{'pickle us':>14}{'binary us':>14}{'speedup':>11}")
+
+    for name, request in REQUESTS.items():
+        pickled = pickle.dumps(request)
+        encoded = encode_request(1, request)
+        _report(f"request/{name}", pickled, encoded,
+                lambda: pickle.loads(pickle.dumps(request)),
+                lambda: decode_request(encode_request(1, request)),
+                number)
+
+    for name, response in RESPONSES.items():
+        pickled = pickle.dumps(response)
+        encoded = encode_response(1, response)
+        _report(f"response/{name}", pickled, encoded,
+                lambda: pickle.loads(pickle.dumps(response)),
+                lambda: decode_response(encode_response(1, response)),
+                number // 10 if len(encoded) > 0x10000 else number)
+
+
+if "__main__" == __name__:
+    main()
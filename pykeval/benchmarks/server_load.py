@@ -0,0 +1,146 @@
+"""
+Load-tests `RemoteBrokerServer` with many clients against an in-memory broker, comparing worker counts.
+
+Every request sleeps for a while in the broker to stand in for the time the driver takes. One of the clients ("slow")
+only makes long calls, to show how much it delays the others.
+
+Run with `python benchmarks/server_load.py` from the `pykeval` directory.
+"""
+
+import socket
+import statistics
+import threading
+import time
+from argparse import ArgumentParser
+from typing import List
+
+from pykeval.broker import RemoteBroker, RemoteBrokerServer
+from pykeval.broker.interface import Broker
+from pykeval.broker.requests import CallFunction, ReadBytes, WriteBytes, Allocate, Free
+from pykeval.shared.ffi import FfiType, FfiArgument
+
+SLOW_CALL_MODULE = "slow"
+REQUESTS_PER_ITERATION = 5
+
+
+class InMemoryBroker(Broker):
+    """
+    Serves memory from a bytearray. Each request takes `latency` seconds, calls to `SLOW_CALL_MODULE` take
+    `slow_latency` seconds.
+    """
+
+    thread_safe = True
+
+    def __init__(self, latency: float, slow_latency: float, size: int = 0x100000):
+        self._latency = latency
+        self._slow_latency = slow_latency
+        self._memory = bytearray(size)
+        self._next_address = 0
+        self._lock = threading.Lock()
+
+    def get_pointer_size(self) -> int:
+        return 8
+
+    def call_function(self, request_data: CallFunction) -> any:
+        time.sleep(self._slow_latency if request_data.module_name == SLOW_CALL_MODULE else self._latency)
+        return 0
+
+    def read_bytes(self, request_data: ReadBytes) -> bytes:
+        time.sleep(self._latency)
+        with self._lock:
+            return bytes(self._memory[request_data.address:request_data.address + request_data.size])
+
+    def write_bytes(self, request_data: WriteBytes):
+        time.sleep(self._latency)
+        with self._lock:
+            self._memory[request_data.address:request_data.address + len(request_data.data)] = request_data.data
+
+    def allocate(self, request_data: Allocate) -> int:
+        time.sleep(self._latency)
+        with self._lock:
+            address = self._next_address
+            self._next_address = (self._next_address + request_data.size + 0xF & ~0xF) % len(self._memory)
+            return address
+
+    def free(self, request_data: Free):
+        time.sleep(self._latency)
+
+
+def _find_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_server(workers: int, latency: float, slow_latency: float) -> int:
+    port = _find_free_port()
+    server = RemoteBrokerServer(InMemoryBroker(latency, slow_latency), "127.0.0.1", port, workers=workers)
+    threading.Thread(target=server.start, daemon=True).start()
+
+    # Wait for the server to listen
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return port
+        except ConnectionRefusedError:
+            time.sleep(0.01)
+
+
+def _fast_client(port: int, deadline: float, latencies: List[float]):
+    broker = RemoteBroker("127.0.0.1", port)
+    call = CallFunction("fast", "Function", FfiType.UINT64, [FfiArgument(FfiType.UINT64, 1)])
+    # Each iteration makes `REQUESTS_PER_ITERATION` requests
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        address = broker.allocate(Allocate(0x40))
+        broker.write_bytes(WriteBytes(address, b"\x41" * 0x40))
+        broker.call_function(call)
+        broker.read_bytes(ReadBytes(address, 0x40))
+        broker.free(Free(address))
+        latencies.append((time.perf_counter() - start) / REQUESTS_PER_ITERATION)
+    broker.close()
+
+
+def _slow_client(port: int, deadline: float):
+    broker = RemoteBroker("127.0.0.1", port)
+    call = CallFunction(SLOW_CALL_MODULE, "Function", FfiType.VOID, [])
+    while time.perf_counter() < deadline:
+        broker.call_function(call)
+    broker.close()
+
+
+def run(workers: int, clients: int, duration: float, latency: float, slow_latency: float):
+    port = _start_server(workers, latency, slow_latency)
+    deadline = time.perf_counter() + duration
+
+    latencies = [[] for _ in range(clients)]
+    threads = [threading.Thread(target=_fast_client, args=(port, deadline, client_latencies))
+               for client_latencies in latencies]
+    threads.append(threading.Thread(target=_slow_client, args=(port, deadline)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    all_latencies = sorted(latency for client_latencies in latencies for latency in client_latencies)
+    p99 = all_latencies[int(len(all_latencies) * 0.99)]
+    print(f"{workers:>8}{clients:>8}{len(all_latencies) * REQUESTS_PER_ITERATION / duration:>14.0f}"
+          f"{statistics.median(all_latencies) * 1e3:>12.2f}{p99 * 1e3:>12.2f}")
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=16, help="The number of fast clients.")
+    parser.add_argument("--duration", type=float, default=3, help="Seconds to run each configuration for.")
+    parser.add_argument("--latency", type=float, default=0.0005, help="Seconds each request takes in the broker.")
+    parser.add_argument("--slow-latency", type=float, default=0.05, help="Seconds each slow call takes.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16], help="Worker counts to compare.")
+    args = parser.parse_args()
+
+    print(f"{'workers':>8}{'clients':>8}{'requests/s':>14}{'p50 ms':>12}{'p99 ms':>12}")
+    for workers in args.workers:
+        run(workers, args.clients, args.duration, args.latency, args.slow_latency)
+
+
+if __name__ == "__main__":
+    main()
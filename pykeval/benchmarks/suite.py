@@ -0,0 +1,459 @@
+"""
+Benchmarks the hot paths of pykeval without the driver: marshalling `ex_call` arguments, client operations, serializing
+requests for the driver and for the remote protocol, and parsing declarations.
+
+Client operations run against a `SimulatedBroker`, either in this process or behind a `RemoteBrokerServer` on the
+loopback interface (`--transport tcp`). Each case is reported in operations per second, along with the round trips to
+the broker and the bytes on the wire (as the remote protocol encodes them) that each operation costs.
+
+Results can be saved as JSON with `--output`, and compared with a previous run with `--compare`.
+
+Run with `python benchmarks/suite.py` from the `pykeval` directory.
+"""
+
+import ctypes
+import io
+import json
+import platform
+import socket
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from contextlib import closing
+from dataclasses import dataclass, asdict
+from typing import Callable, Dict, Optional, Tuple, Union
+
+from pykeval.broker.interface import Broker
+from pykeval.broker.ioctl_requests import IoctlCallFunction, IoctlReadBytes
+from pykeval.broker.remote_protocol import encode_request, decode_request, encode_response, decode_response
+from pykeval.broker.requests import (BrokerRequest, BrokerRequestType, BrokerResponse, BrokerResponseType,
+                                     CallFunction, ReadBytes)
+from pykeval.broker.simulated import SimulatedBroker
+from pykeval.frontend.client import Client
+from pykeval.frontend.profiler import Profile, ProfilingBroker
+from pykeval.frontend.ctypes_shim.address import get_native_pointer_type
+from pykeval.frontend.ctypes_shim.native import get_native_type, get_as_native_value
+from pykeval.frontend.ctypes_shim.translate import TranslatedArgs
+from pykeval.shared.ffi import FfiType, FfiArgument, FfiFunction, FfiNamedArgument
+
+RESULTS_FORMAT_VERSION = 1
+
+MODULE_NAME = "bench"
+DECLARATIONS = """
+typedef unsigned long ULONG;
+typedef void* PVOID;
+typedef struct _UNICODE_STRING { unsigned short Length; unsigned short MaximumLength; wchar_t* Buffer; } UNICODE_STRING;
+void RtlInitUnicodeString(UNICODE_STRING* DestinationString, const wchar_t* SourceString);
+ULONG RtlCompareMemory(const PVOID Source1, const PVOID Source2, unsigned long long Length);
+int ZwOpenEvent(PVOID* EventHandle, ULONG DesiredAccess, PVOID ObjectAttributes);
+"""
+
+
+class UNICODE_STRING(ctypes.Structure):
+    _fields_ = [("Length", ctypes.c_ushort),
+                ("MaximumLength", ctypes.c_ushort),
+                ("Buffer", ctypes.c_void_p)]
+
+
+class OBJECT_ATTRIBUTES(ctypes.Structure):
+    _fields_ = [("Length", ctypes.c_ulong),
+                ("RootDirectory", ctypes.c_void_p),
+                ("ObjectName", ctypes.POINTER(UNICODE_STRING)),
+                ("Attributes", ctypes.c_ulong),
+                ("SecurityDescriptor", ctypes.c_void_p),
+                ("SecurityQualityOfService", ctypes.c_void_p)]
+
+
+class LIST_NODE(ctypes.Structure):
+    pass
+
+
+LIST_NODE._fields_ = [("Next", ctypes.POINTER(LIST_NODE)),
+                      ("Attributes", ctypes.POINTER(OBJECT_ATTRIBUTES)),
+                      ("Value", ctypes.c_uint64)]
+
+
+@dataclass
+class Environment:
+    simulated: SimulatedBroker
+    broker: ProfilingBroker
+    client: Client
+
+
+@dataclass
+class Case:
+    name: str
+    # Creates the operation to measure. Cases that don't go through the broker return the operation along with the number
+    # of bytes it puts on the wire.
+    setup: Callable[[Environment], Union[Callable, Tuple[Callable, int]]]
+
+
+@dataclass
+class CaseResult:
+    ops_per_sec: float
+    round_trips_per_op: float
+    bytes_sent_per_op: float
+    bytes_received_per_op: float
+
+
+def _register_routines(simulated: SimulatedBroker):
+    pointer_size = simulated.get_pointer_size()
+
+    def rtl_init_unicode_string(destination: int, source: int):
+        length = 0
+        while simulated.read_memory(source + length, 2) != b"\0\0":
+            length += 2
+        native_string = get_native_type(UNICODE_STRING, get_native_pointer_type(pointer_size))
+        simulated.write_memory(destination, bytes(native_string(length, length + 2, source)))
+
+    simulated.register_routine(MODULE_NAME, "RtlInitUnicodeString", rtl_init_unicode_string)
+    simulated.register_routine(MODULE_NAME, "RtlCompareMemory", lambda source1, source2, length: length)
+    simulated.register_routine(MODULE_NAME, "ZwOpenEvent", lambda handle, access, attributes: 0)
+
+
+def _declare(client: Client):
+    pointer = FfiType.POINTER
+    functions = [
+        FfiFunction("RtlInitUnicodeString", FfiType.VOID,
+                    [FfiNamedArgument(pointer, "DestinationString"), FfiNamedArgument(pointer, "SourceString")]),
+        FfiFunction("RtlCompareMemory", FfiType.ULONG,
+                    [FfiNamedArgument(pointer, "Source1"), FfiNamedArgument(pointer, "Source2"),
+                     FfiNamedArgument(FfiType.UINT64, "Length")]),
+        FfiFunction("ZwOpenEvent", FfiType.SINT,
+                    [FfiNamedArgument(pointer, "EventHandle"), FfiNamedArgument(FfiType.ULONG, "DesiredAccess"),
+                     FfiNamedArgument(pointer, "ObjectAttributes")]),
+    ]
+    for function in functions:
+        client._set_function(MODULE_NAME, function)
+
+
+def _make_list(length: int):
+    """
+    :return: A pointer to the head of a linked list, each of whose nodes points to object attributes with a name.
+    """
+
+    head = None
+    for value in range(length):
+        name = UNICODE_STRING(0, 0, None)
+        attributes = OBJECT_ATTRIBUTES(ctypes.sizeof(OBJECT_ATTRIBUTES), None, ctypes.pointer(name), 0x40, None, None)
+        node = LIST_NODE(head, ctypes.pointer(attributes), value)
+        head = ctypes.pointer(node)
+
+    return head
+
+
+# Cases
+
+
+def _translate_nested(env: Environment):
+    head = _make_list(4)
+
+    def operation():
+        translated_args = TranslatedArgs(env.broker, head)
+        for allocation in translated_args.allocations:
+            allocation.free()
+
+    return operation
+
+
+def _get_as_native_value(env: Environment):
+    head = _make_list(1)
+    native_type = get_native_type(LIST_NODE, get_native_pointer_type(env.broker.get_pointer_size()))
+    address_map = {ctypes.addressof(head.contents.Attributes.contents): 0xFFFFA00000001000}
+    return lambda: get_as_native_value(head.contents, native_type, address_map)
+
+
+def _read_back(env: Environment):
+    translated_args = TranslatedArgs(env.broker, _make_list(4))
+    return translated_args.read_back
+
+
+def _call(env: Environment):
+    compare_memory = env.client.prepare(MODULE_NAME, "RtlCompareMemory")
+    compare_memory(0, 0, 0)  # Resolves the function
+    return lambda: env.client.call(MODULE_NAME, "RtlCompareMemory", 0x1000, 0x2000, 0x10)
+
+
+def _call_by_name(env: Environment):
+    env.client.resolve_routines = False
+    return lambda: env.client.call(MODULE_NAME, "RtlCompareMemory", 0x1000, 0x2000, 0x10)
+
+
+def _ex_call(env: Environment):
+    source = "Hello, world\0".encode("utf-16-le")
+
+    def operation():
+        with env.client.session():
+            env.client.ex_call(MODULE_NAME, "RtlInitUnicodeString", ctypes.pointer(UNICODE_STRING()), source)
+
+    return operation
+
+
+def _ex_call_nested(env: Environment):
+    name = UNICODE_STRING(0, 0, None)
+    attributes = OBJECT_ATTRIBUTES(ctypes.sizeof(OBJECT_ATTRIBUTES), None, ctypes.pointer(name), 0x40, None, None)
+
+    def operation():
+        with env.client.session():
+            env.client.ex_call(MODULE_NAME, "ZwOpenEvent", ctypes.pointer(ctypes.c_void_p()), 0x1F0003,
+                               ctypes.pointer(attributes))
+
+    return operation
+
+
+def _read_wstring(env: Environment):
+    allocation = env.client.allocate(0x100)
+    allocation.write(("A" * 64 + "\0").encode("utf-16-le"))
+    return lambda: env.client.read_wstring(allocation.address)
+
+
+def _read_many(env: Environment):
+    allocation = env.client.allocate(0x1000)
+    # The fields of a structure walk, one every 0x100 bytes
+    ranges = [(allocation.address + offset, 8) for offset in range(0, 0x1000, 0x100)]
+
+    def read_many():
+        results = env.client.read_many(ranges)
+        assert len(allocation) != 0  # Keeps the allocation from being garbage collected, which frees it
+        return results
+
+    return read_many
+
+
+def _read_bytes_1m(env: Environment):
+    allocation = env.client.allocate(0x100000)
+    return lambda: env.client.read_bytes(allocation.address, len(allocation))
+
+
+def _read_into_1m(env: Environment):
+    allocation = env.client.allocate(0x100000)
+    buffer = bytearray(len(allocation))
+    return lambda: env.client.read_into(allocation.address, buffer)
+
+
+def _dump_4m(env: Environment):
+    allocation = env.client.allocate(0x400000)
+    return lambda: env.client.dump(allocation.address, len(allocation), io.BytesIO())
+
+
+def _ioctl_call_function(env: Environment):
+    request = CallFunction(MODULE_NAME, "RtlCompareMemory", FfiType.ULONG,
+                           [FfiArgument(FfiType.POINTER, 0x1000), FfiArgument(FfiType.POINTER, 0x2000),
+                            FfiArgument(FfiType.UINT64, 0x10)])
+    return lambda: IoctlCallFunction(request).serialize(), len(IoctlCallFunction(request).serialize())
+
+
+def _ioctl_read_bytes(env: Environment):
+    request = ReadBytes(0xFFFFA00000001000, 0x1000)
+    return lambda: IoctlReadBytes(request).serialize(), len(IoctlReadBytes(request).serialize())
+
+
+def _protocol_call_function(env: Environment):
+    request = BrokerRequest(BrokerRequestType.CALL_FUNCTION, CallFunction(
+        MODULE_NAME, "RtlCompareMemory", FfiType.ULONG,
+        [FfiArgument(FfiType.POINTER, 0x1000), FfiArgument(FfiType.POINTER, 0x2000), FfiArgument(FfiType.UINT64, 0x10)]))
+
+    return lambda: decode_request(encode_request(1, request)), len(encode_request(1, request))
+
+
+def _protocol_read_response(env: Environment):
+    response = BrokerResponse(BrokerResponseType.SUCCESS, bytes(range(256)) * 16)
+
+    return lambda: decode_response(encode_response(1, response)), len(encode_response(1, response))
+
+
+def _parse_declarations(env: Environment):
+    from pykeval.frontend.parse_cache import CacheMode
+    from pykeval.frontend.parser import CParser
+
+    return lambda: CParser.get_functions_from_c_string(DECLARATIONS, None, CacheMode.BYPASS)
+
+
+def _parse_declarations_cached(env: Environment):
+    import tempfile
+    from pykeval.frontend.parse_cache import ParseCache
+    from pykeval.frontend.parser import CParser
+
+    cache = ParseCache(tempfile.mkdtemp(prefix="pykeval-bench-"))
+    CParser.get_functions_from_c_string(DECLARATIONS, cache)
+    return lambda: CParser.get_functions_from_c_string(DECLARATIONS, cache)
+
+
+CASES = [
+    Case("marshal/translate_nested", _translate_nested),
+    Case("marshal/get_as_native_value", _get_as_native_value),
+    Case("marshal/read_back", _read_back),
+    Case("client/call", _call),
+    Case("client/call_by_name", _call_by_name),
+    Case("client/ex_call", _ex_call),
+    Case("client/ex_call_nested", _ex_call_nested),
+    Case("client/read_wstring", _read_wstring),
+    Case("client/read_many_16", _read_many),
+    Case("client/read_bytes_1m", _read_bytes_1m),
+    Case("client/read_into_1m", _read_into_1m),
+    Case("client/dump_4m", _dump_4m),
+    Case("ioctl/call_function", _ioctl_call_function),
+    Case("ioctl/read_bytes", _ioctl_read_bytes),
+    Case("protocol/call_function", _protocol_call_function),
+    Case("protocol/read_response_4k", _protocol_read_response),
+    Case("parse/declarations", _parse_declarations),
+    Case("parse/declarations_cached", _parse_declarations_cached),
+]
+
+
+# Running
+
+
+def _get_free_port() -> int:
+    with closing(socket.socket()) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_server(simulated: SimulatedBroker) -> Broker:
+    """
+    Serves the broker on the loopback interface.
+
+    :return: A broker connected to the server.
+    """
+
+    from pykeval.broker.remote import RemoteBroker
+    from pykeval.broker.remote_server import RemoteBrokerServer
+
+    port = _get_free_port()
+    threading.Thread(target=RemoteBrokerServer(simulated, "127.0.0.1", port).start, daemon=True).start()
+
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            break
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+    return RemoteBroker("127.0.0.1", port)
+
+
+def _create_environment(transport: str) -> Environment:
+    simulated = SimulatedBroker()
+    _register_routines(simulated)
+    broker = ProfilingBroker(_start_server(simulated) if transport == "tcp" else simulated, Profile())
+    client = Client(broker)
+    client.parse_cache = None
+    _declare(client)
+    return Environment(simulated, broker, client)
+
+
+def _time_operation(operation: Callable, min_time: float) -> float:
+    """
+    :return: The best time of a single operation, in seconds.
+    """
+
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            operation()
+        elapsed = time.perf_counter() - start
+        if elapsed >= 0.02:
+            break
+        number *= 4
+
+    best = elapsed / number
+    deadline = time.perf_counter() + min_time
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        for _ in range(number):
+            operation()
+        best = min(best, (time.perf_counter() - start) / number)
+
+    return best
+
+
+def run_case(case: Case, transport: str, min_time: float, metered_runs: int = 20) -> CaseResult:
+    env = _create_environment(transport)
+    operation = case.setup(env)
+    message_size = 0
+    if isinstance(operation, tuple):
+        operation, message_size = operation
+
+    env.broker.profile = Profile()
+    for _ in range(metered_runs):
+        operation()
+    requests = env.broker.profile.requests.values()
+    round_trips = sum(statistics.round_trips for statistics in requests) / metered_runs
+    bytes_sent = sum(statistics.bytes_sent for statistics in requests) / metered_runs + message_size
+    bytes_received = sum(statistics.bytes_received for statistics in requests) / metered_runs
+
+    return CaseResult(ops_per_sec=1 / _time_operation(operation, min_time),
+                      round_trips_per_op=round_trips,
+                      bytes_sent_per_op=bytes_sent,
+                      bytes_received_per_op=bytes_received)
+
+
+def _print_results(results: Dict[str, CaseResult], baseline: Optional[dict]):
+    header = f"{'case':<30}{'ops/sec':>12}{'trips/op':>10}{'sent B/op':>11}{'recv B/op':>11}"
+    if baseline is not None:
+        header += f"{'vs baseline':>13}"
+    print(header)
+
+    for name, result in results.items():
+        line = (f"{name:<30}{result.ops_per_sec:>12.0f}{result.round_trips_per_op:>10.2f}"
+                f"{result.bytes_sent_per_op:>11.0f}{result.bytes_received_per_op:>11.0f}")
+
+        baseline_result = baseline.get(name) if baseline is not None else None
+        if baseline_result is not None:
+            line += f"{result.ops_per_sec / baseline_result['ops_per_sec']:>12.2f}x"
+            if baseline_result["round_trips_per_op"] != result.round_trips_per_op:
+                line += f"  (round trips were {baseline_result['round_trips_per_op']:.2f})"
+        print(line)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-t", "--transport", help="Where the simulated broker runs.", choices=("memory", "tcp"),
+                        default="memory")
+    parser.add_argument("-k", "--filter", help="Only run the cases whose name contains this.", default="")
+    parser.add_argument("--min-time", help="The minimal number of seconds to measure each case for.", type=float,
+                        default=0.5)
+    parser.add_argument("-o", "--output", help="Save the results to this JSON file.")
+    parser.add_argument("-c", "--compare", help="Compare the results with a JSON file saved by a previous run.")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+
+    results = {}
+    skipped = {}
+    for case in CASES:
+        if args.filter not in case.name:
+            continue
+        try:
+            results[case.name] = run_case(case, args.transport, args.min_time)
+        except ImportError as e:
+            # Parsing needs libclang, which is optional
+            skipped[case.name] = str(e)
+
+    _print_results(results, baseline)
+    for name, reason in skipped.items():
+        print(f"{name:<30}skipped: {reason}")
+
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump({"version": RESULTS_FORMAT_VERSION,
+                       "transport": args.transport,
+                       "python": sys.version.split()[0],
+                       "platform": platform.platform(),
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "results": {name: asdict(result) for name, result in results.items()},
+                       "skipped": skipped},
+                      output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,27 @@
-from .local import LocalBroker
-from .remote import RemoteBroker
-from .remote_server import RemoteBrokerServer
+from importlib import import_module
+
+# Brokers are imported when they are first used, so using one broker doesn't pay for importing the others (such as the
+# IOCTL stack `LocalBroker` needs, or asyncio).
+_BROKER_MODULES = {
+    "LocalBroker": ".local",
+    "RemoteBroker": ".remote",
+    "RemoteBrokerServer": ".remote_server",
+    "AsyncRemoteBroker": ".async_remote",
+    "CachingBroker": ".caching",
+    "SimulatedBroker": ".simulated",
+}
+
+__all__ = list(_BROKER_MODULES)
+
+
+def __getattr__(name: str):
+    if name not in _BROKER_MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = getattr(import_module(_BROKER_MODULES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,371 @@
+import asyncio
+import itertools
+import logging
+import socket
+from typing import Dict, List, Optional
+
+from pykeval.broker.interface import start_request_span
+from pykeval.broker.messaging import receive_async, send_buffered, ConnectionClosedError
+from pykeval.broker.remote import DEFAULT_SERVER_PORT
+from pykeval.broker.remote_protocol import (ServerHello, Capability, Compression, DEFAULT_COMPRESSION_THRESHOLD,
+                                            create_client_hello, encode_client_hello, decode_server_hello,
+                                            check_server_hello, get_required_capabilities, encode_request_parts,
+                                            decode_response)
+from pykeval.broker.read_until import read_until_steps
+from pykeval.broker.requests import (BrokerRequest, BrokerRequestType, BrokerResponseType, Batch, CallFunction,
+                                     ResolveRoutine, CallAddress, ReadBytes, ReadUntil, WriteBytes, ReadMany, WriteMany,
+                                     Allocate, Free)
+from pykeval.shared.tracing import get_tracer
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncRemoteBroker:
+    """
+    An asyncio proxy to a broker server over TCP. This mirrors `RemoteBroker`, but all operations are coroutines.
+
+    Requests are multiplexed over a single connection: each request carries an ID, so many requests may be in flight at
+    the same time. If the server's broker is thread safe, the server executes them concurrently and their responses may
+    arrive in any order; otherwise it executes them one at a time. The connection is opened on the first request and
+    reopened if it is lost.
+    """
+
+    def __init__(self,
+                 address: str,
+                 port: int = DEFAULT_SERVER_PORT,
+                 max_in_flight: int = 64,
+                 timeout: Optional[float] = None,
+                 compression_level: Optional[int] = None,
+                 compression_threshold: int = DEFAULT_COMPRESSION_THRESHOLD):
+        """
+        :param address: The address of the broker server
+        :param port: The port of the broker server
+        :param max_in_flight: The maximum number of requests that may wait for a response at the same time. Further
+                              requests wait until a response arrives.
+        :param timeout: The default deadline in seconds for each request. None to wait indefinitely.
+        :param compression_level: The zlib level (1-9) to compress messages with. See `RemoteBroker`.
+        :param compression_threshold: The size in bytes from which messages are compressed.
+        """
+
+        if max_in_flight < 1:
+            raise ValueError(f"At least one request must be allowed in flight (got {max_in_flight})")
+        if compression_level is not None and not 1 <= compression_level <= 9:
+            raise ValueError(f"Compression level must be between 1 and 9 (got {compression_level})")
+
+        self.server_address = address
+        self.server_port = port
+        self.timeout = timeout
+        self._max_in_flight = max_in_flight
+        self._requested_compression = (Compression(compression_level, compression_threshold)
+                                       if compression_level is not None else None)
+        # The compression agreed on with the server, if any
+        self._compression = None  # type: Optional[Compression]
+
+        self._server_hello = None  # type: Optional[ServerHello]
+        self._request_ids = itertools.count(1)
+        self._writer = None  # type: Optional[asyncio.StreamWriter]
+        self._receive_task = None  # type: Optional[asyncio.Task]
+        self._pending = {}  # type: Dict[int, asyncio.Future]
+
+        # Created on connection, so they are bound to the running event loop.
+        self._connect_lock = None  # type: Optional[asyncio.Lock]
+        self._window = None  # type: Optional[asyncio.Semaphore]
+
+    async def get_pointer_size(self) -> int:
+        if self._server_hello is None:
+            # The pointer size is sent by the server when connecting.
+            await self._connect_within(self.timeout)
+        return self._server_hello.pointer_size
+
+    async def call_function(self, request_data: CallFunction, timeout: Optional[float] = None) -> any:
+        return await self._send_request(BrokerRequest(BrokerRequestType.CALL_FUNCTION, request_data), timeout)
+
+    async def resolve_routine(self, request_data: ResolveRoutine, timeout: Optional[float] = None) -> int:
+        """
+        See `Broker.resolve_routine()`.
+
+        :raises NotImplementedError if the server does not support it.
+        """
+
+        await self._ensure_server_supports(Capability.ROUTINES, "resolving routines", timeout)
+        return await self._send_request(BrokerRequest(BrokerRequestType.RESOLVE_ROUTINE, request_data), timeout)
+
+    async def call_address(self, request_data: CallAddress, timeout: Optional[float] = None) -> any:
+        """
+        See `Broker.call_address()`.
+
+        :raises NotImplementedError if the server does not support it.
+        """
+
+        await self._ensure_server_supports(Capability.ROUTINES, "calling addresses", timeout)
+        return await self._send_request(BrokerRequest(BrokerRequestType.CALL_ADDRESS, request_data), timeout)
+
+    async def read_bytes(self, request_data: ReadBytes, timeout: Optional[float] = None) -> bytes:
+        return await self._send_request(BrokerRequest(BrokerRequestType.READ_BYTES, request_data), timeout)
+
+    async def read_until(self, request_data: ReadUntil, timeout: Optional[float] = None) -> bytes:
+        """
+        Reads next to the target, or in chunks over the network if the server does not support it.
+        See `Broker.read_until()`.
+        """
+
+        if await self._server_supports(Capability.READ_UNTIL, timeout):
+            return await self._send_request(BrokerRequest(BrokerRequestType.READ_UNTIL, request_data), timeout)
+
+        steps = read_until_steps(request_data)
+        data = None
+        try:
+            while True:
+                data = await self.read_bytes(steps.send(data), timeout)
+        except StopIteration as e:
+            return e.value
+
+    async def write_bytes(self, request_data: WriteBytes, timeout: Optional[float] = None):
+        return await self._send_request(BrokerRequest(BrokerRequestType.WRITE_BYTES, request_data), timeout)
+
+    async def read_many(self, request_data: ReadMany, timeout: Optional[float] = None) -> List[any]:
+        """
+        Reads all ranges in a single request, or in a batch of reads if the server does not support it.
+        See `Broker.read_many()`.
+        """
+
+        if await self._server_supports(Capability.MANY, timeout):
+            return await self._send_request(BrokerRequest(BrokerRequestType.READ_MANY, request_data), timeout)
+
+        return await self.execute_batch([BrokerRequest(BrokerRequestType.READ_BYTES, entry)
+                                         for entry in request_data.entries],
+                                        timeout)
+
+    async def write_many(self, request_data: WriteMany, timeout: Optional[float] = None) -> List[any]:
+        """
+        Writes all ranges in a single request, or in a batch of writes if the server does not support it.
+        See `Broker.write_many()`.
+        """
+
+        if await self._server_supports(Capability.MANY, timeout):
+            return await self._send_request(BrokerRequest(BrokerRequestType.WRITE_MANY, request_data), timeout)
+
+        return await self.execute_batch([BrokerRequest(BrokerRequestType.WRITE_BYTES, entry)
+                                         for entry in request_data.entries],
+                                        timeout)
+
+    async def allocate(self, request_data: Allocate, timeout: Optional[float] = None) -> int:
+        return await self._send_request(BrokerRequest(BrokerRequestType.ALLOCATE, request_data), timeout)
+
+    async def free(self, request_data: Free, timeout: Optional[float] = None):
+        return await self._send_request(BrokerRequest(BrokerRequestType.FREE, request_data), timeout)
+
+    async def execute(self, request: BrokerRequest, timeout: Optional[float] = None) -> any:
+        """
+        Executes a single request. See `Broker.execute()`.
+        """
+
+        if request.type is BrokerRequestType.GET_POINTER_SIZE:
+            return await self.get_pointer_size()
+
+        if request.type is BrokerRequestType.READ_UNTIL:
+            return await self.read_until(request.data, timeout)
+
+        if request.type is BrokerRequestType.READ_MANY:
+            return await self.read_many(request.data, timeout)
+
+        if request.type is BrokerRequestType.WRITE_MANY:
+            return await self.write_many(request.data, timeout)
+
+        if request.type in (BrokerRequestType.RESOLVE_ROUTINE, BrokerRequestType.CALL_ADDRESS):
+            await self._ensure_server_supports(Capability.ROUTINES, f"{request.type.name} requests", timeout)
+
+        return await self._send_request(request, timeout)
+
+    async def execute_batch(self, requests: List[BrokerRequest], timeout: Optional[float] = None) -> List[any]:
+        """
+        Executes independent requests in order. See `Broker.execute_batch()`.
+
+        :return: For each request, either its result or the exception it raised.
+        """
+
+        if len(requests) == 0:
+            return []
+
+        if await self._server_supports(Capability.BATCH | get_required_capabilities(requests), timeout):
+            return await self._send_request(BrokerRequest(BrokerRequestType.BATCH, Batch(requests)), timeout)
+
+        results = []
+        for request in requests:
+            try:
+                results.append(await self.execute(request, timeout))
+            except Exception as e:
+                results.append(e)
+
+        return results
+
+    async def close(self):
+        """
+        Closes the connection to the server. Requests that are still in flight fail.
+        """
+
+        if self._receive_task is not None:
+            self._receive_task.cancel()
+            try:
+                await self._receive_task
+            except asyncio.CancelledError:
+                pass
+
+        self._disconnect(ConnectionClosedError(0, 0))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def _send_request(self, request: BrokerRequest, timeout: Optional[float]) -> any:
+        """
+        Sends a request to the server and waits for its response.
+        If the deadline passes or the caller is cancelled, the response is ignored once it arrives. Note that the
+        server may still execute the request.
+
+        :param timeout: The deadline in seconds for the whole request, including waiting for room in the window and
+                        connecting. None for the default deadline.
+        :raises asyncio.TimeoutError if the deadline passed.
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+
+        if get_tracer() is None:
+            return await asyncio.wait_for(self._exchange(request), timeout)
+
+        with start_request_span(self, request.type, request.data):
+            return await asyncio.wait_for(self._exchange(request), timeout)
+
+    async def _exchange(self, request: BrokerRequest) -> any:
+        self._create_primitives()
+        await self._window.acquire()
+        # The window is released by `_receive_responses()` once the response arrives (or the connection is lost), even
+        # if nobody waits for it anymore. This keeps abandoned requests counted until the server is done with them.
+        try:
+            await self._ensure_connected()
+        except BaseException:
+            self._window.release()
+            raise
+
+        request_id = next(self._request_ids) & 0xFFFFFFFF
+        future = asyncio.get_running_loop().create_future()
+        writer = self._writer
+        try:
+            parts = encode_request_parts(request_id, request)
+            if writer is None:
+                raise ConnectionClosedError(0, 0)
+            self._pending[request_id] = future
+            send_buffered(writer, *parts, compression=self._compression)
+        except BaseException:
+            self._pending.pop(request_id, None)
+            self._window.release()
+            raise
+
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass  # The request fails once the connection loss is noticed while receiving
+
+        response = await future
+
+        if response.type is BrokerResponseType.EXCEPTION:
+            raise response.data  # Exception was raised on the remote broker. Try viewing its logs for more info.
+        return response.data
+
+    async def _server_supports(self, capabilities: Capability, timeout: Optional[float]) -> bool:
+        if self._server_hello is None:
+            # The capabilities of the server are sent when connecting
+            await self._connect_within(self.timeout if timeout is None else timeout)
+        return self._server_hello.capabilities & capabilities == capabilities
+
+    async def _ensure_server_supports(self, capabilities: Capability, feature: str, timeout: Optional[float]):
+        if not await self._server_supports(capabilities, timeout):
+            raise NotImplementedError(f"The server does not support {feature}")
+
+    async def _connect_within(self, timeout: Optional[float]):
+        await asyncio.wait_for(self._ensure_connected(), timeout)
+
+    def _create_primitives(self):
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+            self._window = asyncio.Semaphore(self._max_in_flight)
+
+    async def _ensure_connected(self):
+        self._create_primitives()
+        async with self._connect_lock:
+            if self._writer is not None:
+                return
+
+            logger.debug(f"Connecting with {self.server_address}:{self.server_port}")
+            reader, writer = await asyncio.open_connection(self.server_address, self.server_port)
+            try:
+                writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                await self._handshake(reader, writer)
+            except BaseException:
+                writer.close()
+                raise
+
+            self._writer = writer
+            self._receive_task = asyncio.get_running_loop().create_task(self._receive_responses(reader, writer))
+
+    async def _handshake(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Agrees on the protocol with the server over a new connection.
+
+        :raises ProtocolError if the server does not support this client.
+        """
+
+        send_buffered(writer, encode_client_hello(create_client_hello(self._requested_compression)))
+        await writer.drain()
+        server_hello = decode_server_hello(await receive_async(reader))
+        check_server_hello(server_hello)
+        logger.debug(f"Connected to server with {server_hello}")
+        self._server_hello = server_hello
+        self._compression = (self._requested_compression
+                             if server_hello.capabilities & Capability.COMPRESSION else None)
+
+    async def _receive_responses(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Passes each response to the request that waits for it, until the connection is lost.
+        """
+
+        error = ConnectionClosedError(0, 0)
+        try:
+            while True:
+                response_id, response = decode_response(await receive_async(reader, self._compression))
+
+                future = self._pending.pop(response_id, None)
+                if future is None:
+                    logger.warning(f"Got response to unknown request {response_id}")
+                    continue
+
+                self._window.release()
+                if not future.done():
+                    future.set_result(response)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.debug(f"Connection with server lost: {e}")
+            error = e
+        finally:
+            if self._writer is writer:
+                self._disconnect(error)
+
+    def _disconnect(self, error: Exception):
+        """
+        Closes the connection and fails all requests that wait for a response.
+        """
+
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = None
+        self._receive_task = None
+
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            self._window.release()
+            if not future.done():
+                future.set_exception(error)
@@ -0,0 +1,437 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from pykeval.broker.interface import Broker
+from pykeval.broker.read_until import PAGE_SIZE, read_until_steps
+from pykeval.broker.requests import (CallFunction, ResolveRoutine, CallAddress, ReadBytes, ReadUntil, WriteBytes,
+                                     Allocate, Free, BrokerRequest, BrokerRequestType)
+
+DEFAULT_CACHE_SIZE = 16 * 1024 * 1024
+
+
+@dataclass
+class CacheStatistics:
+    """
+    Counts of pages, since the cache was created.
+    """
+
+    hits: int = 0
+    misses: int = 0
+    # Misses on pages that another thread was already reading, so they were not read again.
+    shared: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+
+class _PageFetch:
+    """
+    A read of a page that is in progress. Other readers of the page wait for it instead of reading it again.
+    """
+
+    def __init__(self):
+        self.future = Future()
+        # Set if the page was invalidated while it was read, so the data that is read is not cached.
+        self.stale = False
+
+
+class _PendingRead:
+    """
+    A read in a batch that is in progress. Its data is cached once the batch returns, unless its memory was invalidated
+    in the meantime.
+    """
+
+    def __init__(self, address: int, size: int):
+        self.address = address
+        # The most memory the read may return
+        self.size = size
+        self.stale = False
+
+    def overlaps(self, address: int, size: int) -> bool:
+        return address < self.address + self.size and self.address < address + size
+
+
+def _get_pages(address: int, size: int) -> List[int]:
+    """
+    :return: The addresses of the pages the given range touches.
+    """
+
+    return list(range(address - address % PAGE_SIZE, address + size, PAGE_SIZE))
+
+
+def _get_contiguous_runs(pages: List[int]) -> List[List[int]]:
+    runs = []
+    for page in sorted(pages):
+        if len(runs) != 0 and runs[-1][-1] + PAGE_SIZE == page:
+            runs[-1].append(page)
+        else:
+            runs.append([page])
+
+    return runs
+
+
+class CachingBroker(Broker):
+    """
+    Caches memory that is read through another broker, in whole pages. The least recently used pages are evicted once
+    the cache is full.
+
+    Memory that is written, allocated or freed through this broker is invalidated, and by default so is everything
+    after a function is called. Changes made to memory in any other way (by the kernel itself, for example) are not
+    noticed, so call `invalidate()` when memory may have changed. Since whole pages are read, don't use this for memory
+    that is affected by being read (such as device memory).
+
+    Concurrent reads of the same page are read from the underlying broker only once.
+    """
+
+    def __init__(self, broker: Broker, max_size: int = DEFAULT_CACHE_SIZE, invalidate_on_call: bool = True):
+        """
+        :param broker: The broker to cache the memory of.
+        :param max_size: The maximal number of bytes to cache. Pinned pages are kept even beyond it.
+        :param invalidate_on_call: Whether to invalidate the entire cache after every function call, since the function
+                                   may change any memory.
+        """
+
+        self._broker = broker
+        self._max_pages = max_size // PAGE_SIZE
+        self._invalidate_on_call = invalidate_on_call
+
+        self._lock = threading.Lock()
+        self._pages = OrderedDict()  # type: OrderedDict[int, bytes]  # Least recently used first
+        self._pinned_pages = set()
+        self._fetches = {}  # type: Dict[int, _PageFetch]
+        self._pending_reads = []  # type: List[_PendingRead]
+        self._allocation_sizes = {}  # type: Dict[int, int]
+
+        self.statistics = CacheStatistics()
+
+    @property
+    def thread_safe(self) -> bool:
+        return self._broker.thread_safe
+
+    def get_pointer_size(self) -> int:
+        return self._broker.get_pointer_size()
+
+    def call_function(self, request_data: CallFunction) -> any:
+        try:
+            return self._broker.call_function(request_data)
+        finally:
+            self._apply_effects(BrokerRequest(BrokerRequestType.CALL_FUNCTION, request_data))
+
+    def resolve_routine(self, request_data: ResolveRoutine) -> int:
+        return self._broker.resolve_routine(request_data)
+
+    def call_address(self, request_data: CallAddress) -> any:
+        try:
+            return self._broker.call_address(request_data)
+        finally:
+            self._apply_effects(BrokerRequest(BrokerRequestType.CALL_ADDRESS, request_data))
+
+    def read_bytes(self, request_data: ReadBytes) -> bytes:
+        if request_data.size == 0:
+            return b""
+
+        pages = _get_pages(request_data.address, request_data.size)
+        with self._lock:
+            page_data = {}
+            fetches = {}
+            own_pages = []  # Pages this thread reads, rather than waits for
+            for page in pages:
+                data = self._pages.get(page)
+                if data is not None:
+                    self._pages.move_to_end(page)
+                    page_data[page] = data
+                    self.statistics.hits += 1
+                elif page in self._fetches:
+                    fetches[page] = self._fetches[page]
+                    self.statistics.shared += 1
+                else:
+                    fetches[page] = self._fetches[page] = _PageFetch()
+                    own_pages.append(page)
+                    self.statistics.misses += 1
+
+        if len(own_pages) != 0:
+            self._fetch_pages(own_pages, fetches)
+
+        for page, fetch in fetches.items():
+            page_data[page] = fetch.future.result()
+
+        offset = request_data.address - pages[0]
+        return b"".join(page_data[page] for page in pages)[offset:offset + request_data.size]
+
+    def read_until(self, request_data: ReadUntil) -> bytes:
+        """
+        Reads from the cache if the data and its terminator are cached, or with the underlying broker otherwise.
+        """
+
+        data = self._read_until_cached(request_data)
+        if data is not None:
+            return data
+
+        return self._broker.read_until(request_data)
+
+    def write_bytes(self, request_data: WriteBytes):
+        try:
+            return self._broker.write_bytes(request_data)
+        finally:
+            self._apply_effects(BrokerRequest(BrokerRequestType.WRITE_BYTES, request_data))
+
+    def allocate(self, request_data: Allocate) -> int:
+        address = self._broker.allocate(request_data)
+        self._apply_effects(BrokerRequest(BrokerRequestType.ALLOCATE, request_data), address)
+        return address
+
+    def free(self, request_data: Free):
+        try:
+            return self._broker.free(request_data)
+        finally:
+            self._apply_effects(BrokerRequest(BrokerRequestType.FREE, request_data))
+
+    def execute_batch(self, requests: List[BrokerRequest]) -> List[any]:
+        """
+        Answers the reads that are cached locally and passes the rest of the requests to the underlying broker in a
+        single batch.
+        """
+
+        results = [None] * len(requests)
+        forwarded = []
+        for index, request in enumerate(requests):
+            if request.type is BrokerRequestType.READ_BYTES:
+                data = self._read_cached(request.data)
+            elif request.type is BrokerRequestType.READ_UNTIL:
+                data = self._read_until_cached(request.data)
+            else:
+                data = None
+                # Later reads in the batch must not be answered from memory this request changes
+                self._invalidate_affected(request)
+
+            if data is not None:
+                results[index] = data
+            else:
+                forwarded.append(index)
+
+        if len(forwarded) == 0:
+            return results
+
+        pending_reads = {}  # type: Dict[int, _PendingRead]
+        for index in forwarded:
+            request = requests[index]
+            if request.type is BrokerRequestType.READ_BYTES:
+                pending_reads[index] = _PendingRead(request.data.address, request.data.size)
+            elif request.type is BrokerRequestType.READ_UNTIL:
+                pending_reads[index] = _PendingRead(request.data.address, request.data.max_size)
+
+        with self._lock:
+            self._pending_reads.extend(pending_reads.values())
+
+        try:
+            forwarded_results = self._broker.execute_batch([requests[index] for index in forwarded])
+            # Results are applied in order, so reads that follow a write in the batch are not cached
+            for index, result in zip(forwarded, forwarded_results):
+                results[index] = result
+                if index in pending_reads and isinstance(result, (bytes, bytearray)):
+                    self._store_read(pending_reads[index], result)
+                self._apply_effects(requests[index], result)
+        finally:
+            with self._lock:
+                for pending_read in pending_reads.values():
+                    self._pending_reads.remove(pending_read)
+
+        return results
+
+    def invalidate(self, address: Optional[int] = None, size: Optional[int] = None):
+        """
+        Drops memory from the cache.
+
+        :param address: The start of the memory to drop, or None to drop everything.
+        :param size: The size of the memory to drop.
+        """
+
+        with self._lock:
+            if address is None:
+                pages = list(self._pages)
+                fetches = list(self._fetches.values())
+            else:
+                pages = _get_pages(address, size)
+                fetches = [self._fetches[page] for page in pages if page in self._fetches]
+
+            for page in pages:
+                if self._pages.pop(page, None) is not None:
+                    self.statistics.invalidations += 1
+            for fetch in fetches:
+                fetch.stale = True
+            for pending_read in self._pending_reads:
+                if address is None or pending_read.overlaps(address, size):
+                    pending_read.stale = True
+
+    def pin(self, address: int, size: int):
+        """
+        Keeps the pages of the given memory in the cache once they are read, even if they are the least recently used.
+        They are still invalidated when the memory changes.
+        """
+
+        with self._lock:
+            self._pinned_pages.update(_get_pages(address, size))
+
+    def unpin(self, address: int, size: int):
+        """
+        Lets the pages of the given memory be evicted again. See `pin()`.
+        """
+
+        with self._lock:
+            self._pinned_pages.difference_update(_get_pages(address, size))
+            self._evict()
+
+    def _read_cached(self, request_data: ReadBytes) -> Optional[bytes]:
+        """
+        :return: The data, or None if any of it is not cached.
+        """
+
+        if request_data.size == 0:
+            return b""
+
+        pages = _get_pages(request_data.address, request_data.size)
+        with self._lock:
+            if any(page not in self._pages for page in pages):
+                return None
+
+            for page in pages:
+                self._pages.move_to_end(page)
+            self.statistics.hits += len(pages)
+            data = b"".join(self._pages[page] for page in pages)
+
+        offset = request_data.address - pages[0]
+        return data[offset:offset + request_data.size]
+
+    def _read_until_cached(self, request_data: ReadUntil) -> Optional[bytes]:
+        """
+        :return: The data, or None if any of it (or the terminator) is not cached.
+        """
+
+        steps = read_until_steps(request_data)
+        data = None
+        try:
+            while True:
+                data = self._read_cached(steps.send(data))
+                if data is None:
+                    return None
+        except StopIteration as e:
+            return e.value
+
+    def _fetch_pages(self, pages: List[int], fetches: Dict[int, _PageFetch]):
+        """
+        Reads the given pages with the underlying broker, in one batch, and completes their fetches.
+        """
+
+        runs = _get_contiguous_runs(pages)
+        try:
+            results = self._broker.execute_batch([BrokerRequest(BrokerRequestType.READ_BYTES,
+                                                                ReadBytes(run[0], len(run) * PAGE_SIZE))
+                                                  for run in runs])
+        except BaseException as e:
+            results = [e] * len(runs)
+            raise
+        finally:
+            with self._lock:
+                for run, result in zip(runs, results):
+                    for index, page in enumerate(run):
+                        fetch = fetches[page]
+                        del self._fetches[page]
+                        if isinstance(result, BaseException):
+                            fetch.future.set_exception(result)
+                            continue
+
+                        data = result[index * PAGE_SIZE:(index + 1) * PAGE_SIZE]
+                        fetch.future.set_result(data)
+                        if not fetch.stale:
+                            self._store(page, data)
+
+    def _store_read(self, pending_read: _PendingRead, data: bytes):
+        """
+        Caches the whole pages a read in a batch returned.
+        """
+
+        first_page = pending_read.address + (-pending_read.address % PAGE_SIZE)
+        end_page = (pending_read.address + len(data)) & ~(PAGE_SIZE - 1)
+        with self._lock:
+            if pending_read.stale:
+                return
+
+            for page in range(first_page, end_page, PAGE_SIZE):
+                offset = page - pending_read.address
+                self._store(page, bytes(data[offset:offset + PAGE_SIZE]))
+
+    def _store(self, page: int, data: bytes):
+        """
+        Must be called with the lock held.
+        """
+
+        self._pages[page] = data
+        self._pages.move_to_end(page)
+        self._evict()
+
+    def _evict(self):
+        """
+        Evicts the least recently used pages that are not pinned until the cache fits its size.
+        Must be called with the lock held.
+        """
+
+        # Pinned pages are moved out of the way, so the least recently used page is always at the front
+        skipped = 0
+        while len(self._pages) > self._max_pages and skipped < len(self._pages):
+            page = next(iter(self._pages))
+            if page in self._pinned_pages:
+                self._pages.move_to_end(page)
+                skipped += 1
+                continue
+
+            del self._pages[page]
+            self.statistics.evictions += 1
+
+    def _apply_effects(self, request: BrokerRequest, result: any = None):
+        """
+        Updates the cache after a request was executed.
+
+        :param result: The result of the request.
+        """
+
+        self._invalidate_affected(request, result)
+
+        if request.type is BrokerRequestType.ALLOCATE and isinstance(result, int):
+            self._allocation_sizes[result] = request.data.size
+        elif request.type is BrokerRequestType.FREE:
+            self._allocation_sizes.pop(request.data.address, None)
+        elif request.type is BrokerRequestType.BATCH and isinstance(result, list):
+            for inner_request, inner_result in zip(request.data.requests, result):
+                self._apply_effects(inner_request, inner_result)
+
+    def _invalidate_affected(self, request: BrokerRequest, result: any = None):
+        """
+        Invalidates the memory a request may change.
+
+        :param result: The result of the request, if it was executed.
+        """
+
+        if request.type is BrokerRequestType.WRITE_BYTES:
+            self.invalidate(request.data.address, len(request.data.data))
+        elif request.type is BrokerRequestType.WRITE_MANY:
+            for entry in request.data.entries:
+                self.invalidate(entry.address, len(entry.data))
+        elif request.type in (BrokerRequestType.CALL_FUNCTION, BrokerRequestType.CALL_ADDRESS):
+            if self._invalidate_on_call:
+                self.invalidate()
+        elif request.type is BrokerRequestType.ALLOCATE:
+            if isinstance(result, int):
+                # The memory may have been cached while it belonged to a previous allocation
+                self.invalidate(result, request.data.size)
+        elif request.type is BrokerRequestType.FREE:
+            size = self._allocation_sizes.get(request.data.address)
+            if size is not None:
+                self.invalidate(request.data.address, size)
+            else:
+                # Not allocated through this broker, so how much memory was freed is unknown
+                self.invalidate()
+        elif request.type is BrokerRequestType.BATCH:
+            for inner_request in request.data.requests:
+                self._invalidate_affected(inner_request)
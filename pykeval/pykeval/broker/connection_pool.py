@@ -0,0 +1,140 @@
+import logging
+import socket
+import threading
+import time
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class PooledConnection:
+    """
+    A TCP connection owned by a `ConnectionPool`.
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.socket = sock
+        self.last_used = time.monotonic()
+        self.use_count = 0
+
+    @property
+    def is_reused(self) -> bool:
+        return self.use_count > 1
+
+    def close(self):
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+
+
+class ConnectionPool:
+    """
+    A bounded pool of long-lived TCP connections to a single server.
+    Connections that were idle for too long are discarded instead of being reused, since the server may have already
+    closed them.
+    """
+
+    def __init__(self,
+                 address: str,
+                 port: int,
+                 max_connections: int = 4,
+                 idle_timeout: Optional[float] = 60,
+                 connect_timeout: Optional[float] = None,
+                 on_connect: Optional[Callable[[socket.socket], None]] = None):
+        """
+        :param address: The address of the server
+        :param port: The port of the server
+        :param max_connections: The maximum number of connections that may be open at the same time. Callers block
+                                until a connection is available.
+        :param idle_timeout: The amount of seconds after which an unused connection is closed. None to never close
+                             idle connections. This should be shorter than the server's idle timeout.
+        :param connect_timeout: The timeout in seconds for establishing a new connection. None to block.
+        :param on_connect: Called with the socket of every new connection before it is used, e.g. for a handshake.
+        """
+
+        if max_connections < 1:
+            raise ValueError(f"A pool must allow at least one connection (got {max_connections})")
+
+        self.address = address
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.on_connect = on_connect
+
+        self._idle = []  # type: List[PooledConnection]
+        self._lock = threading.Lock()
+        self._available = threading.BoundedSemaphore(max_connections)
+
+    def acquire(self) -> PooledConnection:
+        """
+        Takes a connection from the pool, opening a new one if no idle connection is available.
+        The connection must be given back with `release()`.
+        """
+
+        self._available.acquire()
+        try:
+            connection = self._pop_idle() or self._connect()
+        except BaseException:
+            self._available.release()
+            raise
+
+        connection.use_count += 1
+        return connection
+
+    def release(self, connection: PooledConnection, reusable: bool = True):
+        """
+        Gives a connection back to the pool.
+
+        :param connection: A connection from `acquire()`.
+        :param reusable: False if the connection is in an unknown state and should be closed.
+        """
+
+        try:
+            if reusable:
+                connection.last_used = time.monotonic()
+                with self._lock:
+                    self._idle.append(connection)
+            else:
+                connection.close()
+        finally:
+            self._available.release()
+
+    def close(self):
+        """
+        Closes all idle connections. The pool may still be used afterwards, new connections are opened as needed.
+        """
+
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for connection in idle:
+            connection.close()
+
+    def _pop_idle(self) -> Optional[PooledConnection]:
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                # Most recently used first, it is the least likely to have been closed by the server.
+                connection = self._idle.pop()
+                if self.idle_timeout is None or now - connection.last_used < self.idle_timeout:
+                    return connection
+
+                logger.debug(f"Discarding connection that was idle for {now - connection.last_used:.1f} seconds")
+                connection.close()
+
+        return None
+
+    def _connect(self) -> PooledConnection:
+        logger.debug(f"Connecting with {self.address}:{self.port}")
+        sock = socket.create_connection((self.address, self.port), timeout=self.connect_timeout)
+        try:
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.on_connect is not None:
+                self.on_connect(sock)
+        except BaseException:
+            sock.close()
+            raise
+
+        return PooledConnection(sock)
@@ -1,14 +1,106 @@
 from abc import ABC, abstractmethod
+from functools import wraps
+from typing import Callable, List
 
-from pykeval.broker.requests import CallFunction, ReadBytes, WriteBytes, Allocate, Free
+from pykeval.broker.read_until import read_until_steps
+from pykeval.broker.requests import (CallFunction, ResolveRoutine, CallAddress, ReadBytes, ReadUntil, WriteBytes,
+                                     ReadMany, WriteMany, Allocate, Free, Batch, BrokerRequest, BrokerRequestType)
+from pykeval.shared.tracing import Span, get_tracer, start_span
+
+# The attributes of the span of each type of request
+_REQUEST_SPAN_ATTRIBUTES = {
+    BrokerRequestType.GET_POINTER_SIZE: lambda data: {},
+    BrokerRequestType.CALL_FUNCTION: lambda data: {"function": f"{data.module_name}!{data.function_name}",
+                                                   "argument_count": len(data.arguments)},
+    BrokerRequestType.RESOLVE_ROUTINE: lambda data: {"function": f"{data.module_name}!{data.function_name}"},
+    BrokerRequestType.CALL_ADDRESS: lambda data: {"address": data.address, "argument_count": len(data.arguments)},
+    BrokerRequestType.READ_BYTES: lambda data: {"address": data.address, "size": data.size},
+    BrokerRequestType.READ_UNTIL: lambda data: {"address": data.address, "max_size": data.max_size},
+    BrokerRequestType.WRITE_BYTES: lambda data: {"address": data.address, "size": len(data.data)},
+    BrokerRequestType.READ_MANY: lambda data: {"count": len(data.entries),
+                                               "size": sum(entry.size for entry in data.entries)},
+    BrokerRequestType.WRITE_MANY: lambda data: {"count": len(data.entries),
+                                                "size": sum(len(entry.data) for entry in data.entries)},
+    BrokerRequestType.ALLOCATE: lambda data: {"size": data.size},
+    BrokerRequestType.FREE: lambda data: {"address": data.address},
+    BrokerRequestType.BATCH: lambda data: {"request_count": len(data.requests)},
+}
+
+# The methods of brokers that are traced, and the type of request each handles
+_TRACED_METHODS = {
+    "call_function": BrokerRequestType.CALL_FUNCTION,
+    "resolve_routine": BrokerRequestType.RESOLVE_ROUTINE,
+    "call_address": BrokerRequestType.CALL_ADDRESS,
+    "read_bytes": BrokerRequestType.READ_BYTES,
+    "read_into": BrokerRequestType.READ_BYTES,
+    "read_until": BrokerRequestType.READ_UNTIL,
+    "write_bytes": BrokerRequestType.WRITE_BYTES,
+    "read_many": BrokerRequestType.READ_MANY,
+    "write_many": BrokerRequestType.WRITE_MANY,
+    "allocate": BrokerRequestType.ALLOCATE,
+    "free": BrokerRequestType.FREE,
+    "execute_batch": BrokerRequestType.BATCH,
+}
+
+
+def raise_first_error(results: List[any]):
+    """
+    :param results: The results of `Broker.execute_batch()`.
+    :raises The first exception in the results, if there is one.
+    """
+
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+
+def start_request_span(broker, request_type: BrokerRequestType, request_data) -> Span:
+    """
+    :param broker: The broker that handles the request.
+    :return: The span of a request, named after its type (such as "broker.read_bytes").
+    """
+
+    return start_span(f"broker.{request_type.name.lower()}",
+                      broker=type(broker).__name__,
+                      **_REQUEST_SPAN_ATTRIBUTES[request_type](request_data))
+
+
+def _trace_method(method: Callable, request_type: BrokerRequestType) -> Callable:
+    @wraps(method)
+    def wrapper(self, request_data, *args, **kwargs):
+        if get_tracer() is None:
+            return method(self, request_data, *args, **kwargs)
+
+        span_data = Batch(request_data) if request_type is BrokerRequestType.BATCH else request_data
+        with start_request_span(self, request_type, span_data):
+            return method(self, request_data, *args, **kwargs)
+
+    wrapper._traced = True
+    return wrapper
 
 
 class Broker(ABC):
     """
     A broker is responsible for communicating with the driver on the target machine.
     It services the client (which may be on another machine).
+
+    The request methods of every broker start a span when a tracer is installed (see `pykeval.shared.tracing`).
     """
 
+    # Whether the broker's methods may be called from several threads at the same time. Servers serialize access to
+    # brokers that are not.
+    thread_safe = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        # Methods are wrapped on each implementation rather than on `Broker`, so an implementation that falls back to a
+        # default method with `super()` doesn't start a second span.
+        for name, request_type in _TRACED_METHODS.items():
+            method = getattr(cls, name)
+            if not getattr(method, "_traced", False):
+                setattr(cls, name, _trace_method(method, request_type))
+
     @abstractmethod
     def get_pointer_size(self) -> int:
         """
@@ -27,6 +119,27 @@ class Broker(ABC):
 
         pass
 
+    def resolve_routine(self, request_data: ResolveRoutine) -> int:
+        """
+        Finds the address of a kernel-mode function on the target machine, so it can be called with `call_address()`
+        without being looked up on every call.
+
+        :return: The address of the function.
+        :raises NotImplementedError if the broker can only call functions by name.
+        """
+
+        raise NotImplementedError(f"{type(self).__name__} does not support resolving routines")
+
+    def call_address(self, request_data: CallAddress) -> any:
+        """
+        Calls a kernel-mode function on the target machine by its address, as returned by `resolve_routine()`.
+
+        :return: The return value of the function.
+        :raises NotImplementedError if the broker can only call functions by name.
+        """
+
+        raise NotImplementedError(f"{type(self).__name__} does not support calling addresses")
+
     @abstractmethod
     def read_bytes(self, request_data: ReadBytes) -> bytes:
         """
@@ -36,6 +149,34 @@ class Broker(ABC):
         """
         pass
 
+    def read_into(self, request_data: ReadBytes, buffer):
+        """
+        Reads kernel-mode memory from the target machine into a writable buffer. Brokers should override this to read
+        straight into the buffer, without the intermediate `bytes` object of `read_bytes()`.
+
+        :param buffer: Any writable object that supports the buffer protocol, of at least `request_data.size` bytes.
+        """
+
+        data = self.read_bytes(request_data)
+        memoryview(buffer).cast("B")[:len(data)] = data
+
+    def read_until(self, request_data: ReadUntil) -> bytes:
+        """
+        Reads memory from the target machine up to a terminator. See `ReadUntil`.
+        The memory is read in chunks that never cross a page boundary, so nothing is read from a page the data does not
+        reach. Brokers that talk to the driver over a slow channel should override this to read next to the target.
+
+        :return: The data before the terminator, or `max_size` bytes if no terminator was found.
+        """
+
+        steps = read_until_steps(request_data)
+        data = None
+        try:
+            while True:
+                data = self.read_bytes(steps.send(data))
+        except StopIteration as e:
+            return e.value
+
     @abstractmethod
     def write_bytes(self, request_data: WriteBytes):
         """
@@ -45,6 +186,27 @@ class Broker(ABC):
 
         pass
 
+    def read_many(self, request_data: ReadMany) -> List[any]:
+        """
+        Reads many separate ranges of memory. Brokers that talk to the driver over a slow channel should override this
+        to read all ranges in one go.
+
+        :return: For each range, in order, either its data or the exception reading it raised.
+        """
+
+        return self.execute_batch([BrokerRequest(BrokerRequestType.READ_BYTES, entry) for entry in request_data.entries])
+
+    def write_many(self, request_data: WriteMany) -> List[any]:
+        """
+        Writes to many separate ranges of memory. Brokers that talk to the driver over a slow channel should override
+        this to write all ranges in one go.
+
+        :return: For each write, in order, either None or the exception it raised.
+        """
+
+        return self.execute_batch([BrokerRequest(BrokerRequestType.WRITE_BYTES, entry)
+                                   for entry in request_data.entries])
+
     @abstractmethod
     def allocate(self, request_data: Allocate) -> int:
         """
@@ -63,3 +225,54 @@ class Broker(ABC):
         """
 
         pass
+
+    def execute(self, request: BrokerRequest) -> any:
+        """
+        Executes a single request by passing its data to the matching method.
+
+        :return: What the method returned.
+        :raises ValueError if the request type is not supported.
+        """
+
+        if request.type is BrokerRequestType.GET_POINTER_SIZE:
+            return self.get_pointer_size()
+
+        if request.type is BrokerRequestType.BATCH:
+            return self.execute_batch(request.data.requests)
+
+        handler = {
+            BrokerRequestType.CALL_FUNCTION: self.call_function,
+            BrokerRequestType.RESOLVE_ROUTINE: self.resolve_routine,
+            BrokerRequestType.CALL_ADDRESS: self.call_address,
+            BrokerRequestType.READ_BYTES: self.read_bytes,
+            BrokerRequestType.READ_UNTIL: self.read_until,
+            BrokerRequestType.WRITE_BYTES: self.write_bytes,
+            BrokerRequestType.READ_MANY: self.read_many,
+            BrokerRequestType.WRITE_MANY: self.write_many,
+            BrokerRequestType.ALLOCATE: self.allocate,
+            BrokerRequestType.FREE: self.free
+        }.get(request.type)
+
+        if handler is None:
+            raise ValueError(f"Unrecognized request type {request.type.value}")
+
+        return handler(request.data)
+
+    def execute_batch(self, requests: List[BrokerRequest]) -> List[any]:
+        """
+        Executes independent requests in order. A failing request does not stop the ones after it.
+        Brokers that talk to the driver over a slow channel should override this to execute all requests in one go.
+
+        :return: For each request, either its result or the exception it raised.
+        """
+
+        results = []
+        for request in requests:
+            try:
+                if request.type is BrokerRequestType.BATCH:
+                    raise ValueError("Batches may not be nested")
+                results.append(self.execute(request))
+            except Exception as e:
+                results.append(e)
+
+        return results
@@ -24,7 +24,6 @@
 
 import ctypes
 import ctypes.wintypes as wintypes
-from ctypes import windll
 
 LPDWORD = ctypes.POINTER(wintypes.DWORD)
 LPOVERLAPPED = wintypes.LPVOID
@@ -58,7 +57,7 @@ def _CreateFile(filename, access, mode, creation, flags):
     """See: CreateFile function
     http://msdn.microsoft.com/en-us/library/windows/desktop/aa363858(v=vs.85).aspx
     """
-    CreateFile_Fn = windll.kernel32.CreateFileW
+    CreateFile_Fn = ctypes.windll.kernel32.CreateFileW
     CreateFile_Fn.argtypes = [
         wintypes.LPWSTR,  # _In_          LPCTSTR lpFileName
         wintypes.DWORD,  # _In_          DWORD dwDesiredAccess
@@ -82,7 +81,7 @@ def _DeviceIoControl(devhandle, ioctl, inbuf, inbufsiz, outbuf, outbufsiz):
     """See: DeviceIoControl function
     http://msdn.microsoft.com/en-us/library/aa363216(v=vs.85).aspx
     """
-    DeviceIoControl_Fn = windll.kernel32.DeviceIoControl
+    DeviceIoControl_Fn = ctypes.windll.kernel32.DeviceIoControl
     DeviceIoControl_Fn.argtypes = [
         wintypes.HANDLE,  # _In_          HANDLE hDevice
         wintypes.DWORD,  # _In_          DWORD dwIoControlCode
@@ -121,7 +120,7 @@ class DeviceIoControl(object):
             raise Exception('No file handle')
         if self._fhandle.value == wintypes.HANDLE(INVALID_HANDLE_VALUE).value:
             raise Exception('Failed to open %s. GetLastError(): %d' %
-                            (self.path, windll.kernel32.GetLastError()))
+                            (self.path, ctypes.windll.kernel32.GetLastError()))
 
     def ioctl(self, ctl, inbuf, inbufsiz, outbuf, outbufsiz):
         self._validate_handle()
@@ -143,4 +142,4 @@ class DeviceIoControl(object):
         except Exception:
             pass
         else:
-            windll.kernel32.CloseHandle(self._fhandle)
+            ctypes.windll.kernel32.CloseHandle(self._fhandle)
@@ -1,13 +1,16 @@
 import ctypes
 import struct
+from dataclasses import dataclass
 from enum import Enum, auto
+from functools import lru_cache
 from io import BytesIO
+from typing import List, Tuple
 
 import pykeval.broker.requests as broker_requests
 from pykeval.broker.ioctl import METHOD_NEITHER, FILE_ANY_ACCESS
 from pykeval.broker.ioctl_serialize import (serialize_enum_value, serialize_string, serialize_enum_array,
                                             serialize_pointer, serialize_array, serialize_buffer_view)
-from pykeval.shared.ffi import FFI_TYPE_TO_CTYPES_TYPE_MAP
+from pykeval.shared.ffi import FfiType, FfiArgument, FFI_TYPE_TO_CTYPES_TYPE_MAP
 
 """
 Constants and definitions for communicating with the driver using IOCTL.
@@ -33,45 +36,143 @@ class IoctlRequestType(Enum):
     WRITE_BYTES = auto()
     ALLOCATE = auto()
     FREE = auto()
+    RESOLVE_ROUTINE = auto()
+    CALL_ADDRESS = auto()
+    READ_MANY = auto()
 
 
-class IoctlCallFunction:
+@dataclass
+class _IoctlCallSignature:
+    # The serialized request up to (not including) the return value and the arguments
+    header: bytes
+    ctypes_return_type: any
+    ctypes_argument_types: List[any]
+
+
+def _create_call_signature(header: bytes,
+                           return_type: FfiType,
+                           argument_types: Tuple[FfiType, ...]) -> _IoctlCallSignature:
+    return _IoctlCallSignature(header=header,
+                               ctypes_return_type=FFI_TYPE_TO_CTYPES_TYPE_MAP[return_type] or ctypes.c_void_p,
+                               ctypes_argument_types=[FFI_TYPE_TO_CTYPES_TYPE_MAP[argument_type]
+                                                      for argument_type in argument_types])
+
+
+@lru_cache(maxsize=1024)
+def _get_call_signature(module_name: str,
+                        function_name: str,
+                        return_type: FfiType,
+                        argument_types: Tuple[FfiType, ...]) -> _IoctlCallSignature:
+    """
+    Functions are usually called many times, so their signatures are only serialized once.
+    """
+
+    buffer = BytesIO()
+
+    serialize_enum_value(buffer, IoctlRequestType.CALL_FUNCTION)
+    serialize_string(buffer, module_name)
+    serialize_string(buffer, function_name)
+    serialize_enum_value(buffer, return_type)
+    serialize_enum_array(buffer, argument_types)
+
+    return _create_call_signature(buffer.getvalue(), return_type, argument_types)
+
+
+@lru_cache(maxsize=1024)
+def _get_call_address_signature(address: int,
+                                return_type: FfiType,
+                                argument_types: Tuple[FfiType, ...]) -> _IoctlCallSignature:
+    """
+    Like `_get_call_signature()`, for functions that are called by their address.
+    """
+
+    buffer = BytesIO()
+
+    serialize_enum_value(buffer, IoctlRequestType.CALL_ADDRESS)
+    serialize_pointer(buffer, address)
+    serialize_enum_value(buffer, return_type)
+    serialize_enum_array(buffer, argument_types)
+
+    return _create_call_signature(buffer.getvalue(), return_type, argument_types)
+
+
+class _IoctlCall:
+    """
+    The common part of calling a function by name and by address. The driver writes the return value directly to
+    `return_value`.
+    """
+
+    def __init__(self, signature: _IoctlCallSignature, arguments: List[FfiArgument]):
+        self._signature = signature
+
+        self.return_value = self._signature.ctypes_return_type()
+        self.arguments = [ctypes_type(python_arg.value)
+                          for ctypes_type, python_arg in zip(self._signature.ctypes_argument_types, arguments)]
+
+    def serialize(self):
+        buffer = BytesIO()
+
+        buffer.write(self._signature.header)
+        serialize_pointer(buffer, ctypes.addressof(self.return_value))
+        serialize_array(buffer, [ctypes.addressof(arg) for arg in self.arguments], "P")
+
+        buffer.seek(0)
+        return bytes(buffer.read())
+
+
+class IoctlCallFunction(_IoctlCall):
     def __init__(self, request: broker_requests.CallFunction):
         self.module_name = request.module_name
         self.function_name = request.function_name
 
         self.ffi_return_type = request.return_type
-        ctypes_return_type = FFI_TYPE_TO_CTYPES_TYPE_MAP[self.ffi_return_type]
-        if ctypes_return_type is None:
-            self.return_value = ctypes.c_void_p(0)
-        else:
-            self.return_value = ctypes_return_type()
+        self.ffi_argument_types = tuple(arg.type for arg in request.arguments)
+        super().__init__(_get_call_signature(self.module_name,
+                                             self.function_name,
+                                             self.ffi_return_type,
+                                             self.ffi_argument_types),
+                         request.arguments)
+
 
-        self.ffi_argument_types = [arg.type for arg in request.arguments]
-        self.arguments = []
-        for python_arg in request.arguments:
-            ctypes_arg = FFI_TYPE_TO_CTYPES_TYPE_MAP[python_arg.type](python_arg.value)
-            self.arguments.append(ctypes_arg)
+class IoctlCallAddress(_IoctlCall):
+    def __init__(self, request: broker_requests.CallAddress):
+        self.address = request.address
+
+        self.ffi_return_type = request.return_type
+        self.ffi_argument_types = tuple(arg.type for arg in request.arguments)
+        super().__init__(_get_call_address_signature(self.address, self.ffi_return_type, self.ffi_argument_types),
+                         request.arguments)
+
+
+class IoctlResolveRoutine:
+    def __init__(self, request: broker_requests.ResolveRoutine):
+        self.module_name = request.module_name
+        self.function_name = request.function_name
+        self.result = ctypes.c_void_p(0)
 
     def serialize(self):
         buffer = BytesIO()
 
-        serialize_enum_value(buffer, IoctlRequestType.CALL_FUNCTION)
+        serialize_enum_value(buffer, IoctlRequestType.RESOLVE_ROUTINE)
         serialize_string(buffer, self.module_name)
         serialize_string(buffer, self.function_name)
-        serialize_enum_value(buffer, self.ffi_return_type)
-        serialize_enum_array(buffer, self.ffi_argument_types)
-        serialize_pointer(buffer, ctypes.addressof(self.return_value))
-        serialize_array(buffer, [ctypes.addressof(arg) for arg in self.arguments], "P")
+        serialize_pointer(buffer, ctypes.addressof(self.result))
 
         buffer.seek(0)
         return bytes(buffer.read())
 
 
 class IoctlReadBytes:
-    def __init__(self, request: broker_requests.ReadBytes):
+    def __init__(self, request: broker_requests.ReadBytes, buffer=None):
+        """
+        :param buffer: A writable buffer for the driver to read into directly, or None to read into a new buffer.
+        """
+
         self.address = request.address
-        self.result_buffer = ctypes.create_string_buffer(request.size)
+        if buffer is None:
+            self.result_buffer = ctypes.create_string_buffer(request.size)
+        else:
+            self.result_buffer = (ctypes.c_char * request.size).from_buffer(memoryview(buffer).cast("B"))
 
     def serialize(self):
         buffer = BytesIO()
@@ -84,10 +185,50 @@ class IoctlReadBytes:
         return bytes(buffer.read())
 
 
+class IoctlReadMany:
+    def __init__(self, request: broker_requests.ReadMany):
+        self.addresses = [entry.address for entry in request.entries]
+        self.result_buffers = [ctypes.create_string_buffer(entry.size) for entry in request.entries]
+        # The NTSTATUS of reading each range
+        self.statuses = (ctypes.c_int32 * len(request.entries))()
+
+    def serialize(self):
+        buffer = BytesIO()
+
+        serialize_enum_value(buffer, IoctlRequestType.READ_MANY)
+        buffer.write(struct.pack("I", len(self.addresses)))
+        for address, result_buffer in zip(self.addresses, self.result_buffers):
+            serialize_pointer(buffer, address)
+            serialize_buffer_view(buffer, result_buffer)
+        serialize_pointer(buffer, ctypes.addressof(self.statuses))
+
+        buffer.seek(0)
+        return bytes(buffer.read())
+
+
+def _share_buffer(data) -> ctypes.Array:
+    """
+    :param data: Any object that supports the buffer protocol.
+    :return: A ctypes array over the memory of the data, which is only copied if it is neither `bytes` nor writable.
+             The data must be kept alive as long as the array is used.
+    """
+
+    view = memoryview(data).cast("B")
+    array_type = ctypes.c_char * len(view)
+    if isinstance(data, bytes):
+        # `bytes` are immutable, but the driver only reads the buffer of a write
+        return array_type.from_address(ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p).value)
+    if not view.readonly:
+        return array_type.from_buffer(view)
+    return array_type.from_buffer_copy(view)
+
+
 class IoctlWriteBytes:
     def __init__(self, request: broker_requests.WriteBytes):
         self.address = request.address
-        self.buffer = ctypes.create_string_buffer(request.data, len(request.data))
+        # Keeps the data alive, since the buffer may share its memory
+        self.data = request.data
+        self.buffer = _share_buffer(request.data)
 
     def serialize(self):
         buffer = BytesIO()
@@ -1,10 +1,14 @@
 import ctypes
+import threading
+from contextlib import contextmanager
+from typing import List
 
 from pykeval.broker.interface import Broker
 from pykeval.broker.ioctl import DeviceIoControl
 from pykeval.broker.ioctl_requests import IoctlCallFunction, IoctlReadBytes, IoctlWriteBytes, MESSAGE_IOCTL_CODE, \
-    IoctlAllocate, IoctlFree
-from pykeval.broker.requests import CallFunction, ReadBytes, WriteBytes, Allocate, Free
+    IoctlAllocate, IoctlFree, IoctlResolveRoutine, IoctlCallAddress, IoctlReadMany
+from pykeval.broker.requests import (CallFunction, ResolveRoutine, CallAddress, ReadBytes, WriteBytes, ReadMany,
+                                     Allocate, Free, BrokerRequest)
 
 
 class LocalBroker(Broker):
@@ -12,12 +16,16 @@ class LocalBroker(Broker):
     A broker that communicates using IOCTLs to the driver on the local machine.
     """
 
+    # Every request opens its own handle to the device (or uses the calling thread's batch handle).
+    thread_safe = True
+
     def __init__(self, device_name: str = "\\??\\keval"):
         """
         :param device_name: The name of the driver's device to which IOCTLs will be sent.
         """
 
         self.device_name = device_name
+        self._batch_state = threading.local()
 
     def get_pointer_size(self) -> int:
         return ctypes.sizeof(ctypes.c_void_p)
@@ -27,11 +35,48 @@ class LocalBroker(Broker):
         self._send_ioctl(ioctl_request)
         return ioctl_request.return_value.value
 
+    def resolve_routine(self, request_data: ResolveRoutine) -> int:
+        ioctl_request = IoctlResolveRoutine(request_data)
+        self._send_ioctl(ioctl_request)
+        return ioctl_request.result.value
+
+    def call_address(self, request_data: CallAddress) -> any:
+        ioctl_request = IoctlCallAddress(request_data)
+        self._send_ioctl(ioctl_request)
+        return ioctl_request.return_value.value
+
     def read_bytes(self, request_data: ReadBytes) -> bytes:
         ioctl_request = IoctlReadBytes(request_data)
         self._send_ioctl(ioctl_request)
         return ioctl_request.result_buffer.raw
 
+    def read_into(self, request_data: ReadBytes, buffer):
+        """
+        Has the driver write straight into the buffer.
+        """
+
+        self._send_ioctl(IoctlReadBytes(request_data, memoryview(buffer).cast("B")[:request_data.size]))
+
+    def read_many(self, request_data: ReadMany) -> List[any]:
+        """
+        Reads all ranges with a single IOCTL. The driver reports ranges that can't be read instead of crashing.
+        """
+
+        ioctl_request = IoctlReadMany(request_data)
+        self._send_ioctl(ioctl_request)
+
+        results = []
+        for entry, result_buffer, status in zip(request_data.entries,
+                                                ioctl_request.result_buffers,
+                                                ioctl_request.statuses):
+            if status < 0:
+                results.append(MemoryError(f"Failed to read {entry.size} bytes at {entry.address:#x} "
+                                           f"(NTSTATUS {status & 0xFFFFFFFF:#010x})"))
+            else:
+                results.append(result_buffer.raw)
+
+        return results
+
     def write_bytes(self, request_data: WriteBytes):
         ioctl_request = IoctlWriteBytes(request_data)
         self._send_ioctl(ioctl_request)
@@ -45,6 +90,32 @@ class LocalBroker(Broker):
         ioctl_request = IoctlFree(request_data)
         self._send_ioctl(ioctl_request)
 
+    def execute_batch(self, requests: List[BrokerRequest]) -> List[any]:
+        """
+        Executes all requests over a single handle to the device.
+        """
+
+        with DeviceIoControl(self.device_name) as device:
+            self._batch_state.device = device
+            try:
+                return super().execute_batch(requests)
+            finally:
+                self._batch_state.device = None
+
+    @contextmanager
+    def _open_device(self):
+        """
+        Opens the device, unless it is already open for the batch that is currently executing.
+        """
+
+        batch_device = getattr(self._batch_state, "device", None)
+        if batch_device is not None:
+            yield batch_device
+            return
+
+        with DeviceIoControl(self.device_name) as device:
+            yield device
+
     def _send_ioctl(self, request, output_buffer_size=0x100):
         """
         Sends a request to the device.
@@ -55,7 +126,8 @@ class LocalBroker(Broker):
 
         input_buffer = ctypes.create_string_buffer(python_buffer, len(python_buffer))
         output_buffer = ctypes.create_string_buffer(output_buffer_size)
-        with DeviceIoControl(self.device_name) as device:
+
+        with self._open_device() as device:
             success, bytes_returned = device.ioctl(MESSAGE_IOCTL_CODE,
                                                    input_buffer,
                                                    ctypes.sizeof(input_buffer),
@@ -1,10 +1,263 @@
 import struct
+import zlib
+from typing import List, Optional, Tuple
 
+from pykeval.broker.remote_protocol import Compression, ProtocolError
 
-def receive(sock) -> bytes:
-    request_length = struct.unpack(">I", sock.recv(4))[0]
-    return sock.recv(request_length)
+_LENGTH_FORMAT = ">I"
+# The size of the length prefix every message starts with
+LENGTH_PREFIX_SIZE = struct.calcsize(_LENGTH_FORMAT)
+# Messages (and parts of messages) smaller than this are copied into a single buffer, which is cheaper than gathering
+_GATHER_THRESHOLD = 64 * 1024
+# Well below the limit of buffers a single `sendmsg()` may gather on common systems
+_MAX_GATHERED_BUFFERS = 512
 
+# Set in the length prefix of a compressed message. A compressed message starts with its uncompressed size, followed by
+# the zlib stream of its data.
+_COMPRESSED_FLAG = 1 << 31
+_UNCOMPRESSED_SIZE = struct.Struct(">I")
+# The size of the largest message, compressed or not
+MAX_MESSAGE_SIZE = _COMPRESSED_FLAG - 1
+# Messages of at least twice this size are only compressed if a sample of this size from their bulk compresses well, so
+# incompressible data (such as encrypted memory) costs little to try
+_SAMPLE_SIZE = 0x10000
+_SAMPLE_MAX_RATIO = 0.9
 
-def send(sock, data: bytes):
-    sock.sendall(struct.pack(">I", len(data)) + data)
+
+class ConnectionClosedError(ConnectionError):
+    """
+    Raised when the peer closes the connection in the middle of (or before) a message.
+    """
+
+    def __init__(self, received: int, expected: int):
+        self.received = received
+        self.expected = expected
+
+    def __str__(self):
+        return f"Connection closed by peer after {self.received} out of {self.expected} bytes"
+
+
+def receive_exactly_into(sock, view: memoryview, received_so_far: int = 0):
+    """
+    Receives exactly enough bytes to fill the view, straight into its memory.
+
+    :param received_so_far: The number of bytes of the message that were already received, for reporting errors.
+    :raises ConnectionClosedError if the peer closed the connection before the view was filled.
+    """
+
+    offset = 0
+    while offset < len(view):
+        count = sock.recv_into(view[offset:])
+        if count == 0:
+            raise ConnectionClosedError(received_so_far + offset, received_so_far + len(view))
+        offset += count
+
+
+def _parse_length_prefix(prefix: bytes, compression: Optional[Compression], max_size: int) -> Tuple[int, bool]:
+    """
+    :raises ProtocolError if the message is larger than the maximal size, or compressed while compression wasn't agreed
+            on.
+    """
+
+    length, = struct.unpack(_LENGTH_FORMAT, prefix)
+    compressed = length & _COMPRESSED_FLAG != 0
+    size = length & ~_COMPRESSED_FLAG
+    if compressed and compression is None:
+        raise ProtocolError("Got a compressed message, but compression was not agreed on")
+    if size > max_size:
+        raise ProtocolError(f"Message of {size} bytes is larger than the limit of {max_size} bytes")
+    return size, compressed
+
+
+def _decompress(data: bytes, max_size: int) -> bytes:
+    """
+    :raises ProtocolError if the message is not a valid compressed message, or would be larger than the maximal size.
+    """
+
+    if len(data) < _UNCOMPRESSED_SIZE.size:
+        raise ProtocolError("Compressed message is truncated")
+
+    size, = _UNCOMPRESSED_SIZE.unpack_from(data)
+    # A size of 0 would not limit decompression at all, and empty messages are never compressed
+    if size == 0:
+        raise ProtocolError("Compressed message has an invalid size of 0 bytes")
+    if size > max_size:
+        raise ProtocolError(f"Compressed message of {size} bytes is larger than the limit of {max_size} bytes")
+
+    decompressor = zlib.decompressobj()
+    try:
+        # Never decompresses beyond the declared size, so a corrupt message can't exhaust memory
+        decompressed = decompressor.decompress(memoryview(data)[_UNCOMPRESSED_SIZE.size:], size)
+    except zlib.error as e:
+        raise ProtocolError(f"Compressed message is corrupt: {e}") from None
+
+    if len(decompressed) != size or not decompressor.eof:
+        raise ProtocolError(f"Compressed message does not match its size of {size} bytes")
+    return decompressed
+
+
+def _compress(parts: Tuple, size: int, compression: Compression) -> Optional[List]:
+    """
+    :return: The parts of the compressed message, or None if compressing doesn't make it smaller.
+    """
+
+    if size >= 2 * _SAMPLE_SIZE:
+        sample = memoryview(max(parts, key=len)).cast("B")[:_SAMPLE_SIZE]
+        if len(zlib.compress(sample, compression.level)) > len(sample) * _SAMPLE_MAX_RATIO:
+            return None
+
+    compressor = zlib.compressobj(compression.level)
+    compressed = [_UNCOMPRESSED_SIZE.pack(size)]
+    compressed.extend(compressor.compress(part) for part in parts)
+    compressed.append(compressor.flush())
+    if sum(len(part) for part in compressed) >= size:
+        return None
+    return compressed
+
+
+def receive_header(sock,
+                   compression: Optional[Compression] = None,
+                   max_size: int = MAX_MESSAGE_SIZE) -> Tuple[int, bool]:
+    """
+    Receives the length prefix of a message. The message itself should then be received with `receive_body()`, or
+    straight into a buffer with `receive_exactly_into()` if it isn't compressed.
+
+    :param compression: The compression that was agreed on with the peer, or None to reject compressed messages.
+    :param max_size: The size in bytes of the largest message to accept, as it is sent.
+    :return: The size of the message, and whether it is compressed.
+    """
+
+    prefix = bytearray(LENGTH_PREFIX_SIZE)
+    receive_exactly_into(sock, memoryview(prefix))
+    return _parse_length_prefix(prefix, compression, max_size)
+
+
+def receive_body(sock, size: int, compressed: bool, max_size: int = MAX_MESSAGE_SIZE) -> bytes:
+    """
+    Receives a message whose length prefix was received with `receive_header()`, and decompresses it if needed.
+
+    :param max_size: The size in bytes of the largest message to accept, once decompressed.
+    """
+
+    data = bytearray(size)
+    receive_exactly_into(sock, memoryview(data), LENGTH_PREFIX_SIZE)
+    return _decompress(data, max_size) if compressed else data
+
+
+def receive(sock, compression: Optional[Compression] = None, max_size: int = MAX_MESSAGE_SIZE) -> bytes:
+    """
+    Receives a single length-prefixed message.
+
+    :param compression: The compression that was agreed on with the peer, or None to reject compressed messages.
+    :param max_size: The size in bytes of the largest message to accept, both as it is sent and once decompressed.
+                     Checked before any memory is allocated for the message.
+    :raises ConnectionClosedError if the peer closed the connection before the whole message arrived. If the connection
+            was closed cleanly between messages, `received` is 0.
+    :raises ProtocolError if a message is too large, or a compressed message is corrupt or unexpected.
+    """
+
+    return receive_body(sock, *receive_header(sock, compression, max_size), max_size)
+
+
+def _coalesce(parts: Tuple) -> List:
+    """
+    Joins consecutive small parts, so only large parts are sent without being copied.
+    """
+
+    chunks = []
+    small_parts = []
+    for part in parts:
+        if len(part) < _GATHER_THRESHOLD:
+            small_parts.append(part)
+            continue
+
+        if len(small_parts) != 0:
+            chunks.append(b"".join(small_parts))
+            small_parts = []
+        chunks.append(part)
+
+    if len(small_parts) != 0:
+        chunks.append(b"".join(small_parts))
+
+    return chunks
+
+
+def _frame(parts: Tuple, compression: Optional[Compression]) -> Tuple[bytes, Tuple, int]:
+    """
+    :return: The length prefix of the message, its parts (compressed if worthwhile) and its size.
+    """
+
+    size = sum(len(part) for part in parts)
+    if size > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Message of {size} bytes is too large to send")
+
+    if compression is not None and size >= compression.threshold:
+        compressed = _compress(parts, size, compression)
+        if compressed is not None:
+            compressed_size = sum(len(part) for part in compressed)
+            return struct.pack(_LENGTH_FORMAT, compressed_size | _COMPRESSED_FLAG), tuple(compressed), compressed_size
+
+    return struct.pack(_LENGTH_FORMAT, size), parts, size
+
+
+def send(sock, *parts, compression: Optional[Compression] = None):
+    """
+    Sends a single length-prefixed message, made of the given parts (any bytes-like objects).
+    Small messages are joined and sent at once. The large parts of big messages are gathered from where they are with
+    `sendmsg()` where it is available, rather than being copied into a single buffer.
+
+    :param compression: How to compress the message, or None to send it as is. Only pass this if the peer agreed to
+                        compression.
+    """
+
+    header, parts, size = _frame(parts, compression)
+    if size < _GATHER_THRESHOLD:
+        sock.sendall(b"".join((header, *parts)))
+        return
+
+    chunks = [memoryview(chunk).cast("B") for chunk in _coalesce((header, *parts))]
+    if not hasattr(sock, "sendmsg"):
+        # Windows sockets can't gather, but sending the large parts one by one still saves copying them
+        for chunk in chunks:
+            sock.sendall(chunk)
+        return
+
+    while len(chunks) != 0:
+        sent = sock.sendmsg(chunks[:_MAX_GATHERED_BUFFERS])
+        while sent != 0:
+            if sent < len(chunks[0]):
+                chunks[0] = chunks[0][sent:]
+                break
+            sent -= len(chunks.pop(0))
+
+
+async def receive_async(reader, compression: Optional[Compression] = None, max_size: int = MAX_MESSAGE_SIZE) -> bytes:
+    """
+    `receive()` for an `asyncio.StreamReader`.
+    """
+
+    import asyncio  # Already imported by the caller, but too slow to import for synchronous clients
+
+    try:
+        request_length, compressed = _parse_length_prefix(await reader.readexactly(LENGTH_PREFIX_SIZE),
+                                                          compression,
+                                                          max_size)
+    except asyncio.IncompleteReadError as e:
+        raise ConnectionClosedError(len(e.partial), LENGTH_PREFIX_SIZE) from None
+
+    try:
+        data = await reader.readexactly(request_length)
+    except asyncio.IncompleteReadError as e:
+        raise ConnectionClosedError(LENGTH_PREFIX_SIZE + len(e.partial), LENGTH_PREFIX_SIZE + request_length) from None
+
+    return _decompress(data, max_size) if compressed else data
+
+
+def send_buffered(writer, *parts, compression: Optional[Compression] = None):
+    """
+    `send()` for an `asyncio.StreamWriter`. The message is buffered as a whole, so messages written by different
+    coroutines never interleave. Await `writer.drain()` to wait for the buffer to flush.
+    """
+
+    header, parts, _ = _frame(parts, compression)
+    writer.writelines((header, *parts))
@@ -0,0 +1,57 @@
+from typing import Generator
+
+from pykeval.broker.requests import ReadBytes, ReadUntil
+
+"""
+Reading memory up to a terminator in chunks, for brokers that can only read a known number of bytes.
+
+The first chunk is small since most strings are short, and each following chunk is twice as large. A chunk never
+crosses a page boundary: the first byte of every chunk is known to belong to the data (the terminator was not found
+yet), so its page is mapped, but the next page might not be.
+"""
+
+PAGE_SIZE = 0x1000
+INITIAL_CHUNK_SIZE = 0x100
+
+
+def _find_aligned(data: bytearray, terminator: bytes, start: int) -> int:
+    """
+    :return: The first offset from `start` (which must be aligned) that is a multiple of the terminator's size and
+             holds the terminator, or -1.
+    """
+
+    index = data.find(terminator, start)
+    while index != -1 and index % len(terminator) != 0:
+        index = data.find(terminator, index + 1)
+
+    return index
+
+
+def read_until_steps(request_data: ReadUntil) -> Generator[ReadBytes, bytes, bytes]:
+    """
+    A generator that yields the reads to make and is sent back the data of each one. See `Broker.read_until()`.
+
+    :return: The data before the terminator, or `max_size` bytes if no terminator was found.
+    """
+
+    terminator = request_data.terminator
+    if len(terminator) == 0:
+        raise ValueError("The terminator may not be empty")
+
+    data = bytearray()
+    searched = 0  # Terminators can't start before this offset
+    address = request_data.address
+    chunk_size = INITIAL_CHUNK_SIZE
+    while len(data) < request_data.max_size:
+        size = min(chunk_size, PAGE_SIZE - address % PAGE_SIZE, request_data.max_size - len(data))
+        data += yield ReadBytes(address, size)
+        address += size
+
+        index = _find_aligned(data, terminator, searched)
+        if index != -1:
+            return bytes(data[:index])
+
+        searched = len(data) - len(data) % len(terminator)
+        chunk_size = min(chunk_size * 2, PAGE_SIZE)
+
+    return bytes(data)
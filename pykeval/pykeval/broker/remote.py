@@ -1,11 +1,19 @@
+import itertools
 import logging
-import pickle
 import socket
-from functools import lru_cache
+from typing import Callable, List, Optional
 
+from pykeval.broker.connection_pool import ConnectionPool
 from pykeval.broker.interface import Broker
-from pykeval.broker.requests import BrokerResponse, BrokerResponseType, BrokerRequest, BrokerRequestType
-from pykeval.broker.messaging import send, receive
+from pykeval.broker.remote_protocol import (ServerHello, ProtocolError, Capability, Compression,
+                                            DEFAULT_COMPRESSION_THRESHOLD, create_client_hello, encode_client_hello,
+                                            decode_server_hello, check_server_hello, get_required_capabilities,
+                                            encode_request_parts, decode_response, decode_bytes_response_prefix,
+                                            BYTES_RESPONSE_PREFIX_SIZE)
+from pykeval.broker.requests import (BrokerResponseType, BrokerRequest, BrokerRequestType, Batch, ReadUntil,
+                                     ResolveRoutine, CallAddress, ReadBytes, ReadMany, WriteMany)
+from pykeval.broker.messaging import (send, receive, receive_header, receive_body, receive_exactly_into,
+                                      LENGTH_PREFIX_SIZE, ConnectionClosedError)
 
 logger = logging.getLogger(__name__)
 
@@ -23,20 +31,53 @@ class RemoteBroker(Broker):
     """
     A proxy to a broker server over TCP. This is useful when you want the actual broker to be on another machine.
     See `RemoteBrokerServer`
+
+    Connections to the server are kept open and reused between requests.
     """
 
-    def __init__(self, address: str, port: int = DEFAULT_SERVER_PORT):
+    # Concurrent requests are sent over separate connections from the pool
+    thread_safe = True
+
+    def __init__(self,
+                 address: str,
+                 port: int = DEFAULT_SERVER_PORT,
+                 max_connections: int = 4,
+                 idle_timeout: Optional[float] = 60,
+                 connect_timeout: Optional[float] = None,
+                 compression_level: Optional[int] = None,
+                 compression_threshold: int = DEFAULT_COMPRESSION_THRESHOLD):
         """
         :param address: The address of the broker server
         :param port: The port of the broker server
+        :param max_connections: The maximum number of connections to keep with the server at the same time.
+        :param idle_timeout: The amount of seconds after which an unused connection is closed.
+                             This should be shorter than the server's idle timeout.
+        :param connect_timeout: The timeout in seconds for establishing a new connection. None to block.
+        :param compression_level: The zlib level (1-9) to compress messages with in both directions, if the server
+                                  supports it. None not to compress, which is best unless the link is slow: compressing
+                                  runs at tens of MB/s.
+        :param compression_threshold: The size in bytes from which messages are compressed.
         """
 
+        if compression_level is not None and not 1 <= compression_level <= 9:
+            raise ValueError(f"Compression level must be between 1 and 9 (got {compression_level})")
+
         self.server_address = address
         self.server_port = port
+        self._requested_compression = (Compression(compression_level, compression_threshold)
+                                       if compression_level is not None else None)
+        # The compression agreed on with the server, if any
+        self._compression = None  # type: Optional[Compression]
+        self._server_hello = None  # type: Optional[ServerHello]
+        self._request_ids = itertools.count(1)
+        self._pool = ConnectionPool(address, port, max_connections, idle_timeout, connect_timeout,
+                                    on_connect=self._handshake)
 
-    @lru_cache
     def get_pointer_size(self) -> int:
-        return _wrap_and_send(BrokerRequestType.GET_POINTER_SIZE)(self)
+        if self._server_hello is None:
+            # The pointer size is sent by the server when connecting.
+            self._pool.release(self._pool.acquire())
+        return self._server_hello.pointer_size
 
     call_function = _wrap_and_send(BrokerRequestType.CALL_FUNCTION)
     read_bytes = _wrap_and_send(BrokerRequestType.READ_BYTES)
@@ -44,31 +85,203 @@ class RemoteBroker(Broker):
     allocate = _wrap_and_send(BrokerRequestType.ALLOCATE)
     free = _wrap_and_send(BrokerRequestType.FREE)
 
+    def read_into(self, request_data: ReadBytes, buffer):
+        """
+        Receives the data of the read straight into the buffer, rather than into a message that is decoded and copied.
+        """
+
+        view = memoryview(buffer).cast("B")
+        if view.readonly:
+            raise TypeError("Cannot read into a read-only buffer")
+        if len(view) < request_data.size:
+            raise ValueError(f"Buffer of {len(view)} bytes is too small to read {request_data.size} bytes into")
+
+        request_id = next(self._request_ids) & 0xFFFFFFFF
+
+        def receive_response(sock: socket.socket):
+            message_size, compressed = receive_header(sock, self._compression)
+            if compressed:
+                # Decompressed as a whole, and copied into the buffer
+                return receive_body(sock, message_size, compressed)
+
+            prefix = bytearray(min(message_size, BYTES_RESPONSE_PREFIX_SIZE))
+            receive_exactly_into(sock, memoryview(prefix), LENGTH_PREFIX_SIZE)
+            data_size = message_size - len(prefix)
+            if decode_bytes_response_prefix(prefix) == (request_id, data_size) and data_size <= len(view):
+                receive_exactly_into(sock, view[:data_size], LENGTH_PREFIX_SIZE + len(prefix))
+                return None
+
+            # An exception, or a response that doesn't fit. It is decoded as usual to raise the right error.
+            rest = bytearray(data_size)
+            receive_exactly_into(sock, memoryview(rest), LENGTH_PREFIX_SIZE + len(prefix))
+            return prefix + rest
+
+        serialized_response = self._communicate(
+            encode_request_parts(request_id, BrokerRequest(BrokerRequestType.READ_BYTES, request_data)),
+            receive_response)
+        if serialized_response is not None:
+            data = self._unpack_response(request_id, serialized_response)
+            view[:len(data)] = data
+
+    def read_until(self, request_data: ReadUntil) -> bytes:
+        """
+        Reads next to the target, or in chunks over the network if the server does not support it.
+        """
+
+        if not self._server_supports(Capability.READ_UNTIL):
+            return super().read_until(request_data)
+
+        return self._send_request(BrokerRequest(BrokerRequestType.READ_UNTIL, request_data))
+
+    def read_many(self, request_data: ReadMany) -> List[any]:
+        """
+        Reads all ranges in a single request, or in a batch of reads if the server does not support it.
+        """
+
+        if not self._server_supports(Capability.MANY):
+            return super().read_many(request_data)
+
+        return self._send_request(BrokerRequest(BrokerRequestType.READ_MANY, request_data))
+
+    def write_many(self, request_data: WriteMany) -> List[any]:
+        """
+        Writes all ranges in a single request, or in a batch of writes if the server does not support it.
+        """
+
+        if not self._server_supports(Capability.MANY):
+            return super().write_many(request_data)
+
+        return self._send_request(BrokerRequest(BrokerRequestType.WRITE_MANY, request_data))
+
+    def resolve_routine(self, request_data: ResolveRoutine) -> int:
+        """
+        See `Broker.resolve_routine()`.
+
+        :raises NotImplementedError if the server does not support it.
+        """
+
+        self._ensure_server_supports(Capability.ROUTINES, "resolving routines")
+        return self._send_request(BrokerRequest(BrokerRequestType.RESOLVE_ROUTINE, request_data))
+
+    def call_address(self, request_data: CallAddress) -> any:
+        """
+        See `Broker.call_address()`.
+
+        :raises NotImplementedError if the server does not support it.
+        """
+
+        self._ensure_server_supports(Capability.ROUTINES, "calling addresses")
+        return self._send_request(BrokerRequest(BrokerRequestType.CALL_ADDRESS, request_data))
+
+    def execute_batch(self, requests: List[BrokerRequest]) -> List[any]:
+        """
+        Sends all requests to the server in a single message.
+        """
+
+        if len(requests) == 0:
+            return []
+
+        if not self._server_supports(Capability.BATCH | get_required_capabilities(requests)):
+            return super().execute_batch(requests)
+
+        return self._send_request(BrokerRequest(BrokerRequestType.BATCH, Batch(requests)))
+
+    def close(self):
+        """
+        Closes all idle connections to the server.
+        """
+
+        self._pool.close()
+
+    def _server_supports(self, capabilities: Capability) -> bool:
+        self.get_pointer_size()  # Makes sure the capabilities of the server are known
+        return self._server_hello.capabilities & capabilities == capabilities
+
+    def _ensure_server_supports(self, capabilities: Capability, feature: str):
+        if not self._server_supports(capabilities):
+            raise NotImplementedError(f"The server does not support {feature}")
+
+    def _handshake(self, sock: socket.socket):
+        """
+        Agrees on the protocol with the server over a new connection.
+
+        :raises ProtocolError if the server does not support this client.
+        """
+
+        send(sock, encode_client_hello(create_client_hello(self._requested_compression)))
+        server_hello = decode_server_hello(receive(sock))
+        check_server_hello(server_hello)
+        logger.debug(f"Connected to server with {server_hello}")
+        self._server_hello = server_hello
+        if server_hello.capabilities & Capability.COMPRESSION:
+            self._compression = self._requested_compression
+
     def _send_request(self, request: BrokerRequest) -> any:
         """
         Sends a request to the remote broker server and returns its response.
 
-        :raises ValueError if the response from the broker couldn't be interpreted.
+        :raises ProtocolError if the response from the broker couldn't be interpreted.
         """
 
-        data = pickle.dumps(request)
-        serialized_response = self._communicate(data)
-        response = pickle.loads(serialized_response)  # type: BrokerResponse
+        request_id = next(self._request_ids) & 0xFFFFFFFF
+        return self._unpack_response(request_id, self._communicate(encode_request_parts(request_id, request)))
+
+    @staticmethod
+    def _unpack_response(request_id: int, serialized_response: bytes) -> any:
+        response_id, response = decode_response(serialized_response)
+        if response_id != request_id:
+            raise ProtocolError(f"Got response to request {response_id} while waiting for request {request_id}",
+                                response_id)
 
         if response.type is BrokerResponseType.EXCEPTION:
             raise response.data  # Exception was raised on the remote broker. Try viewing its logs for more info.
-        elif response.type is BrokerResponseType.SUCCESS:
-            return response.data
-        raise ValueError(f"Got unknown response type from remote broker: {response.type}")
+        return response.data
 
-    def _communicate(self, data: bytes) -> bytes:
+    def _communicate(self,
+                     parts: tuple,
+                     receive_response: Optional[Callable[[socket.socket], any]] = None) -> any:
         """
-        Sends data to the server and returns its response.
+        Sends a message to the server and returns its response.
+
+        If a reused connection turns out to be closed by the server before it took the message, the message is sent
+        again over a new connection. That is the case when sending fails, or when the server closes the connection cleanly
+        without responding: the server only closes connections between requests, after answering every request it read.
+        A connection that fails in any other way once the message was sent is not retried, since the server may have
+        handled the request already.
+
+        :param parts: The parts of the message.
+        :param receive_response: Receives the response from the socket and returns it. By default, receives a message.
         """
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            logger.debug(f"Connecting with f{self.server_address}:{self.server_port}")
-            sock.connect((self.server_address, self.server_port))
-            send(sock, data)
-            logger.debug(f"Waiting for response")
-            return receive(sock)
+        while True:
+            connection = self._pool.acquire()
+            try:
+                try:
+                    send(connection.socket, *parts, compression=self._compression)
+                except (ConnectionResetError, BrokenPipeError) as e:
+                    # The message was not sent whole, so the server could not have handled it
+                    if not connection.is_reused:
+                        raise
+                    self._pool.release(connection, reusable=False)
+                    logger.debug(f"Reused connection was closed by the server ({e}), reconnecting")
+                    continue
+
+                logger.debug(f"Waiting for response")
+                try:
+                    if receive_response is None:
+                        # The compression is only known once connected
+                        response = receive(connection.socket, self._compression)
+                    else:
+                        response = receive_response(connection.socket)
+                except ConnectionClosedError as e:
+                    if not (connection.is_reused and e.received == 0):
+                        raise
+                    self._pool.release(connection, reusable=False)
+                    logger.debug(f"Reused connection was closed by the server ({e}), reconnecting")
+                    continue
+            except BaseException:
+                self._pool.release(connection, reusable=False)
+                raise
+
+            self._pool.release(connection)
+            return response
@@ -0,0 +1,634 @@
+import builtins
+import struct
+from dataclasses import dataclass
+from enum import IntFlag
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+from pykeval.broker.requests import (BrokerRequest, BrokerRequestType, BrokerResponse, BrokerResponseType,
+                                     CallFunction, ResolveRoutine, CallAddress, ReadBytes, ReadUntil, WriteBytes,
+                                     ReadMany, WriteMany, Allocate, Free, Batch)
+from pykeval.shared.ffi import FfiType, FfiArgument
+
+"""
+The binary protocol spoken between `RemoteBroker` and `RemoteBrokerServer`.
+
+Every connection starts with a handshake: the client sends a hello with its protocol version and capabilities, and the
+server answers with the agreed version, the capabilities both sides support and the pointer size of the target.
+After that, each message (framed by `messaging`) is a request or a response:
+
+    request:  u8 request type | u32 request id | body (by request type)
+    response: u8 response type | u32 request id | value or exception
+
+All integers are little-endian. Bulk data is sent as raw length-prefixed bytes.
+"""
+
+PROTOCOL_MAGIC = b"KEVL"
+PROTOCOL_VERSION = 1
+
+
+class Capability(IntFlag):
+    """
+    Optional protocol features. Both sides must support a feature for it to be used.
+    """
+
+    NONE = 0
+    BATCH = 1 << 0
+    READ_UNTIL = 1 << 1
+    # Resolving routines and calling them by address
+    ROUTINES = 1 << 2
+    # Reading and writing many ranges of memory in one request
+    MANY = 1 << 3
+    # Compressing large messages (see `messaging.Compression`). The client's hello carries how to compress them.
+    COMPRESSION = 1 << 4
+
+
+SUPPORTED_CAPABILITIES = (Capability.BATCH | Capability.READ_UNTIL | Capability.ROUTINES | Capability.MANY |
+                          Capability.COMPRESSION)
+
+# Request types that older servers may not know
+_REQUEST_CAPABILITIES = {
+    BrokerRequestType.BATCH: Capability.BATCH,
+    BrokerRequestType.READ_UNTIL: Capability.READ_UNTIL,
+    BrokerRequestType.RESOLVE_ROUTINE: Capability.ROUTINES,
+    BrokerRequestType.CALL_ADDRESS: Capability.ROUTINES,
+    BrokerRequestType.READ_MANY: Capability.MANY,
+    BrokerRequestType.WRITE_MANY: Capability.MANY,
+}
+
+
+class ProtocolError(Exception):
+    def __init__(self, reason: str, request_id: Optional[int] = None):
+        """
+        :param reason: What is wrong with the message.
+        :param request_id: The ID of the malformed request or response, if it could be read.
+        """
+
+        self.reason = reason
+        self.request_id = request_id
+
+    def __str__(self):
+        return self.reason
+
+
+class RemoteBrokerError(Exception):
+    """
+    An exception raised on the remote broker that has no local equivalent.
+    """
+
+    def __init__(self, type_name: str, message: str):
+        self.type_name = type_name
+        self.message = message
+
+    def __str__(self):
+        return f"{self.type_name}: {self.message}"
+
+
+DEFAULT_COMPRESSION_LEVEL = 1
+DEFAULT_COMPRESSION_THRESHOLD = 0x1000
+
+
+@dataclass
+class Compression:
+    """
+    How to compress the messages that are sent over a connection on which both sides agreed to compression. The client
+    decides, and the server compresses its responses the same way.
+    Messages smaller than the threshold, and messages that don't get smaller, are sent as they are.
+    """
+
+    # The zlib level, from 1 (fastest) to 9 (smallest)
+    level: int = DEFAULT_COMPRESSION_LEVEL
+    threshold: int = DEFAULT_COMPRESSION_THRESHOLD
+
+
+@dataclass
+class ClientHello:
+    version: int
+    capabilities: Capability
+    # How the client wants messages compressed, sent only if it supports `Capability.COMPRESSION`
+    compression: Optional[Compression] = None
+
+
+@dataclass
+class ServerHello:
+    version: int
+    capabilities: Capability
+    pointer_size: int
+
+
+_HELLO = struct.Struct("<4sHI")
+_SERVER_HELLO = struct.Struct("<4sHIB")
+# The level and threshold of compression, in the client's hello
+_COMPRESSION_PARAMETERS = struct.Struct("<BI")
+_HEADER = struct.Struct("<BI")
+_U8 = struct.Struct("<B")
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_U64 = struct.Struct("<Q")
+_S64 = struct.Struct("<q")
+_DOUBLE = struct.Struct("<d")
+_ADDRESS_AND_SIZE = struct.Struct("<QI")
+# Strings are prefixed with a u16 size
+_MAX_STRING_SIZE = 0xFFFF
+# Lists only nest for the results of batches (such as a `ReadMany` in a batch), so anything deeper is malformed
+_MAX_LIST_DEPTH = 8
+
+_VALUE_NONE = 0
+_VALUE_INT = 1
+_VALUE_UINT = 2
+_VALUE_DOUBLE = 3
+_VALUE_BYTES = 4
+_VALUE_LIST = 5
+_VALUE_EXCEPTION = 6
+
+# The response header, the value tag and the size of a response with bytes
+_BYTES_RESPONSE_PREFIX = struct.Struct("<BIBI")
+BYTES_RESPONSE_PREFIX_SIZE = _BYTES_RESPONSE_PREFIX.size
+
+_S64_MIN = -(1 << 63)
+_U64_LIMIT = 1 << 64
+
+
+class _Reader:
+    """
+    Reads consecutive fields from a message.
+    """
+
+    def __init__(self, data: bytes):
+        self._data = memoryview(data)
+        self._offset = 0
+        # The number of lists being read, one inside the other
+        self.list_depth = 0
+
+    def unpack(self, fmt: struct.Struct) -> tuple:
+        try:
+            values = fmt.unpack_from(self._data, self._offset)
+        except struct.error as e:
+            raise ProtocolError(f"Message is truncated at offset {self._offset}") from e
+        self._offset += fmt.size
+        return values
+
+    def read(self, size: int) -> bytes:
+        end = self._offset + size
+        if end > len(self._data):
+            raise ProtocolError(f"Message is truncated at offset {self._offset} (expected {size} more bytes)")
+        data = bytes(self._data[self._offset:end])
+        self._offset = end
+        return data
+
+    def read_sized_bytes(self) -> bytes:
+        size, = self.unpack(_U32)
+        return self.read(size)
+
+    def read_string(self) -> str:
+        size, = self.unpack(_U16)
+        return self.read(size).decode("utf-8")
+
+    def read_value(self) -> any:
+        tag, = self.unpack(_U8)
+        try:
+            decode = _VALUE_DECODERS[tag]
+        except KeyError:
+            raise ProtocolError(f"Unknown value tag {tag}") from None
+        return decode(self)
+
+    def ensure_consumed(self):
+        if self._offset != len(self._data):
+            raise ProtocolError(f"Unexpected {len(self._data) - self._offset} trailing bytes in message")
+
+
+def _pack_string(string: str) -> bytes:
+    """
+    Strings longer than their length field allows (such as long exception messages) are truncated.
+    """
+
+    encoded = string.encode("utf-8")
+    if len(encoded) > _MAX_STRING_SIZE:
+        encoded = encoded[:_MAX_STRING_SIZE].decode("utf-8", "ignore").encode("utf-8")
+    return _U16.pack(len(encoded)) + encoded
+
+
+def _value_parts(value) -> tuple:
+    """
+    Packs a plain value (the result of a broker operation or a function argument) along with its type.
+    Bulk data is returned as is and not copied, so it can be joined with the rest of the message at once.
+    """
+
+    if value is None:
+        return _U8.pack(_VALUE_NONE),
+    if isinstance(value, int):
+        if _S64_MIN <= value < 0:
+            return _U8.pack(_VALUE_INT), _S64.pack(value)
+        if 0 <= value < _U64_LIMIT:
+            return _U8.pack(_VALUE_UINT), _U64.pack(value)
+        raise ProtocolError(f"Integer {value} does not fit in 64 bits")
+    if isinstance(value, float):
+        return _U8.pack(_VALUE_DOUBLE), _DOUBLE.pack(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return _U8.pack(_VALUE_BYTES), _U32.pack(len(value)), value
+    if isinstance(value, list):
+        parts = [_U8.pack(_VALUE_LIST), _U32.pack(len(value))]
+        for element in value:
+            parts.extend(_value_parts(element))
+        return tuple(parts)
+    if isinstance(value, Exception):
+        return (_U8.pack(_VALUE_EXCEPTION), *_exception_parts(value))
+
+    raise ProtocolError(f"Values of type {type(value).__name__} cannot be sent")
+
+
+def _exception_parts(exception: Exception) -> tuple:
+    if len(exception.args) == 1 and isinstance(exception.args[0], str):
+        message = exception.args[0]  # Avoids the quotes `str()` adds to some exceptions, such as `KeyError`
+    else:
+        message = str(exception)
+
+    return _pack_string(type(exception).__name__), _pack_string(message)
+
+
+def _to_local_exception(type_name: str, message: str) -> Exception:
+    """
+    Only builtin exception types are recreated, anything else is wrapped.
+    """
+
+    exception_type = getattr(builtins, type_name, None)
+    if isinstance(exception_type, type) and issubclass(exception_type, Exception):
+        try:
+            return exception_type(message)
+        except Exception:
+            pass  # Its constructor takes other arguments, such as that of `UnicodeDecodeError`
+
+    return RemoteBrokerError(type_name, message)
+
+
+def _read_exception(reader: _Reader) -> Exception:
+    type_name = reader.read_string()
+    return _to_local_exception(type_name, reader.read_string())
+
+
+def _read_list(reader: _Reader) -> list:
+    count, = reader.unpack(_U32)
+    if reader.list_depth >= _MAX_LIST_DEPTH:
+        raise ProtocolError(f"Lists are nested deeper than {_MAX_LIST_DEPTH} levels")
+
+    reader.list_depth += 1
+    values = [reader.read_value() for _ in range(count)]
+    reader.list_depth -= 1
+    return values
+
+
+_VALUE_DECODERS = {
+    _VALUE_NONE: lambda reader: None,
+    _VALUE_INT: lambda reader: reader.unpack(_S64)[0],
+    _VALUE_UINT: lambda reader: reader.unpack(_U64)[0],
+    _VALUE_DOUBLE: lambda reader: reader.unpack(_DOUBLE)[0],
+    _VALUE_BYTES: _Reader.read_sized_bytes,
+    _VALUE_LIST: _read_list,
+    _VALUE_EXCEPTION: _read_exception,
+}
+
+
+def _read_ffi_type(reader: _Reader) -> FfiType:
+    value, = reader.unpack(_U8)
+    try:
+        return FfiType(value)
+    except ValueError:
+        raise ProtocolError(f"Unknown FFI type {value}") from None
+
+
+# Request bodies
+
+
+@lru_cache(maxsize=1024)
+def _pack_call_header(module_name: str, function_name: str, return_type: FfiType) -> bytes:
+    """
+    Functions are usually called many times, so the part of their request that only depends on the function is only
+    packed once.
+    """
+
+    return _pack_string(module_name) + _pack_string(function_name) + _U8.pack(return_type.value)
+
+
+def _arguments_parts(arguments: List[FfiArgument]) -> list:
+    parts = [_U16.pack(len(arguments))]
+    for argument in arguments:
+        parts.append(_U8.pack(argument.type.value))
+        parts.extend(_value_parts(argument.value))
+
+    return parts
+
+
+def _read_arguments(reader: _Reader) -> List[FfiArgument]:
+    argument_count, = reader.unpack(_U16)
+    arguments = []
+    for _ in range(argument_count):
+        argument_type = _read_ffi_type(reader)
+        arguments.append(FfiArgument(argument_type, reader.read_value()))
+
+    return arguments
+
+
+def _call_function_parts(data: CallFunction) -> list:
+    return [_pack_call_header(data.module_name, data.function_name, data.return_type), *_arguments_parts(data.arguments)]
+
+
+def _read_call_function(reader: _Reader) -> CallFunction:
+    module_name = reader.read_string()
+    function_name = reader.read_string()
+    return_type = _read_ffi_type(reader)
+    return CallFunction(module_name, function_name, return_type, _read_arguments(reader))
+
+
+def _read_resolve_routine(reader: _Reader) -> ResolveRoutine:
+    module_name = reader.read_string()
+    return ResolveRoutine(module_name, reader.read_string())
+
+
+def _call_address_parts(data: CallAddress) -> list:
+    return [_U64.pack(data.address), _U8.pack(data.return_type.value), *_arguments_parts(data.arguments)]
+
+
+def _read_call_address(reader: _Reader) -> CallAddress:
+    address, = reader.unpack(_U64)
+    return_type = _read_ffi_type(reader)
+    return CallAddress(address, return_type, _read_arguments(reader))
+
+
+def _read_until_parts(data: ReadUntil) -> tuple:
+    return _ADDRESS_AND_SIZE.pack(data.address, data.max_size), _U32.pack(len(data.terminator)), data.terminator
+
+
+def _read_read_until(reader: _Reader) -> ReadUntil:
+    address, max_size = reader.unpack(_ADDRESS_AND_SIZE)
+    return ReadUntil(address, reader.read_sized_bytes(), max_size)
+
+
+def _write_bytes_parts(data: WriteBytes) -> tuple:
+    return _U64.pack(data.address), _U32.pack(len(data.data)), data.data
+
+
+def _read_write_bytes(reader: _Reader) -> WriteBytes:
+    address, = reader.unpack(_U64)
+    return WriteBytes(address, reader.read_sized_bytes())
+
+
+def _read_many_parts(data: ReadMany) -> list:
+    return [_U32.pack(len(data.entries)), *(_ADDRESS_AND_SIZE.pack(entry.address, entry.size) for entry in data.entries)]
+
+
+def _read_read_many(reader: _Reader) -> ReadMany:
+    count, = reader.unpack(_U32)
+    return ReadMany([ReadBytes(*reader.unpack(_ADDRESS_AND_SIZE)) for _ in range(count)])
+
+
+def _write_many_parts(data: WriteMany) -> list:
+    parts = [_U32.pack(len(data.entries))]
+    for entry in data.entries:
+        parts.extend(_write_bytes_parts(entry))
+
+    return parts
+
+
+def _read_write_many(reader: _Reader) -> WriteMany:
+    count, = reader.unpack(_U32)
+    return WriteMany([_read_write_bytes(reader) for _ in range(count)])
+
+
+def _batch_parts(data: Batch) -> list:
+    parts = [_U32.pack(len(data.requests))]
+    for request in data.requests:
+        if request.type is BrokerRequestType.BATCH:
+            raise ProtocolError("Batches may not be nested")
+        parts.append(_U8.pack(request.type.value))
+        parts.extend(_REQUEST_BODY_PACKERS[request.type](request.data))
+
+    return parts
+
+
+def _read_request_type(reader: _Reader) -> BrokerRequestType:
+    value, = reader.unpack(_U8)
+    try:
+        return BrokerRequestType(value)
+    except ValueError:
+        raise ProtocolError(f"Unrecognized request type {value}") from None
+
+
+def _read_batch(reader: _Reader) -> Batch:
+    count, = reader.unpack(_U32)
+    requests = []
+    for _ in range(count):
+        request_type = _read_request_type(reader)
+        if request_type is BrokerRequestType.BATCH:
+            raise ProtocolError("Batches may not be nested")
+        requests.append(BrokerRequest(request_type, _REQUEST_BODY_READERS[request_type](reader)))
+
+    return Batch(requests)
+
+
+# Each returns the parts of the body, to be joined with the header.
+_REQUEST_BODY_PACKERS = {
+    BrokerRequestType.GET_POINTER_SIZE: lambda data: (),
+    BrokerRequestType.CALL_FUNCTION: _call_function_parts,
+    BrokerRequestType.READ_BYTES: lambda data: (_ADDRESS_AND_SIZE.pack(data.address, data.size),),
+    BrokerRequestType.WRITE_BYTES: _write_bytes_parts,
+    BrokerRequestType.ALLOCATE: lambda data: (_U32.pack(data.size),),
+    BrokerRequestType.FREE: lambda data: (_U64.pack(data.address),),
+    BrokerRequestType.BATCH: _batch_parts,
+    BrokerRequestType.READ_UNTIL: _read_until_parts,
+    BrokerRequestType.RESOLVE_ROUTINE: lambda data: (_pack_string(data.module_name), _pack_string(data.function_name)),
+    BrokerRequestType.CALL_ADDRESS: _call_address_parts,
+    BrokerRequestType.READ_MANY: _read_many_parts,
+    BrokerRequestType.WRITE_MANY: _write_many_parts,
+}
+
+_REQUEST_BODY_READERS = {
+    BrokerRequestType.GET_POINTER_SIZE: lambda reader: None,
+    BrokerRequestType.CALL_FUNCTION: _read_call_function,
+    BrokerRequestType.READ_BYTES: lambda reader: ReadBytes(*reader.unpack(_ADDRESS_AND_SIZE)),
+    BrokerRequestType.WRITE_BYTES: _read_write_bytes,
+    BrokerRequestType.ALLOCATE: lambda reader: Allocate(*reader.unpack(_U32)),
+    BrokerRequestType.FREE: lambda reader: Free(*reader.unpack(_U64)),
+    BrokerRequestType.BATCH: _read_batch,
+    BrokerRequestType.READ_UNTIL: _read_read_until,
+    BrokerRequestType.RESOLVE_ROUTINE: _read_resolve_routine,
+    BrokerRequestType.CALL_ADDRESS: _read_call_address,
+    BrokerRequestType.READ_MANY: _read_read_many,
+    BrokerRequestType.WRITE_MANY: _read_write_many,
+}
+
+
+# Handshake
+
+
+def create_client_hello(compression: Optional[Compression]) -> ClientHello:
+    """
+    :param compression: How the client wants messages compressed, or None not to compress them.
+    """
+
+    if compression is None:
+        return ClientHello(PROTOCOL_VERSION, SUPPORTED_CAPABILITIES & ~Capability.COMPRESSION)
+    return ClientHello(PROTOCOL_VERSION, SUPPORTED_CAPABILITIES, compression)
+
+
+def encode_client_hello(hello: ClientHello) -> bytes:
+    encoded = _HELLO.pack(PROTOCOL_MAGIC, hello.version, hello.capabilities)
+    if hello.capabilities & Capability.COMPRESSION:
+        # Servers that don't support compression ignore the rest of the hello
+        encoded += _COMPRESSION_PARAMETERS.pack(hello.compression.level, hello.compression.threshold)
+    return encoded
+
+
+def decode_client_hello(data: bytes) -> ClientHello:
+    reader = _Reader(data)
+    magic, version, capabilities = reader.unpack(_HELLO)
+    if magic != PROTOCOL_MAGIC:
+        raise ProtocolError("Peer does not speak the remote broker protocol")
+
+    hello = ClientHello(version, Capability(capabilities & SUPPORTED_CAPABILITIES))
+    if hello.capabilities & Capability.COMPRESSION:
+        hello.compression = Compression(*reader.unpack(_COMPRESSION_PARAMETERS))
+        if not 1 <= hello.compression.level <= 9:
+            raise ProtocolError(f"Invalid compression level {hello.compression.level}")
+    return hello
+
+
+def encode_server_hello(hello: ServerHello) -> bytes:
+    return _SERVER_HELLO.pack(PROTOCOL_MAGIC, hello.version, hello.capabilities, hello.pointer_size)
+
+
+def decode_server_hello(data: bytes) -> ServerHello:
+    reader = _Reader(data)
+    magic, version, capabilities, pointer_size = reader.unpack(_SERVER_HELLO)
+    if magic != PROTOCOL_MAGIC:
+        raise ProtocolError("Peer does not speak the remote broker protocol")
+
+    return ServerHello(version, Capability(capabilities & SUPPORTED_CAPABILITIES), pointer_size)
+
+
+def negotiate(client_hello: ClientHello, pointer_size: int) -> ServerHello:
+    """
+    Decides on the parameters of a connection, from the server's side.
+    If the client's version is not supported, the server still answers with its own version so the client can report
+    the mismatch, and then closes the connection.
+    """
+
+    return ServerHello(PROTOCOL_VERSION, client_hello.capabilities & SUPPORTED_CAPABILITIES, pointer_size)
+
+
+def check_server_hello(hello: ServerHello):
+    """
+    :raises ProtocolError if the server does not support this client.
+    """
+
+    if hello.version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Server speaks protocol version {hello.version}, expected {PROTOCOL_VERSION}")
+
+
+def get_required_capabilities(requests: List[BrokerRequest]) -> Capability:
+    """
+    :return: The capabilities the server must support to accept the given requests.
+    """
+
+    required = Capability.NONE
+    for request in requests:
+        required |= _REQUEST_CAPABILITIES.get(request.type, Capability.NONE)
+        if request.type is BrokerRequestType.BATCH:
+            required |= get_required_capabilities(request.data.requests)
+
+    return required
+
+
+# Requests and responses
+
+
+def encode_request_parts(request_id: int, request: BrokerRequest) -> tuple:
+    """
+    :return: The parts of the encoded request, which may be sent one after the other. Bulk data (such as the data of a
+             write) is one of the parts as is, without being copied.
+    """
+
+    return (_HEADER.pack(request.type.value, request_id), *_REQUEST_BODY_PACKERS[request.type](request.data))
+
+
+def encode_request(request_id: int, request: BrokerRequest) -> bytes:
+    return b"".join(encode_request_parts(request_id, request))
+
+
+def decode_request(data: bytes) -> Tuple[int, BrokerRequest]:
+    """
+    :return: The request ID and the request.
+    :raises ProtocolError if the message is malformed.
+    """
+
+    reader = _Reader(data)
+    type_value, request_id = reader.unpack(_HEADER)
+    try:
+        request_type = BrokerRequestType(type_value)
+    except ValueError:
+        raise ProtocolError(f"Unrecognized request type {type_value}", request_id) from None
+
+    try:
+        request = BrokerRequest(request_type, _REQUEST_BODY_READERS[request_type](reader))
+        reader.ensure_consumed()
+    except (ProtocolError, UnicodeDecodeError) as e:
+        raise ProtocolError(f"Malformed {request_type.name} request: {e}", request_id) from e
+
+    return request_id, request
+
+
+def encode_response_parts(request_id: int, response: BrokerResponse) -> tuple:
+    """
+    :return: The parts of the encoded response, like `encode_request_parts()`.
+    """
+
+    header = _HEADER.pack(response.type.value, request_id)
+    if response.type is BrokerResponseType.EXCEPTION:
+        return (header, *_exception_parts(response.data))
+
+    return (header, *_value_parts(response.data))
+
+
+def encode_response(request_id: int, response: BrokerResponse) -> bytes:
+    return b"".join(encode_response_parts(request_id, response))
+
+
+def decode_bytes_response_prefix(data: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Decodes the start of a response that may be a successful response with bytes, so the bytes themselves can be
+    received straight into a buffer.
+
+    :param data: The first `BYTES_RESPONSE_PREFIX_SIZE` bytes of the response.
+    :return: The ID of the request this is the response to and the size of the bytes, or None if this is any other
+             response (which should be received whole and decoded with `decode_response()`).
+    """
+
+    if len(data) < _BYTES_RESPONSE_PREFIX.size:
+        return None
+
+    type_value, request_id, tag, size = _BYTES_RESPONSE_PREFIX.unpack_from(data)
+    if type_value != BrokerResponseType.SUCCESS.value or tag != _VALUE_BYTES:
+        return None
+    return request_id, size
+
+
+def decode_response(data: bytes) -> Tuple[int, BrokerResponse]:
+    """
+    :return: The ID of the request this is the response to, and the response. If the response is an exception, its data
+             is an exception object that can be raised.
+    :raises ProtocolError if the message is malformed.
+    """
+
+    reader = _Reader(data)
+    type_value, request_id = reader.unpack(_HEADER)
+    try:
+        response_type = BrokerResponseType(type_value)
+    except ValueError:
+        raise ProtocolError(f"Unrecognized response type {type_value}", request_id) from None
+
+    if response_type is BrokerResponseType.EXCEPTION:
+        response_data = _read_exception(reader)
+    else:
+        response_data = reader.read_value()
+
+    reader.ensure_consumed()
+    return request_id, BrokerResponse(response_type, response_data)
@@ -1,63 +1,373 @@
 import logging
-import pickle
-from socketserver import BaseRequestHandler, TCPServer
+import select
+import socket
+import threading
+from collections import deque
+from contextlib import nullcontext
+from socketserver import BaseRequestHandler, ThreadingTCPServer
+from typing import Callable, Deque, Optional, Tuple
 
-from pykeval.broker.local import LocalBroker
-from pykeval.broker.requests import BrokerResponse, BrokerResponseType, BrokerRequest, BrokerRequestType
-from pykeval.broker.messaging import receive, send
+from pykeval.broker.interface import Broker
+from pykeval.broker.requests import BrokerResponse, BrokerResponseType, BrokerRequest
+from pykeval.broker.messaging import receive, send, LENGTH_PREFIX_SIZE, MAX_MESSAGE_SIZE, ConnectionClosedError
+from pykeval.broker.remote_protocol import (ProtocolError, PROTOCOL_VERSION, Capability, Compression,
+                                            decode_client_hello, negotiate, encode_server_hello, decode_request,
+                                            encode_response_parts)
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_IDLE_TIMEOUT = 120
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_QUEUED_REQUESTS = 64
+DEFAULT_MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+
+class _ClientConnection:
+    """
+    A client connection, shared between the thread that reads its requests and the workers that answer them.
+    """
+
+    def __init__(self, sock: socket.socket, client_address, max_queued_requests: int):
+        self.socket = sock
+        self.client_address = client_address
+
+        # Requests that were received but not executed yet. Guarded by the scheduler.
+        self.queue = deque()  # type: Deque[Tuple[int, BrokerRequest]]
+        # Whether the connection waits in line for a worker. Guarded by the scheduler.
+        self.ready = False
+        # The number of the connection's requests that workers are executing. Guarded by the scheduler.
+        self.active = 0
+        # Bounds the requests that were received but not answered yet, so a client can't queue unlimited work.
+        self.request_slots = threading.BoundedSemaphore(max_queued_requests)
+
+        # How responses are compressed, if the client asked for compression
+        self.compression = None  # type: Optional[Compression]
+        self._send_lock = threading.Lock()
+
+    @property
+    def scheduled(self) -> bool:
+        """
+        Whether the connection has requests that were not answered yet.
+        """
+
+        return len(self.queue) != 0 or self.active != 0
+
+    def send_response(self, request_id: int, response: BrokerResponse):
+        """
+        Sends the response to a request. A response that cannot be sent is replaced with an error, so the client is
+        always answered unless the connection itself fails.
+
+        :raises OSError if the connection failed.
+        """
+
+        try:
+            self._send(encode_response_parts(request_id, response))
+            return
+        except OSError:
+            raise
+        except Exception as e:
+            logger.exception("Response cannot be sent")
+            error = ProtocolError(f"Response cannot be sent: {type(e).__name__}: {e}")
+
+        self._send(encode_response_parts(request_id, BrokerResponse(BrokerResponseType.EXCEPTION, error)))
+
+    def abort(self):
+        """
+        Closes the connection mid-message, so the client stops waiting for responses that will never be sent. Unlike a
+        connection that is closed between messages, this tells the client that its requests may have been executed.
+        """
+
+        with self._send_lock:
+            try:
+                # The length prefix of a message that never arrives
+                self.socket.sendall((1).to_bytes(LENGTH_PREFIX_SIZE, "big"))
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _send(self, parts: tuple):
+        # Workers may answer requests of the same connection at the same time, so whole messages are sent under a lock.
+        with self._send_lock:
+            send(self.socket, *parts, compression=self.compression)
+
+
+class _RequestScheduler:
+    """
+    Executes requests on a fixed number of worker threads.
+
+    Every connection has its own queue, and connections with queued requests are served round-robin, one request at a
+    time. This way a client that sends many requests only delays the requests of its own connection.
+
+    Unless requests may run concurrently, the requests of a connection are executed one at a time in the order they
+    arrived. Otherwise a connection's requests are handed to any free worker, so a slow request does not hold up the
+    requests that were sent after it over the same connection (as `AsyncRemoteBroker` does).
+    """
+
+    def __init__(self, workers: int, execute: Callable[[BrokerRequest], any], concurrent_requests: bool = False):
+        """
+        :param workers: The number of worker threads.
+        :param execute: Executes a request and returns its result.
+        :param concurrent_requests: Whether requests of the same connection may be executed at the same time.
+        """
+
+        self._execute = execute
+        self._concurrent_requests = concurrent_requests
+        self._condition = threading.Condition()
+        self._ready = deque()  # type: Deque[_ClientConnection]
+        self._stopped = False
+
+        self._workers = [threading.Thread(target=self._work, name=f"BrokerWorker-{i}", daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, connection: _ClientConnection, request_id: int, request: BrokerRequest):
+        """
+        Queues a request. Its response is sent over the connection once it is executed.
+        """
+
+        with self._condition:
+            connection.queue.append((request_id, request))
+            self._make_ready(connection)
+
+    def wait_until_answered(self, connection: _ClientConnection, timeout: Optional[float] = None) -> bool:
+        """
+        :return: Whether all of the connection's requests were answered before the timeout.
+        """
+
+        with self._condition:
+            return self._condition.wait_for(lambda: not connection.scheduled, timeout)
+
+    def stop(self):
+        """
+        Stops the workers once they finish their current requests. Queued requests are not executed.
+        """
+
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+        for worker in self._workers:
+            worker.join()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopped or len(self._ready) != 0)
+                if self._stopped:
+                    return
+
+                connection = self._ready.popleft()
+                connection.ready = False
+                request_id, request = connection.queue.popleft()
+                connection.active += 1
+                self._make_ready(connection)
+
+            try:
+                self._serve(connection, request_id, request)
+            except Exception:
+                # The worker keeps serving other connections
+                logger.exception(f"Failed to answer a request of {connection.client_address}, closing the connection")
+                connection.abort()
+            finally:
+                connection.request_slots.release()
+                with self._condition:
+                    connection.active -= 1
+                    self._make_ready(connection)
+                    if not connection.scheduled:
+                        self._condition.notify_all()
+
+    def _make_ready(self, connection: _ClientConnection):
+        """
+        Puts the connection in line for a worker if it has a request that may be executed now. Connections are put at
+        the back of the line, after the other connections that wait.
+        """
+
+        if connection.ready or len(connection.queue) == 0:
+            return
+        if connection.active != 0 and not self._concurrent_requests:
+            return
+
+        connection.ready = True
+        self._ready.append(connection)
+        self._condition.notify()
+
+    def _serve(self, connection: _ClientConnection, request_id: int, request: BrokerRequest):
+        try:
+            response = BrokerResponse(BrokerResponseType.SUCCESS, self._execute(request))
+        except Exception as e:
+            logger.exception("Error processing request")
+            response = BrokerResponse(BrokerResponseType.EXCEPTION, e)
+
+        try:
+            connection.send_response(request_id, response)
+            logger.debug(f"Sent response to {connection.client_address}")
+        except OSError as e:
+            logger.info(f"Could not send response to {connection.client_address}: {e}")
+
 
 class BrokerRequestHandler(BaseRequestHandler):
     broker_server = None
 
+    def setup(self) -> None:
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # noinspection PyProtectedMember
+        self.request.settimeout(self.__class__.broker_server._idle_timeout)
+        # noinspection PyProtectedMember
+        self._connection = _ClientConnection(self.request,
+                                             self.client_address,
+                                             self.__class__.broker_server._max_queued_requests)
+        # noinspection PyProtectedMember
+        self._scheduler = self.__class__.broker_server._scheduler
+
     def handle(self) -> None:
         logger.info(f"Got connection from {self.client_address}")
 
-        data = receive(self.request)
-        logger.debug("Received")
         try:
-            request = pickle.loads(data)
+            if not self._handshake():
+                return
+
             # noinspection PyProtectedMember
-            response_data = self.__class__.broker_server._on_new_request(request)
-            response = BrokerResponse(BrokerResponseType.SUCCESS, response_data)
-        except Exception as e:
-            logger.exception("Error processing request")
-            response = BrokerResponse(BrokerResponseType.EXCEPTION, e)
+            max_message_size = self.__class__.broker_server._max_message_size
+            while self._wait_for_request():
+                data = receive(self.request, self._connection.compression, max_message_size)
+                logger.debug("Received")
+                self._handle_request(data)
+        except socket.timeout:
+            logger.info(f"Closing connection from {self.client_address} that stalled mid-message")
+        except ConnectionClosedError as e:
+            if e.received != 0:
+                logger.warning(f"Connection from {self.client_address} closed mid-message: {e}")
+            else:
+                logger.info(f"Connection from {self.client_address} closed")
+        except ProtocolError as e:
+            logger.warning(f"Closing connection from {self.client_address} after a protocol error: {e}")
+        finally:
+            # Requests that were already received are still executed, and the socket is only closed after that.
+            self._scheduler.wait_until_answered(self._connection)
+
+    def _wait_for_request(self) -> bool:
+        """
+        Waits until the client sends more data. A connection is idle only while none of its requests is in progress, so
+        slow requests don't get their connection closed.
+
+        :return: Whether there is data to receive, or False if the connection was idle for too long.
+        """
+
+        # noinspection PyProtectedMember
+        idle_timeout = self.__class__.broker_server._idle_timeout
+        while True:
+            readable, _, _ = select.select([self.request], [], [], idle_timeout)
+            if len(readable) != 0:
+                return True
+
+            if not self._connection.scheduled:
+                logger.info(f"Closing idle connection from {self.client_address}")
+                return False
+
+    def _handshake(self) -> bool:
+        """
+        :return: Whether the client can continue sending requests over the connection.
+        """
+
+        # noinspection PyProtectedMember
+        max_message_size = self.__class__.broker_server._max_message_size
+        client_hello = decode_client_hello(receive(self.request, max_size=max_message_size))
+        # noinspection PyProtectedMember
+        server_hello = negotiate(client_hello, self.__class__.broker_server._get_pointer_size())
+        send(self.request, encode_server_hello(server_hello))
 
-        logger.debug("Serializing and sending response")
-        serialized_response = pickle.dumps(response)
-        send(self.request, serialized_response)
-        logger.info(f"Sent response to {self.client_address}")
+        if client_hello.version != PROTOCOL_VERSION:
+            logger.warning(f"Client {self.client_address} speaks unsupported protocol version {client_hello.version}")
+            return False
+
+        if server_hello.capabilities & Capability.COMPRESSION:
+            self._connection.compression = client_hello.compression
+        return True
+
+    def _handle_request(self, data: bytes):
+        try:
+            request_id, request = decode_request(data)
+        except ProtocolError as e:
+            if e.request_id is None:
+                raise
+            logger.exception("Received a malformed request")
+            self._connection.send_response(e.request_id, BrokerResponse(BrokerResponseType.EXCEPTION, e))
+            return
+
+        # Blocks while the client has too many unanswered requests. The slot is released once the response is sent.
+        self._connection.request_slots.acquire()
+        self._scheduler.submit(self._connection, request_id, request)
 
 
 class RemoteBrokerServer:
     """
     A broker server based on a local broker over TCP. This works together with `RemoteBroker` to allow running code on a
     different machine than the client itself.
+
+    Each connection may carry any number of requests. Connections are read on separate threads, and requests are
+    executed by a pool of workers, so a slow request does not hold up other clients. If the local broker is thread safe,
+    the requests of a connection run concurrently as well. Otherwise requests are passed to the local broker one at a
+    time, and the requests of each connection run in order.
     """
 
-    def __init__(self, local_broker: LocalBroker, address: str, port: int):
+    def __init__(self,
+                 local_broker: Broker,
+                 address: str,
+                 port: int,
+                 idle_timeout: Optional[float] = DEFAULT_IDLE_TIMEOUT,
+                 workers: int = DEFAULT_WORKERS,
+                 max_queued_requests: int = DEFAULT_MAX_QUEUED_REQUESTS,
+                 max_message_size: int = DEFAULT_MAX_MESSAGE_SIZE):
         """
         :param local_broker: The actual local broker that will handle requests
         :param address: The address of the server
         :param port: The port of the server
+        :param idle_timeout: The amount of seconds after which a connection without requests is closed. None to never
+                             close idle connections.
+        :param workers: The number of requests that may be executed at the same time.
+        :param max_queued_requests: The number of unanswered requests a single connection may have. The server stops
+                                    reading from a connection that reaches it.
+        :param max_message_size: The size in bytes of the largest request the server accepts, both as it is sent and
+                                 once decompressed. The connection of a client that sends a larger request is closed.
         """
 
+        if workers < 1:
+            raise ValueError(f"At least one worker is required (got {workers})")
+        if max_queued_requests < 1:
+            raise ValueError(f"At least one request must be allowed to queue (got {max_queued_requests})")
+        if not 0 < max_message_size <= MAX_MESSAGE_SIZE:
+            raise ValueError(f"The maximal message size must be between 1 and {MAX_MESSAGE_SIZE} bytes "
+                             f"(got {max_message_size})")
+
         self._local_broker = local_broker
         self._address = address
         self._port = port
+        self._idle_timeout = idle_timeout
+        self._workers = workers
+        self._max_queued_requests = max_queued_requests
+        self._max_message_size = max_message_size
+        self._scheduler = None  # type: Optional[_RequestScheduler]
+        self._broker_lock = threading.Lock()
 
     def start(self):
         """
         Starts the TCP server.
         """
 
+        self._scheduler = _RequestScheduler(self._workers, self._on_new_request, self._local_broker.thread_safe)
         handler_type = type("BoundBrokerRequestHandler", (BrokerRequestHandler,), {"broker_server": self})
-        with TCPServer((self._address, self._port), handler_type) as server:
-            logger.info(f"Starting server at {self._address}:{self._port}")
-            server.serve_forever()
+        try:
+            with ThreadingTCPServer((self._address, self._port), handler_type) as server:
+                server.daemon_threads = True
+                logger.info(f"Starting server at {self._address}:{self._port} with {self._workers} workers")
+                server.serve_forever()
+        finally:
+            self._scheduler.stop()
+
+    def _get_pointer_size(self) -> int:
+        with self._lock_broker():
+            return self._local_broker.get_pointer_size()
 
     def _on_new_request(self, request: BrokerRequest):
         """
@@ -67,22 +377,8 @@ class RemoteBrokerServer:
         :raises ValueError if the request type is not supported.
         """
 
-        # No-data requests
-        if request.type == BrokerRequestType.GET_POINTER_SIZE:
-            return self._local_broker.get_pointer_size()
+        with self._lock_broker():
+            return self._local_broker.execute(request)
 
-        # Data requests
-        try:
-            handler = {
-                BrokerRequestType.CALL_FUNCTION: self._local_broker.call_function,
-                BrokerRequestType.READ_BYTES: self._local_broker.read_bytes,
-                BrokerRequestType.WRITE_BYTES: self._local_broker.write_bytes,
-                BrokerRequestType.ALLOCATE: self._local_broker.allocate,
-                BrokerRequestType.FREE: self._local_broker.free
-            }[request.type]
-
-            return handler(request.data)
-        except KeyError:
-            pass
-
-        raise ValueError(f"Unrecognized request type {request.type.value}")
+    def _lock_broker(self):
+        return nullcontext() if self._local_broker.thread_safe else self._broker_lock
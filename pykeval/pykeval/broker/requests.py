@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from enum import Enum
-from typing import List
+from typing import List, Union
 
 from pykeval.shared.ffi import FfiType, FfiArgument
 
@@ -16,6 +16,12 @@ class BrokerRequestType(Enum):
     WRITE_BYTES = 3
     ALLOCATE = 4
     FREE = 5
+    BATCH = 6
+    READ_UNTIL = 7
+    RESOLVE_ROUTINE = 8
+    CALL_ADDRESS = 9
+    READ_MANY = 10
+    WRITE_MANY = 11
 
 
 class BrokerResponseType(Enum):
@@ -43,18 +49,65 @@ class CallFunction:
     arguments: List[FfiArgument]
 
 
+@dataclass
+class ResolveRoutine:
+    """
+    Finds the address of a function, so it can be called with `CallAddress` without being looked up again.
+    """
+    module_name: str
+    function_name: str
+
+
+@dataclass
+class CallAddress:
+    """
+    Calls a function by its address, as returned by `ResolveRoutine`.
+    """
+    address: int
+    return_type: FfiType
+    arguments: List[FfiArgument]
+
+
 @dataclass
 class ReadBytes:
     address: int
     size: int
 
 
+@dataclass
+class ReadUntil:
+    """
+    Reads memory up to a terminator, which is only matched at offsets that are multiples of its size (so a wide string
+    is terminated by a whole NUL character). At most `max_size` bytes are read.
+    """
+    address: int
+    terminator: bytes
+    max_size: int
+
+
 @dataclass
 class WriteBytes:
     address: int
+    # Either `bytes` or a flat `memoryview` (see `as_buffer()`), which is written without being copied
     data: bytes
 
 
+@dataclass
+class ReadMany:
+    """
+    Reads many separate ranges of memory in one request. Each range succeeds or fails on its own.
+    """
+    entries: List[ReadBytes]
+
+
+@dataclass
+class WriteMany:
+    """
+    Writes to many separate ranges of memory in one request. Each write succeeds or fails on its own.
+    """
+    entries: List[WriteBytes]
+
+
 @dataclass
 class Allocate:
     size: int
@@ -63,3 +116,24 @@ class Allocate:
 @dataclass
 class Free:
     address: int
+
+
+@dataclass
+class Batch:
+    """
+    Independent requests that are executed one after the other. Batches may not be nested.
+    """
+    requests: List[BrokerRequest]
+
+
+def as_buffer(data) -> Union[bytes, memoryview]:
+    """
+    :param data: Any object that supports the buffer protocol, such as `bytes`, a `bytearray`, an `mmap` or a numpy
+                 array.
+    :return: The data itself if it is `bytes`, or a flat view of its bytes otherwise, so it can be written without being
+             copied. The data must not be modified until the write completes.
+    """
+
+    if isinstance(data, bytes):
+        return data
+    return memoryview(data).cast("B")
@@ -0,0 +1,407 @@
+import ctypes
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from pykeval.broker.interface import Broker
+from pykeval.broker.read_until import PAGE_SIZE
+from pykeval.broker.requests import (CallFunction, ResolveRoutine, CallAddress, ReadBytes, WriteBytes, Allocate, Free,
+                                     ReadMany, WriteMany, Batch, BrokerRequest, BrokerRequestType)
+from pykeval.shared.ffi import FfiArgument, FfiType, FFI_TYPE_TO_CTYPES_TYPE_MAP
+
+"""
+A broker that simulates the target machine in Python, so clients can be used (and benchmarked) without the driver.
+"""
+
+# Allocations are rounded up to this, like pool allocations
+POOL_ALIGNMENT = 0x10
+
+# Where allocations and routines are placed, by pointer size. Routines are placed like the exports of a loaded module.
+_POOL_BASE_ADDRESSES = {4: 0x8A000000, 8: 0xFFFFA00000000000}
+_ROUTINES_BASE_ADDRESSES = {4: 0x80400000, 8: 0xFFFFF80000000000}
+_ROUTINE_ALIGNMENT = 0x10
+
+# The part of each request and response that is not data, such as headers and arguments
+_REQUEST_OVERHEAD = 16
+_ARGUMENT_SIZE = 9
+
+
+@dataclass(frozen=True)
+class LatencyProfile:
+    """
+    How long requests take to reach the simulated target and return: a delay for every round trip, plus the time it
+    takes to transfer the data of the request and its response.
+    """
+
+    name: str
+    # In seconds
+    round_trip: float
+    # In bytes per second. None if transfers take no time.
+    bandwidth: Optional[float] = None
+
+    def get_delay(self, transferred: int) -> float:
+        """
+        :param transferred: The number of bytes that are sent and received.
+        :return: How long a round trip that transfers that many bytes takes, in seconds.
+        """
+
+        if self.bandwidth is None:
+            return self.round_trip
+        return self.round_trip + transferred / self.bandwidth
+
+
+NO_LATENCY = LatencyProfile("none", 0)
+# A `LocalBroker`, which sends an IOCTL to a driver on the same machine
+LOCAL_IOCTL = LatencyProfile("ioctl", 20e-6, 4e9)
+# A `RemoteBroker` on a local network
+LAN = LatencyProfile("lan", 0.5e-3, 125e6)
+# A `RemoteBroker` across the internet or a VPN
+WAN = LatencyProfile("wan", 40e-3, 2.5e6)
+
+LATENCY_PROFILES = {profile.name: profile for profile in (NO_LATENCY, LOCAL_IOCTL, LAN, WAN)}
+
+
+def _get_target_ctypes_type(ffi_type: FfiType, pointer_size: int):
+    """
+    :return: The ctypes type of an FFI type on the Windows target, whose `long` is 32 bits no matter which machine the
+             simulation runs on.
+    """
+
+    if ffi_type is FfiType.POINTER:
+        return ctypes.c_uint64 if pointer_size == 8 else ctypes.c_uint32
+    if ffi_type is FfiType.ULONG:
+        return ctypes.c_uint32
+    if ffi_type is FfiType.SLONG:
+        return ctypes.c_int32
+
+    return FFI_TYPE_TO_CTYPES_TYPE_MAP[ffi_type]
+
+
+def _get_transfer_size(request: BrokerRequest) -> int:
+    """
+    :return: The approximate number of bytes a request and its response transfer.
+    """
+
+    if request.type is BrokerRequestType.READ_BYTES:
+        return _REQUEST_OVERHEAD + request.data.size
+    if request.type is BrokerRequestType.WRITE_BYTES:
+        return _REQUEST_OVERHEAD + len(request.data.data)
+    if request.type in (BrokerRequestType.CALL_FUNCTION, BrokerRequestType.CALL_ADDRESS):
+        return _REQUEST_OVERHEAD + _ARGUMENT_SIZE * len(request.data.arguments)
+    if request.type is BrokerRequestType.READ_MANY:
+        return _REQUEST_OVERHEAD + sum(entry.size for entry in request.data.entries)
+    if request.type is BrokerRequestType.WRITE_MANY:
+        return _REQUEST_OVERHEAD + sum(len(entry.data) for entry in request.data.entries)
+    if request.type is BrokerRequestType.BATCH:
+        return sum(_get_transfer_size(inner_request) for inner_request in request.data.requests)
+
+    return _REQUEST_OVERHEAD
+
+
+class SimulatedBroker(Broker):
+    """
+    Simulates the target machine in Python:
+
+    * Memory is sparse. Only pages that were allocated or mapped with `map_memory()` can be accessed, and accessing
+      anything else raises `MemoryError`.
+    * Small allocations are carved out of pool pages, and freed blocks are reused for allocations of the same size.
+      Allocations of a page or more get pages of their own, which are unmapped when they are freed.
+    * Routines are Python functions, registered with `register_routine()`. Like the driver, `call_function()` looks up
+      the routine by name, while `call_address()` calls a routine that was resolved with `resolve_routine()` directly.
+
+    Every request is delayed according to a `LatencyProfile`, and a batch is delayed like a single request. The delay
+    does not hold up requests from other threads, so concurrent requests overlap as they would over a real connection.
+    This makes the broker suitable for load-testing clients, including behind a `RemoteBrokerServer`.
+    """
+
+    thread_safe = True
+
+    def __init__(self, pointer_size: int = 8, latency: LatencyProfile = NO_LATENCY):
+        """
+        :param pointer_size: The size of a pointer on the simulated machine, 4 or 8.
+        :param latency: How long requests take.
+        """
+
+        if pointer_size not in (4, 8):
+            raise ValueError(f"Pointer size must be 4 or 8 (got {pointer_size})")
+
+        self.pointer_size = pointer_size
+        self.latency = latency
+
+        self._lock = threading.RLock()
+        self._batch_state = threading.local()
+
+        self._pages = {}  # type: Dict[int, bytearray]
+        # Pages are never allocated twice, so a freed address stays invalid
+        self._next_page = _POOL_BASE_ADDRESSES[pointer_size]
+        # The rest of the current pool page, where small allocations are carved from
+        self._pool_cursor = 0
+        self._pool_end = 0
+        self._free_blocks = {}  # type: Dict[int, List[int]]  # Freed addresses by block size
+        self._allocations = {}  # type: Dict[int, int]  # Block sizes by address
+
+        # Routine addresses by uppercase module name and routine name, like the driver's lookup
+        self._routine_addresses = {}  # type: Dict[Tuple[str, str], int]
+        self._routines = {}  # type: Dict[int, Callable]
+        self._next_routine_address = _ROUTINES_BASE_ADDRESSES[pointer_size]
+
+        # The number of times a routine was looked up by name
+        self.routine_lookups = 0
+
+    # Setting up the simulation
+
+    def register_routine(self, module_name: str, function_name: str, routine: Callable) -> int:
+        """
+        Adds a routine to a module. Registering a routine that already exists replaces it at a new address, as if its
+        module was reloaded.
+
+        :param module_name: The name of the module, which is matched regardless of case.
+        :param function_name: The name of the routine.
+        :param routine: Called with the arguments of the routine (as converted to their declared types), and returns
+                        its return value. Routines may use `read_memory()` and `write_memory()` to access pointers.
+
+        :return: The address of the routine.
+        """
+
+        with self._lock:
+            address = self._next_routine_address
+            self._next_routine_address += _ROUTINE_ALIGNMENT
+
+            previous_address = self._routine_addresses.get((module_name.upper(), function_name))
+            self._routines.pop(previous_address, None)
+            self._routine_addresses[(module_name.upper(), function_name)] = address
+            self._routines[address] = routine
+
+        return address
+
+    def unregister_module(self, module_name: str):
+        """
+        Removes all routines of a module, as if it was unloaded. Their addresses are not reused.
+        """
+
+        with self._lock:
+            for key in [key for key in self._routine_addresses if key[0] == module_name.upper()]:
+                del self._routines[self._routine_addresses.pop(key)]
+
+    def map_memory(self, address: int, data: Union[int, bytes]):
+        """
+        Makes memory accessible without allocating it, for example to place the structures a routine returns at a
+        fixed address.
+
+        :param address: The address of the memory.
+        :param data: The initial contents of the memory, or its size if it should be zeroed.
+        """
+
+        size = data if isinstance(data, int) else len(data)
+        with self._lock:
+            for page in range(address & ~(PAGE_SIZE - 1), address + size, PAGE_SIZE):
+                self._pages.setdefault(page, bytearray(PAGE_SIZE))
+            if not isinstance(data, int):
+                self.write_memory(address, data)
+
+    def read_memory(self, address: int, size: int) -> bytes:
+        """
+        Reads simulated memory directly, without a delay.
+
+        :raises MemoryError if any of the memory is not mapped.
+        """
+
+        with self._lock:
+            return b"".join(page_data[start:end] for page_data, start, end in self._get_page_ranges(address, size))
+
+    def write_memory(self, address: int, data: bytes):
+        """
+        Writes simulated memory directly, without a delay.
+
+        :raises MemoryError if any of the memory is not mapped.
+        """
+
+        data = memoryview(data).cast("B")
+        with self._lock:
+            offset = 0
+            for page_data, start, end in self._get_page_ranges(address, len(data)):
+                page_data[start:end] = data[offset:offset + end - start]
+                offset += end - start
+
+    # The broker interface
+
+    def get_pointer_size(self) -> int:
+        return self.pointer_size
+
+    def resolve_routine(self, request_data: ResolveRoutine) -> int:
+        self._delay(BrokerRequest(BrokerRequestType.RESOLVE_ROUTINE, request_data))
+        return self._find_routine(request_data.module_name, request_data.function_name)
+
+    def call_function(self, request_data: CallFunction) -> any:
+        self._delay(BrokerRequest(BrokerRequestType.CALL_FUNCTION, request_data))
+        address = self._find_routine(request_data.module_name, request_data.function_name)
+        return self._call(address, request_data.return_type, request_data.arguments)
+
+    def call_address(self, request_data: CallAddress) -> any:
+        self._delay(BrokerRequest(BrokerRequestType.CALL_ADDRESS, request_data))
+        return self._call(request_data.address, request_data.return_type, request_data.arguments)
+
+    def read_bytes(self, request_data: ReadBytes) -> bytes:
+        self._delay(BrokerRequest(BrokerRequestType.READ_BYTES, request_data))
+        return self.read_memory(request_data.address, request_data.size)
+
+    def read_into(self, request_data: ReadBytes, buffer):
+        self._delay(BrokerRequest(BrokerRequestType.READ_BYTES, request_data))
+
+        view = memoryview(buffer).cast("B")
+        if len(view) < request_data.size:
+            raise ValueError(f"Buffer of {len(view)} bytes is too small to read {request_data.size} bytes into")
+
+        with self._lock:
+            offset = 0
+            for page_data, start, end in self._get_page_ranges(request_data.address, request_data.size):
+                view[offset:offset + end - start] = page_data[start:end]
+                offset += end - start
+
+    def write_bytes(self, request_data: WriteBytes):
+        self._delay(BrokerRequest(BrokerRequestType.WRITE_BYTES, request_data))
+        self.write_memory(request_data.address, request_data.data)
+
+    def read_many(self, request_data: ReadMany) -> List[any]:
+        self._delay(BrokerRequest(BrokerRequestType.READ_MANY, request_data))
+
+        results = []
+        for entry in request_data.entries:
+            try:
+                results.append(self.read_memory(entry.address, entry.size))
+            except MemoryError as e:
+                results.append(e)
+
+        return results
+
+    def write_many(self, request_data: WriteMany) -> List[any]:
+        self._delay(BrokerRequest(BrokerRequestType.WRITE_MANY, request_data))
+
+        results = []
+        for entry in request_data.entries:
+            try:
+                results.append(self.write_memory(entry.address, entry.data))
+            except MemoryError as e:
+                results.append(e)
+
+        return results
+
+    def allocate(self, request_data: Allocate) -> int:
+        self._delay(BrokerRequest(BrokerRequestType.ALLOCATE, request_data))
+
+        size = max(request_data.size + POOL_ALIGNMENT - 1 & ~(POOL_ALIGNMENT - 1), POOL_ALIGNMENT)
+        with self._lock:
+            if size >= PAGE_SIZE:
+                address = self._allocate_pages(size)
+            elif len(self._free_blocks.get(size, [])) != 0:
+                address = self._free_blocks[size].pop()
+                self.write_memory(address, bytes(size))
+            else:
+                if self._pool_cursor + size > self._pool_end:
+                    self._pool_cursor = self._allocate_pages(PAGE_SIZE)
+                    self._pool_end = self._pool_cursor + PAGE_SIZE
+                address = self._pool_cursor
+                self._pool_cursor += size
+
+            self._allocations[address] = size
+
+        return address
+
+    def free(self, request_data: Free):
+        """
+        :raises ValueError if the address is not an allocation (where the driver would crash the machine).
+        """
+
+        self._delay(BrokerRequest(BrokerRequestType.FREE, request_data))
+
+        with self._lock:
+            size = self._allocations.pop(request_data.address, None)
+            if size is None:
+                raise ValueError(f"Freed address {request_data.address:#x} is not allocated")
+
+            if size >= PAGE_SIZE:
+                for page in range(request_data.address, request_data.address + size, PAGE_SIZE):
+                    del self._pages[page]
+            else:
+                self._free_blocks.setdefault(size, []).append(request_data.address)
+
+    def execute_batch(self, requests: List[BrokerRequest]) -> List[any]:
+        """
+        Executes the requests with a single delay, like brokers that send a batch at once.
+        """
+
+        self._delay(BrokerRequest(BrokerRequestType.BATCH, Batch(requests)))
+
+        self._batch_state.active = True
+        try:
+            return super().execute_batch(requests)
+        finally:
+            self._batch_state.active = False
+
+    # Internals
+
+    def _find_routine(self, module_name: str, function_name: str) -> int:
+        with self._lock:
+            self.routine_lookups += 1
+            address = self._routine_addresses.get((module_name.upper(), function_name))
+
+        if address is None:
+            raise LookupError(f"Routine {function_name} was not found in {module_name}")
+        return address
+
+    def _call(self, address: int, return_type: FfiType, arguments: List[FfiArgument]) -> any:
+        routine = self._routines.get(address)
+        if routine is None:
+            raise LookupError(f"There is no routine at {address:#x}")
+
+        result = routine(*[self._to_target_value(argument.type, argument.value) for argument in arguments])
+        return self._to_target_value(return_type, result)
+
+    def _to_target_value(self, ffi_type: FfiType, value) -> any:
+        """
+        Converts a value the way the driver would, by storing it in the C type and reading it back.
+        """
+
+        ctypes_type = _get_target_ctypes_type(ffi_type, self.pointer_size)
+        if ctypes_type is None:
+            return None
+        return ctypes_type(value or 0).value
+
+    def _allocate_pages(self, size: int) -> int:
+        address = self._next_page
+        self._next_page += size + PAGE_SIZE - 1 & ~(PAGE_SIZE - 1)
+        self.map_memory(address, size)
+        return address
+
+    def _get_page_ranges(self, address: int, size: int) -> List[Tuple[bytearray, int, int]]:
+        """
+        :return: The data of each page in the range, and the range of offsets in it.
+        :raises MemoryError if any of the pages is not mapped.
+        """
+
+        ranges = []
+        end_address = address + size
+        while address < end_address:
+            page = address & ~(PAGE_SIZE - 1)
+            page_data = self._pages.get(page)
+            if page_data is None:
+                raise MemoryError(f"Access to unmapped memory at {address:#x}")
+
+            end = min(end_address - page, PAGE_SIZE)
+            ranges.append((page_data, address - page, end))
+            address = page + end
+
+        return ranges
+
+    def _delay(self, request: BrokerRequest):
+        """
+        Waits as long as the request takes according to the latency profile, unless it is part of a batch.
+        """
+
+        if getattr(self._batch_state, "active", False):
+            return
+
+        delay = self.latency.get_delay(_get_transfer_size(request))
+        if delay > 0:
+            time.sleep(delay)
@@ -1 +1,23 @@
-from .client import Client
+from importlib import import_module
+
+# Imported when first used, so `Client` doesn't pay for importing asyncio.
+_FRONTEND_MODULES = {
+    "Client": ".client",
+    "AsyncClient": ".async_client",
+    "Arena": ".arena",
+}
+
+__all__ = list(_FRONTEND_MODULES)
+
+
+def __getattr__(name: str):
+    if name not in _FRONTEND_MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = getattr(import_module(_FRONTEND_MODULES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
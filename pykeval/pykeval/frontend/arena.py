@@ -0,0 +1,235 @@
+import logging
+import threading
+from collections import Counter
+from typing import Dict, List, Optional
+
+from pykeval.broker.interface import Broker, raise_first_error
+from pykeval.broker.requests import Allocate, Free, BrokerRequest, BrokerRequestType
+from pykeval.frontend.batch_steps import BatchSteps, run_steps
+from pykeval.frontend.broker_allocation import BrokerAllocation
+from pykeval.frontend.deferred_free import defer_free, get_owner_thread
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 0x10000
+DEFAULT_MIN_SLOT_SIZE = 0x10
+DEFAULT_MAX_SLOT_SIZE = 0x1000
+
+
+class _Chunk:
+    """
+    A chunk allocated through the broker, split into equally sized slots.
+    """
+
+    def __init__(self, address: int, slot_size: int, chunk_size: int):
+        self.address = address
+        self.slot_size = slot_size
+        self.slot_count = chunk_size // slot_size
+        # Offsets of the free slots. The lowest offset is handed out first.
+        self.free_offsets = list(range(chunk_size - slot_size, -1, -slot_size))
+
+    @property
+    def is_empty(self) -> bool:
+        return len(self.free_offsets) == self.slot_count
+
+
+class ArenaAllocation(BrokerAllocation):
+    """
+    An allocation handed out by an `Arena`. Freeing it returns its slot to the arena. Its request to free is the request
+    that frees its chunk, if the chunk is no longer needed.
+    """
+
+    def __init__(self, arena: "Arena", chunk: _Chunk, offset: int, size: int):
+        super().__init__(arena.broker, chunk.address + offset, size)
+        self._arena = arena
+        self._chunk = chunk
+        self._offset = offset
+
+    def free_request(self) -> Optional[BrokerRequest]:
+        if self._allocation is None:
+            return None
+
+        self._allocation = None
+        self._size = 0
+        return self._arena._release(self._chunk, self._offset)
+
+
+class Arena:
+    """
+    Hands out small allocations from large chunks that are allocated through a broker, so most allocations and frees
+    don't need a request at all.
+
+    Each chunk is split into slots of a single size class (a power of two), and every allocation takes a slot of the
+    smallest class that fits it. Slots are aligned to their size, up to the alignment of the chunk itself. Allocations
+    larger than the largest class are made directly through the broker.
+
+    Once all of the slots of a chunk are free, the chunk is freed, except for a few spare chunks of each size class that
+    are kept for the next allocations. Use `trim()` to free these as well.
+    """
+
+    def __init__(self,
+                 broker: Broker,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 min_slot_size: int = DEFAULT_MIN_SLOT_SIZE,
+                 max_slot_size: int = DEFAULT_MAX_SLOT_SIZE,
+                 spare_chunks: int = 1):
+        """
+        :param broker: The broker to allocate chunks through.
+        :param chunk_size: The size of each chunk.
+        :param min_slot_size: The size of the smallest size class. Must be a power of two.
+        :param max_slot_size: The size of the largest size class. Must be a power of two, no larger than a chunk.
+        :param spare_chunks: How many empty chunks of each size class to keep instead of freeing them.
+        """
+
+        for slot_size in (min_slot_size, max_slot_size):
+            if slot_size <= 0 or slot_size & (slot_size - 1) != 0:
+                raise ValueError(f"Slot sizes must be powers of two (got {slot_size})")
+        if not min_slot_size <= max_slot_size <= chunk_size:
+            raise ValueError(f"Slot sizes must be ordered and fit in a chunk "
+                             f"(got {min_slot_size}, {max_slot_size} and {chunk_size})")
+
+        self.broker = broker
+        self._owner_thread = get_owner_thread(broker)
+        self._chunk_size = chunk_size
+        self._min_slot_size = min_slot_size
+        self._max_slot_size = max_slot_size
+        self._spare_chunks = spare_chunks
+
+        # Allocations may be garbage collected (and freed) while the lock is held by the same thread.
+        self._lock = threading.RLock()
+        self._chunks = {}  # type: Dict[int, List[_Chunk]]  # By slot size
+
+    def allocate(self, size: int) -> BrokerAllocation:
+        """
+        :return: An allocation of the given size.
+        """
+
+        return self.allocate_many([size])[0]
+
+    def allocate_many(self, sizes: List[int]) -> List[BrokerAllocation]:
+        """
+        Creates several allocations. Any chunks that are needed for them are allocated in a single batch.
+        If any of the allocations fails, the ones that succeeded are freed.
+
+        :return: The allocations, in the order of `sizes`.
+        """
+
+        return run_steps(self.allocate_many_steps(sizes), self.broker)
+
+    def allocate_many_steps(self, sizes: List[int]) -> BatchSteps:
+        """
+        The batch steps of `allocate_many()`.
+        """
+
+        allocations = [None] * len(sizes)  # type: List[Optional[BrokerAllocation]]
+        slot_sizes = [self._get_slot_size(size) for size in sizes]
+        large_indices = [index for index, slot_size in enumerate(slot_sizes) if slot_size is None]
+
+        while True:
+            with self._lock:
+                missing_slots = Counter()
+                for index, (size, slot_size) in enumerate(zip(sizes, slot_sizes)):
+                    if slot_size is not None and allocations[index] is None:
+                        allocations[index] = self._take_slot(slot_size, size)
+                        if allocations[index] is None:
+                            missing_slots[slot_size] += 1
+
+            new_chunk_sizes = [slot_size
+                               for slot_size, count in missing_slots.items()
+                               for _ in range(-(-count * slot_size // self._chunk_size))]
+            requests = [BrokerRequest(BrokerRequestType.ALLOCATE, Allocate(self._chunk_size)) for _ in new_chunk_sizes]
+            requests.extend(BrokerRequest(BrokerRequestType.ALLOCATE, Allocate(sizes[index])) for index in large_indices)
+            if len(requests) == 0:
+                return allocations
+
+            logger.debug(f"Allocating {len(new_chunk_sizes)} chunks and {len(large_indices)} large allocations")
+            results = yield requests
+            chunk_results, large_results = results[:len(new_chunk_sizes)], results[len(new_chunk_sizes):]
+
+            for index, address in zip(large_indices, large_results):
+                if not isinstance(address, Exception):
+                    allocations[index] = BrokerAllocation(self.broker, address, sizes[index])
+            large_indices = []
+
+            if any(isinstance(result, Exception) for result in results):
+                free_requests = [BrokerRequest(BrokerRequestType.FREE, Free(address))
+                                 for address in chunk_results if not isinstance(address, Exception)]
+                free_requests.extend(request
+                                     for request in (allocation.free_request()
+                                                     for allocation in allocations if allocation is not None)
+                                     if request is not None)
+                if len(free_requests) != 0:
+                    raise_first_error((yield free_requests))
+                raise_first_error(results)
+
+            with self._lock:
+                for slot_size, address in zip(new_chunk_sizes, chunk_results):
+                    self._chunks.setdefault(slot_size, []).append(_Chunk(address, slot_size, self._chunk_size))
+
+    def trim(self):
+        """
+        Frees the chunks that are empty.
+        """
+
+        with self._lock:
+            requests = []
+            for slot_size, chunks in self._chunks.items():
+                requests.extend(BrokerRequest(BrokerRequestType.FREE, Free(chunk.address))
+                                for chunk in chunks if chunk.is_empty)
+                chunks[:] = [chunk for chunk in chunks if not chunk.is_empty]
+
+        if len(requests) != 0:
+            logger.info(f"Freeing {len(requests)} empty chunks")
+            raise_first_error(self.broker.execute_batch(requests))
+
+    def __del__(self):
+        # Chunks with allocations in them keep the arena alive, so only empty chunks may remain
+        for chunks in self._chunks.values():
+            for chunk in chunks:
+                defer_free(self.broker, BrokerRequest(BrokerRequestType.FREE, Free(chunk.address)), self._owner_thread)
+
+    def _get_slot_size(self, size: int) -> Optional[int]:
+        """
+        :return: The size of the smallest slot that fits the given size, or None if no slot does.
+        """
+
+        if size > self._max_slot_size:
+            return None
+
+        slot_size = self._min_slot_size
+        while slot_size < size:
+            slot_size *= 2
+
+        return slot_size
+
+    def _take_slot(self, slot_size: int, size: int) -> Optional[ArenaAllocation]:
+        """
+        Must be called with the lock held.
+
+        :return: An allocation in a free slot, or None if there is no free slot.
+        """
+
+        for chunk in self._chunks.get(slot_size, []):
+            if len(chunk.free_offsets) != 0:
+                return ArenaAllocation(self, chunk, chunk.free_offsets.pop(), size)
+
+        return None
+
+    def _release(self, chunk: _Chunk, offset: int) -> Optional[BrokerRequest]:
+        """
+        Returns a slot to its chunk.
+
+        :return: The request to free the chunk, if it is empty and not kept as a spare.
+        """
+
+        with self._lock:
+            chunk.free_offsets.append(offset)
+            if not chunk.is_empty:
+                return None
+
+            chunks = self._chunks[chunk.slot_size]
+            if sum(1 for other in chunks if other.is_empty) <= self._spare_chunks:
+                return None
+
+            chunks.remove(chunk)
+            return BrokerRequest(BrokerRequestType.FREE, Free(chunk.address))
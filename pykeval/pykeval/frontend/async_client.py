@@ -0,0 +1,214 @@
+import ctypes
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional, Tuple
+
+from pykeval.broker.async_remote import AsyncRemoteBroker
+from pykeval.broker.requests import ReadBytes, WriteBytes, ReadMany, WriteMany, as_buffer
+from pykeval.frontend.batch_steps import run_steps_async
+from pykeval.frontend.broker_allocation import AsyncBrokerAllocation
+from pykeval.frontend.client import ClientBase
+from pykeval.frontend.ctypes_shim.native import get_native_type
+from pykeval.frontend.ctypes_shim.translate import get_native_pointer_type, TranslatedArgs
+from pykeval.frontend.ctypes_shim.utils import is_pointer_type
+from pykeval.frontend.prepared import PreparedFunction
+from pykeval.frontend.session import AllocationSession, track_allocations
+from pykeval.frontend.strings import (DEFAULT_MAX_STRING_LENGTH, ASCII_TERMINATOR, WIDE_TERMINATOR,
+                                      read_terminated_steps, read_unicode_strings_steps)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncClient(ClientBase):
+    """
+    An asyncio client for using an `AsyncRemoteBroker`. This mirrors `Client`, but its operations are coroutines.
+    Many operations may run concurrently over the same broker.
+    """
+
+    def __init__(self, broker: AsyncRemoteBroker):
+        """
+        :param broker: The broker the client is based on.
+        """
+
+        super().__init__()
+        self.broker = broker
+
+    async def call(self, module_name: str, function_name: str, *args, timeout: Optional[float] = None) -> any:
+        """
+        Calls a declared function. See `Client.call()`.
+
+        :param timeout: The deadline of the call in seconds. Defaults to the broker's timeout.
+        """
+
+        return await self._call_prepared(self.prepare(module_name, function_name), args, timeout=timeout)
+
+    async def _call_prepared(self, prepared: PreparedFunction, args, timeout: Optional[float] = None) -> any:
+        address = self._routine_addresses.get((prepared.module_name, prepared.name))
+        if address is not None:
+            return await self.broker.call_address(prepared.create_address_request(address, args), timeout)
+
+        if not self.resolve_routines:
+            return await self.broker.call_function(prepared.create_request(args), timeout)
+
+        return await run_steps_async(self._resolve_and_call_steps(prepared, args), self.broker, timeout)
+
+    async def ex_call(self,
+                      module_name: str,
+                      function_name: str,
+                      *args,
+                      return_type=None,
+                      read_back_args=True) -> Tuple[any, List, List[AsyncBrokerAllocation]]:
+        """
+        Calls a declared function. This variation supports passing ctypes pointers. See `Client.ex_call()`.
+        """
+
+        return await self._ex_call_prepared(self.prepare(module_name, function_name),
+                                            args,
+                                            return_type=return_type,
+                                            read_back_args=read_back_args)
+
+    async def _ex_call_prepared(self,
+                                prepared: PreparedFunction,
+                                args,
+                                return_type=None,
+                                read_back_args=True) -> Tuple[any, List, List[AsyncBrokerAllocation]]:
+        translated_args = await TranslatedArgs.create_async(self.broker, *args)
+        track_allocations(self, translated_args.allocations)
+        call_result = await self._call_prepared(prepared, translated_args.args)
+
+        if return_type is not None:
+            call_result = await self._cast_return_value(call_result, return_type)
+
+        if read_back_args:
+            returned_args = await translated_args.read_back_async()
+        else:
+            returned_args = translated_args.args
+
+        return call_result, returned_args, translated_args.allocations
+
+    async def _cast_return_value(self, return_value, return_type) -> any:
+        """
+        Casts the return value to the return type. This supports ctypes pointers.
+        """
+
+        if is_pointer_type(return_type):
+            if return_value == 0:
+                return None
+            native_type = get_native_type(return_type._type_,
+                                          get_native_pointer_type(await self.broker.get_pointer_size()))
+            native_value = native_type()
+            data = await self.read_bytes(return_value, ctypes.sizeof(native_type))
+            ctypes.memmove(ctypes.byref(native_value), data, len(data))
+            return native_value
+        else:
+            return return_type(return_value)
+
+    async def read_bytes(self, address: int, size: int, timeout: Optional[float] = None) -> bytes:
+        """
+        Reads bytes from memory on the machine. See `Client.read_bytes()`.
+
+        :param timeout: The deadline of the read in seconds. Defaults to the broker's timeout.
+        """
+
+        return await self.broker.read_bytes(ReadBytes(address, size), timeout)
+
+    async def read_string(self, address: int, max_length: int = DEFAULT_MAX_STRING_LENGTH) -> str:
+        """
+        Read a string (char*) from memory on the machine. See `Client.read_string()`.
+        """
+
+        return (await self.read_strings([address], max_length))[0]
+
+    async def read_strings(self, addresses: List[int], max_length: int = DEFAULT_MAX_STRING_LENGTH) -> List[str]:
+        """
+        Reads many strings (char*) in a single batch. See `Client.read_string()`.
+        """
+
+        data = await run_steps_async(read_terminated_steps(addresses, ASCII_TERMINATOR, max_length), self.broker)
+        return [string.decode("ascii") for string in data]
+
+    async def read_wstring(self, address: int, max_length: int = DEFAULT_MAX_STRING_LENGTH) -> str:
+        """
+        Read a string (wchar_t*) from memory on the machine. See `Client.read_wstring()`.
+        """
+
+        return (await self.read_wstrings([address], max_length))[0]
+
+    async def read_wstrings(self, addresses: List[int], max_length: int = DEFAULT_MAX_STRING_LENGTH) -> List[str]:
+        """
+        Reads many strings (wchar_t*) in a single batch. See `Client.read_wstring()`.
+        """
+
+        data = await run_steps_async(read_terminated_steps(addresses, WIDE_TERMINATOR, max_length), self.broker)
+        return [string.decode("utf-16-le") for string in data]
+
+    async def read_unicode_string(self, address: int) -> str:
+        """
+        Reads the string a `UNICODE_STRING` describes. See `Client.read_unicode_string()`.
+        """
+
+        return (await self.read_unicode_strings([address]))[0]
+
+    async def read_unicode_strings(self, addresses: List[int]) -> List[str]:
+        """
+        Reads the strings many `UNICODE_STRING`s describe, in two batches. See `Client.read_unicode_strings()`.
+        """
+
+        pointer_size = await self.broker.get_pointer_size()
+        return await run_steps_async(read_unicode_strings_steps(addresses, pointer_size), self.broker)
+
+    async def write_bytes(self, address: int, data: bytes, timeout: Optional[float] = None):
+        """
+        Writes bytes to memory on the machine. See `Client.write_bytes()`.
+
+        :param timeout: The deadline of the write in seconds. Defaults to the broker's timeout.
+        """
+
+        return await self.broker.write_bytes(WriteBytes(address, as_buffer(data)), timeout)
+
+    async def read_many(self, ranges: List[Tuple[int, int]], timeout: Optional[float] = None) -> List[any]:
+        """
+        Reads many separate ranges of memory in a single request. See `Client.read_many()`.
+
+        :param timeout: The deadline of the read in seconds. Defaults to the broker's timeout.
+        """
+
+        return await self.broker.read_many(ReadMany([ReadBytes(address, size) for address, size in ranges]), timeout)
+
+    async def write_many(self, writes: List[Tuple[int, bytes]], timeout: Optional[float] = None) -> List[any]:
+        """
+        Writes to many separate ranges of memory in a single request. See `Client.write_many()`.
+
+        :param timeout: The deadline of the write in seconds. Defaults to the broker's timeout.
+        """
+
+        return await self.broker.write_many(WriteMany([WriteBytes(address, as_buffer(data)) for address, data in writes]),
+                                            timeout)
+
+    async def allocate(self, size: int) -> AsyncBrokerAllocation:
+        """
+        Allocates memory on the machine.
+
+        :param size: The amount of bytes to allocate
+
+        :return: An allocation
+        """
+
+        allocation = await AsyncBrokerAllocation.create(self.broker, size)
+        track_allocations(self, [allocation])
+        return allocation
+
+    @asynccontextmanager
+    async def session(self) -> AsyncIterator[AllocationSession]:
+        """
+        Tracks every allocation the client makes inside the scope, and frees them all in a single batch when the scope
+        ends. See `Client.session()`. Each task has sessions of its own.
+        """
+
+        session = AllocationSession(self)
+        session.enter()
+        try:
+            yield session
+        finally:
+            session.exit()
+            await run_steps_async(session.free_steps(), self.broker)
@@ -0,0 +1,47 @@
+from typing import Generator, List, Optional
+
+from pykeval.broker.requests import BrokerRequest
+
+"""
+Operations that take several dependent batches (e.g. allocating memory and only then writing to it) are written as
+generators that yield the requests of each batch and are sent back the results of `execute_batch()`. The value the
+generator returns is the result of the operation.
+
+This keeps such operations independent of how the batches are executed, so the same code serves both synchronous
+brokers and `AsyncRemoteBroker`.
+"""
+
+BatchSteps = Generator[List[BrokerRequest], List[any], any]
+
+
+def run_steps(steps: BatchSteps, broker) -> any:
+    """
+    Executes the batches of an operation on a synchronous broker.
+
+    :return: The result of the operation.
+    """
+
+    results = None
+    try:
+        while True:
+            requests = steps.send(results)
+            results = broker.execute_batch(requests)
+    except StopIteration as e:
+        return e.value
+
+
+async def run_steps_async(steps: BatchSteps, broker, timeout: Optional[float] = None) -> any:
+    """
+    Executes the batches of an operation on an asynchronous broker.
+
+    :param timeout: The deadline of each batch in seconds. Defaults to the broker's timeout.
+    :return: The result of the operation.
+    """
+
+    results = None
+    try:
+        while True:
+            requests = steps.send(results)
+            results = await broker.execute_batch(requests, timeout)
+    except StopIteration as e:
+        return e.value
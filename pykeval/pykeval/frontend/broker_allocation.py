@@ -1,14 +1,20 @@
 import logging
+from typing import List, Optional
 
-from pykeval.broker.interface import Broker
-from pykeval.broker.requests import Allocate, Free, ReadBytes, WriteBytes
+from pykeval.broker.interface import Broker, raise_first_error
+from pykeval.broker.requests import Allocate, Free, ReadBytes, WriteBytes, BrokerRequest, BrokerRequestType, \
+    as_buffer
+from pykeval.frontend.batch_steps import BatchSteps, run_steps
+from pykeval.frontend.deferred_free import defer_free, start_deferred_frees, get_owner_thread
+from pykeval.shared.tracing import start_span
 
 logger = logging.getLogger(__name__)
 
 
 class BrokerAllocation:
     """
-    Represents an allocation by a broker. This object attempts to free the memory once it is garbage collected.
+    Represents an allocation by a broker. This object attempts to free the memory once it is garbage collected, on a
+    background thread.
     """
 
     def __init__(self, broker: Broker, address_or_size: int, size: int = None):
@@ -22,13 +28,69 @@ class BrokerAllocation:
         """
 
         self.broker = broker
+        start_deferred_frees()
+        self._owner_thread = get_owner_thread(broker)
         if size is None:
             self._size = address_or_size
-            self._allocation = broker.allocate(Allocate(self._size))
+            with start_span("allocation.allocate", size=self._size):
+                self._allocation = broker.allocate(Allocate(self._size))
         else:
             self._size = size
             self._allocation = address_or_size
 
+    @classmethod
+    def allocate_many_steps(cls, broker, sizes: List[int]) -> BatchSteps:
+        """
+        The batch steps of `allocate_many()`.
+        """
+
+        results = yield [BrokerRequest(BrokerRequestType.ALLOCATE, Allocate(size)) for size in sizes]
+
+        allocations = [cls(broker, address, size)
+                       for address, size in zip(results, sizes)
+                       if not isinstance(address, Exception)]
+        if len(allocations) != len(sizes):
+            yield from cls.free_many_steps(allocations)
+            raise_first_error(results)
+
+        return allocations
+
+    @classmethod
+    def allocate_many(cls, broker: Broker, sizes: List[int]) -> List["BrokerAllocation"]:
+        """
+        Creates several allocations in a single batch.
+        If any of the allocations fails, the ones that succeeded are freed.
+
+        :return: The allocations, in the order of `sizes`.
+        """
+
+        with start_span("allocation.allocate_many", count=len(sizes), size=sum(sizes)):
+            return run_steps(cls.allocate_many_steps(broker, sizes), broker)
+
+    @staticmethod
+    def free_many_steps(allocations: List["BrokerAllocation"]) -> BatchSteps:
+        """
+        The batch steps of `free_many()`.
+        """
+
+        requests = [request for request in (allocation.free_request() for allocation in allocations)
+                    if request is not None]
+        if len(requests) == 0:
+            return
+
+        logger.info(f"Freeing {len(requests)} allocations")
+        raise_first_error((yield requests))
+
+    @staticmethod
+    def free_many(allocations: List["BrokerAllocation"]):
+        """
+        Frees several allocations (made through the same broker) in a single batch.
+        """
+
+        if len(allocations) != 0:
+            with start_span("allocation.free_many", count=len(allocations)):
+                run_steps(BrokerAllocation.free_many_steps(allocations), allocations[0].broker)
+
     @property
     def address(self):
         return self._allocation
@@ -38,10 +100,17 @@ class BrokerAllocation:
 
     def read(self) -> bytes:
         assert self._allocation is not None
-        return self.broker.read_bytes(ReadBytes(self._allocation, self._size))
+        with start_span("allocation.read", address=self._allocation, size=self._size):
+            return self.broker.read_bytes(ReadBytes(self._allocation, self._size))
+
+    def write_request(self, data: bytes, offset: int = 0) -> BrokerRequest:
+        """
+        :param data: The data to write, which may be any object that supports the buffer protocol.
+        :return: A request that writes to the allocation, to be executed later (e.g. as part of a batch).
+        """
 
-    def write(self, data: bytes, offset: int = 0):
         assert self._allocation is not None
+        data = as_buffer(data)
 
         if offset >= self._size:
             raise ValueError(f"Offset {offset} is too great, only {self._size} bytes available")
@@ -50,14 +119,99 @@ class BrokerAllocation:
         if len(data) > available_size:
             raise ValueError(f"Data length is too great, only {available_size} bytes available (attempted {len(data)})")
 
-        self.broker.write_bytes(WriteBytes(self._allocation + offset, data))
+        return BrokerRequest(BrokerRequestType.WRITE_BYTES, WriteBytes(self._allocation + offset, data))
+
+    def write(self, data: bytes, offset: int = 0):
+        with start_span("allocation.write", address=self._allocation, size=len(data), offset=offset):
+            self.broker.execute(self.write_request(data, offset))
+
+    def free_request(self) -> Optional[BrokerRequest]:
+        """
+        Marks the allocation as freed.
+
+        :return: The request that actually frees the allocation, to be executed later. None if it was already freed.
+        """
+
+        if self._allocation is None:
+            return None
+
+        request = BrokerRequest(BrokerRequestType.FREE, Free(self._allocation))
+        self._allocation = None
+        self._size = 0
+        return request
 
     def free(self):
         if self._allocation is not None:
             logger.info(f"Freeing allocation {self._allocation}")
-            self.broker.free(Free(self._allocation))
-        self._allocation = None
-        self._size = 0
+            with start_span("allocation.free", address=self._allocation, size=self._size):
+                request = self.free_request()
+                if request is not None:
+                    self.broker.execute(request)
+
+    def __del__(self):
+        if getattr(self, "_allocation", None) is None:
+            return  # Freed, or the allocation itself failed
+
+        # Freeing here would block whatever code triggered the garbage collection, so it is done in the background.
+        request = self.free_request()
+        if request is not None:
+            logger.info(f"Deferring free of garbage collected allocation {request.data.address}")
+            defer_free(self.broker, request, self._owner_thread)
+
+
+class AsyncBrokerAllocation(BrokerAllocation):
+    """
+    Represents an allocation by an `AsyncRemoteBroker`. Its operations are coroutines.
+
+    If the object is garbage collected before it was freed, freeing is scheduled on the event loop it was created in.
+    """
+
+    def __init__(self, broker, address: int, size: int):
+        """
+        Wraps an existing allocation. Must be created while the event loop is running.
+
+        :param broker: The asynchronous broker the allocation was made through
+        :param address: The address of the allocation
+        :param size: The size of the allocation
+        """
+
+        import asyncio  # Already imported by the caller, but too slow to import for synchronous clients
+
+        super().__init__(broker, address, size)
+        self._loop = asyncio.get_running_loop()
+
+    @classmethod
+    async def create(cls, broker, size: int) -> "AsyncBrokerAllocation":
+        """
+        Creates a new allocation.
+        """
+
+        with start_span("allocation.allocate", size=size):
+            return cls(broker, await broker.allocate(Allocate(size)), size)
+
+    async def read(self) -> bytes:
+        assert self._allocation is not None
+        with start_span("allocation.read", address=self._allocation, size=self._size):
+            return await self.broker.read_bytes(ReadBytes(self._allocation, self._size))
+
+    async def write(self, data: bytes, offset: int = 0):
+        with start_span("allocation.write", address=self._allocation, size=len(data), offset=offset):
+            await self.broker.execute(self.write_request(data, offset))
+
+    async def free(self):
+        if self._allocation is not None:
+            logger.info(f"Freeing allocation {self._allocation}")
+            with start_span("allocation.free", address=self._allocation, size=self._size):
+                await self.broker.execute(self.free_request())
 
     def __del__(self):
-        self.free()
+        request = self.free_request()
+        if request is None or self._loop.is_closed():
+            return
+
+        logger.info(f"Scheduling free of garbage collected allocation {request.data.address}")
+        broker, loop = self.broker, self._loop
+        try:
+            loop.call_soon_threadsafe(lambda: loop.create_task(broker.execute(request)))
+        except RuntimeError:
+            pass  # The loop was closed in the meantime
@@ -1,41 +1,75 @@
 import ctypes
 import logging
+from contextlib import contextmanager
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Tuple
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
 
+import pykeval.frontend.transfer as transfer
 from pykeval.broker.interface import Broker
-from pykeval.broker.requests import CallFunction, ReadBytes, WriteBytes
+from pykeval.broker.requests import (BrokerRequest, BrokerRequestType, ResolveRoutine, ReadBytes, WriteBytes, ReadMany,
+                                     WriteMany, as_buffer)
+from pykeval.frontend.arena import Arena
+from pykeval.frontend.batch_steps import BatchSteps, run_steps
 from pykeval.frontend.broker_allocation import BrokerAllocation
 from pykeval.frontend.ctypes_shim.native import get_native_type
 from pykeval.frontend.ctypes_shim.translate import get_native_pointer_type, TranslatedArgs
 from pykeval.frontend.ctypes_shim.utils import is_pointer_type
 from pykeval.frontend.function_cache import FunctionCache
+from pykeval.frontend.parse_cache import ParseCache, CacheMode
 from pykeval.frontend.parser import CParser
-from pykeval.shared.ffi import FfiArgument
+from pykeval.frontend.prepared import PreparedFunction, ModuleProxy
+from pykeval.frontend.operations import client_operation
+from pykeval.frontend.profiler import Profile, ProfilingBroker
+from pykeval.frontend.session import AllocationSession, track_allocations
+from pykeval.frontend.strings import (DEFAULT_MAX_STRING_LENGTH, ASCII_TERMINATOR, WIDE_TERMINATOR,
+                                      read_terminated_steps, read_unicode_strings_steps)
+from pykeval.frontend.transfer import DEFAULT_WINDOW, DumpChunk, TransferReport
+from pykeval.shared.ffi import FfiFunction
+from pykeval.shared.tracing import get_current_span, start_span
 
 logger = logging.getLogger(__name__)
 
 
-class Client:
+@dataclass
+class DirectoryDeclarations:
     """
-    A client for using a broker.
+    The result of `declare_from_directory()`. Headers are named by their path relative to the directory.
     """
 
-    def __init__(self, broker: Broker):
-        """
-        :param broker: The broker the client is based on.
-        """
+    # The names of the functions each header declares
+    functions: Dict[str, List[str]]
+    # The error each header that could not be parsed failed with
+    failures: Dict[str, Exception]
 
-        self.broker = broker
-        self._function_cache = FunctionCache()
 
-    def declare_from_header(self, module_name: str, header_path: str) -> List[str]:
+class ClientBase:
+    """
+    Function declarations, shared by `Client` and `AsyncClient`.
+    """
+
+    def __init__(self):
+        self._function_cache = FunctionCache()
+        # Where parsed declarations are cached. Set to None to not cache them.
+        self.parse_cache = ParseCache()  # type: Optional[ParseCache]
+        self._prepared_functions = {}  # type: Dict[Tuple[str, str], PreparedFunction]
+        # Whether functions are called by their address once it is resolved, rather than being looked up by name on
+        # every call. Turned off automatically if the broker can't resolve functions.
+        self.resolve_routines = True
+        self._routine_addresses = {}  # type: Dict[Tuple[str, str], int]
+
+    def declare_from_header(self,
+                            module_name: str,
+                            header_path: str,
+                            cache_mode: CacheMode = CacheMode.USE) -> List[str]:
         """
         Declare all functions in the given header.
+        The parsed functions are cached in `parse_cache`, so declaring from the same header again is fast.
 
         :param module_name: The name of the module that contains the given functions (without its file prefix).
                             For example, "ntoskrnl.exe" would be "ntoskrnl".
         :param header_path: The path to the header.
+        :param cache_mode: How to use the cache. `CacheMode.REFRESH` parses the header even if it is cached.
 
         :return: The names of functions that were declared.
         """
@@ -43,34 +77,211 @@ class Client:
         if not Path(header_path).exists():
             raise FileNotFoundError(header_path)
 
-        functions = CParser.get_functions_from_c_header(header_path)
+        functions = CParser.get_functions_from_c_header(header_path, self.parse_cache, cache_mode)
         for func in functions:
-            self._function_cache.set(module_name, func)
+            self._set_function(module_name, func)
 
         assert len(functions) != 0, "No functions were declared"
 
         return [func.name for func in functions]
 
-    def declare(self, module_name: str, c_declaration: str) -> List[str]:
+    def declare_from_directory(self,
+                               directory: Union[str, Path],
+                               module_map: Union[Dict[str, str], Callable[[Path], Optional[str]]],
+                               pattern: str = "*.h",
+                               workers: Optional[int] = None,
+                               cache_mode: CacheMode = CacheMode.USE) -> DirectoryDeclarations:
+        """
+        Declares all functions in the headers of a directory. Headers are parsed in parallel by a pool of processes, and
+        their functions are declared as each one finishes.
+
+        If headers of the same module declare the same function, the declaration in the header whose path sorts last is
+        used, no matter which header is parsed first. A header that fails to parse is reported in the result, and the
+        rest are still declared.
+
+        :param directory: The directory to look for headers in.
+        :param module_map: The module of each header, by its path relative to the directory (such as "ntoskrnl.h"), or
+                           a function that returns the module of a header. Headers without a module are skipped.
+        :param pattern: A glob pattern of the headers, relative to the directory. Use "**/*.h" to include
+                        subdirectories.
+        :param workers: The number of processes to parse with. Defaults to the number of CPUs. If 1, headers are parsed
+                        in this process.
+        :param cache_mode: How to use the cache. See `declare_from_header()`.
+
+        :return: The functions that were declared, and the headers that failed.
+        """
+
+        directory = Path(directory)
+        if not directory.is_dir():
+            raise NotADirectoryError(str(directory))
+
+        headers = []  # type: List[Tuple[str, Path, str]]  # Name, path and module of each header
+        for path in sorted(directory.glob(pattern)):
+            name = path.relative_to(directory).as_posix()
+            module_name = module_map(path) if callable(module_map) else module_map.get(name)
+            if module_name is None:
+                logger.debug(f"Skipping {name}, which has no module")
+                continue
+            headers.append((name, path, module_name))
+
+        result = DirectoryDeclarations(functions={}, failures={})
+        # The index of the header each function was declared by. Headers that sort later override earlier ones.
+        declared_by = {}  # type: Dict[Tuple[str, str], int]
+        for index, functions in self._parse_headers([path for _, path, _ in headers], workers, cache_mode):
+            name, _, module_name = headers[index]
+            if isinstance(functions, Exception):
+                logger.warning(f"Failed to declare functions from {name}: {functions}")
+                result.failures[name] = functions
+                continue
+
+            for func in functions:
+                if declared_by.get((module_name, func.name), -1) < index:
+                    declared_by[(module_name, func.name)] = index
+                    self._set_function(module_name, func)
+            result.functions[name] = [func.name for func in functions]
+            logger.debug(f"Declared {len(functions)} functions from {name}")
+
+        logger.info(f"Declared functions from {len(result.functions)} headers, {len(result.failures)} failed")
+        return result
+
+    def _parse_headers(self,
+                       paths: List[Path],
+                       workers: Optional[int],
+                       cache_mode: CacheMode) -> Iterator[Tuple[int, Union[List[FfiFunction], Exception]]]:
+        """
+        Parses headers, in parallel unless there is a single worker.
+
+        :return: For each header, as it is parsed: its index and its functions, or the error it failed with.
+        """
+
+        if workers == 1 or len(paths) <= 1:
+            for index, path in enumerate(paths):
+                try:
+                    yield index, CParser.get_functions_from_c_header(str(path), self.parse_cache, cache_mode)
+                except Exception as e:
+                    yield index, e
+            return
+
+        # libclang is not safe to use from several threads, so headers are parsed by processes instead
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        with ProcessPoolExecutor(workers) as executor:
+            futures = {executor.submit(CParser.get_functions_from_c_header, str(path), self.parse_cache, cache_mode):
+                       index
+                       for index, path in enumerate(paths)}
+            for future in as_completed(futures):
+                exception = future.exception()
+                yield futures[future], exception if exception is not None else future.result()
+
+    def declare(self, module_name: str, c_declaration: str, cache_mode: CacheMode = CacheMode.USE) -> List[str]:
         """
-        Declares all functions in the given C declaration string.
+        Declares all functions in the given C declaration string. The parsed functions are cached like in
+        `declare_from_header()`.
 
         :param module_name: The name of the module that contains the given functions (without its file prefix).
                             For example, "ntoskrnl.exe" would be "ntoskrnl".
         :param c_declaration: The declaration. For example, "void HelloWorld();"
+        :param cache_mode: How to use the cache.
 
         :return: The names of functions that were declared.
         """
 
-        functions = CParser.get_functions_from_c_string(c_declaration)
+        functions = CParser.get_functions_from_c_string(c_declaration, self.parse_cache, cache_mode)
 
         for func in functions:
-            self._function_cache.set(module_name, func)
+            self._set_function(module_name, func)
 
         assert len(functions) != 0, "No functions were declared"
 
         return [func.name for func in functions]
 
+    def prepare(self, module_name: str, function_name: str) -> PreparedFunction:
+        """
+        Prepares a declared function to be called many times. This is faster than calling it by name every time.
+
+        :param module_name: The name of the function's module.
+        :param function_name: The name of the function.
+
+        :return: A callable that calls the function. See `PreparedFunction`.
+        """
+
+        key = (module_name, function_name)
+        prepared = self._prepared_functions.get(key)
+        if prepared is None:
+            prepared = PreparedFunction(self, module_name, self._function_cache.get(module_name, function_name))
+            self._prepared_functions[key] = prepared
+
+        return prepared
+
+    def module(self, module_name: str) -> ModuleProxy:
+        """
+        :param module_name: The name of a module.
+        :return: An object that has the functions that are declared in the module as attributes. See `ModuleProxy`.
+        """
+
+        return ModuleProxy(self, module_name)
+
+    def invalidate_routines(self, module_name: Optional[str] = None):
+        """
+        Forgets the addresses functions were resolved to, so they are resolved again the next time they are called.
+        This must be done after a module is reloaded on the target machine, since its functions may have moved.
+
+        :param module_name: Only forget the functions of this module. If None, all addresses are forgotten.
+        """
+
+        if module_name is None:
+            self._routine_addresses.clear()
+            return
+
+        for key in [key for key in self._routine_addresses if key[0] == module_name]:
+            self._routine_addresses.pop(key, None)
+
+    def _resolve_and_call_steps(self, prepared: PreparedFunction, args) -> BatchSteps:
+        """
+        Calls a function by name, and resolves its address in the same batch so later calls can use it.
+
+        :return: The return value of the function.
+        """
+
+        key = (prepared.module_name, prepared.name)
+        resolve_result, call_result = yield [
+            BrokerRequest(BrokerRequestType.RESOLVE_ROUTINE, ResolveRoutine(*key)),
+            BrokerRequest(BrokerRequestType.CALL_FUNCTION, prepared.create_request(args))
+        ]
+
+        if isinstance(resolve_result, NotImplementedError):
+            logger.debug(f"Broker can't resolve routines ({resolve_result}), calling functions by name")
+            self.resolve_routines = False
+        elif not isinstance(resolve_result, Exception):
+            self._routine_addresses[key] = resolve_result
+
+        if isinstance(call_result, Exception):
+            raise call_result
+        return call_result
+
+    def _set_function(self, module_name: str, func: FfiFunction):
+        self._function_cache.set(module_name, func)
+        # The function is prepared again with its new declaration the next time it is called
+        self._prepared_functions.pop((module_name, func.name), None)
+
+
+class Client(ClientBase):
+    """
+    A client for using a broker.
+    """
+
+    def __init__(self, broker: Broker, arena: Optional[Arena] = None):
+        """
+        :param broker: The broker the client is based on.
+        :param arena: If given, allocations (including those `ex_call()` makes) are made from this arena rather than
+                      directly through the broker. This saves requests when making many small allocations.
+        """
+
+        super().__init__()
+        self.broker = broker
+        self.arena = arena
+        self._profile = None  # type: Optional[Profile]
+
     def call(self, module_name: str, function_name: str, *args) -> any:
         """
         Calls a declared function.
@@ -84,16 +295,22 @@ class Client:
         :return: The function's return value.
         """
 
-        func = self._function_cache.get(module_name, function_name)
+        return self._call_prepared(self.prepare(module_name, function_name), args)
+
+    @client_operation("call")
+    def _call_prepared(self, prepared: PreparedFunction, args) -> any:
+        span = get_current_span()
+        if span.recording:
+            span.set_attributes(function=f"{prepared.module_name}!{prepared.name}", argument_count=len(args))
 
-        if len(func.arguments) != len(args):
-            raise TypeError(f"{func.name}() takes exactly {len(func.arguments)} arguments ({len(args)} given)")
+        address = self._routine_addresses.get((prepared.module_name, prepared.name))
+        if address is not None:
+            return self.broker.call_address(prepared.create_address_request(address, args))
 
-        ffi_args = []
-        for named_argument, value in zip(func.arguments, args):
-            ffi_args.append(FfiArgument(named_argument.type, value))
+        if not self.resolve_routines:
+            return self.broker.call_function(prepared.create_request(args))
 
-        return self.broker.call_function(CallFunction(module_name, func.name, func.return_type, ffi_args))
+        return run_steps(self._resolve_and_call_steps(prepared, args), self.broker)
 
     def ex_call(self,
                 module_name: str,
@@ -128,11 +345,32 @@ class Client:
             [2] - Any allocations that were made for this call
         """
 
-        translated_args = TranslatedArgs(self.broker, *args)
-        call_result = self.call(module_name, function_name, *translated_args.args)
+        return self._ex_call_prepared(self.prepare(module_name, function_name),
+                                      args,
+                                      return_type=return_type,
+                                      read_back_args=read_back_args)
+
+    @client_operation("ex_call")
+    def _ex_call_prepared(self,
+                          prepared: PreparedFunction,
+                          args,
+                          return_type=None,
+                          read_back_args=True) -> Tuple[any, List, List[BrokerAllocation]]:
+        translated_args = TranslatedArgs(self.broker, *args, arena=self.arena)
+        track_allocations(self, translated_args.allocations)
+
+        span = get_current_span()
+        if span.recording:
+            span.set_attributes(function=f"{prepared.module_name}!{prepared.name}",
+                                argument_count=len(args),
+                                bytes_marshalled=translated_args.bytes_marshalled,
+                                allocations=len(translated_args.allocations))
+
+        call_result = self._call_prepared(prepared, translated_args.args)
 
         if return_type is not None:
-            call_result = self._cast_return_value(call_result, return_type)
+            with start_span("client.cast_return_value"):
+                call_result = self._cast_return_value(call_result, return_type)
 
         if read_back_args:
             returned_args = translated_args.read_back()
@@ -158,6 +396,7 @@ class Client:
         else:
             return return_type(return_value)
 
+    @client_operation("read_bytes")
     def read_bytes(self, address: int, size: int) -> bytes:
         """
         Reads bytes from memory on the machine.
@@ -171,55 +410,202 @@ class Client:
 
         return self.broker.read_bytes(ReadBytes(address, size))
 
-    def read_string(self, address: int) -> str:
+    @client_operation("read_string")
+    def read_string(self, address: int, max_length: int = DEFAULT_MAX_STRING_LENGTH) -> str:
         """
         Read a string (char*) from memory on the machine.
-        This function continues reading until it encounters a NUL terminator. If the string is malformed, this can cause
-        a page fault.
+        This function continues reading until it encounters a NUL terminator. The string is read in chunks that don't
+        cross into a page the string does not reach.
 
         :param address: The address the string starts at.
+        :param max_length: The maximal number of characters to read. Longer strings are truncated.
 
         :return: The string.
         """
 
-        return self._read_until(address, b'\0').decode("ascii")
+        return self.read_strings([address], max_length)[0]
 
-    def read_wstring(self, address: int) -> str:
+    @client_operation("read_strings")
+    def read_strings(self, addresses: List[int], max_length: int = DEFAULT_MAX_STRING_LENGTH) -> List[str]:
+        """
+        Reads many strings (char*) in a single batch. See `read_string()`.
+        """
+
+        data = run_steps(read_terminated_steps(addresses, ASCII_TERMINATOR, max_length), self.broker)
+        return [string.decode("ascii") for string in data]
+
+    @client_operation("read_wstring")
+    def read_wstring(self, address: int, max_length: int = DEFAULT_MAX_STRING_LENGTH) -> str:
         """
         Read a string (wchar_t*) from memory on the machine.
-        This function continues reading until it encounters a NUL terminator. If the string is malformed, this can cause
-        a page fault.
+        This function continues reading until it encounters a NUL terminator. The string is read in chunks that don't
+        cross into a page the string does not reach.
 
         :param address: The address the string starts at.
+        :param max_length: The maximal number of characters to read. Longer strings are truncated.
 
         :return: The string.
         """
 
-        return self._read_until(address, b'\0\0').decode("utf-16")
+        return self.read_wstrings([address], max_length)[0]
+
+    @client_operation("read_wstrings")
+    def read_wstrings(self, addresses: List[int], max_length: int = DEFAULT_MAX_STRING_LENGTH) -> List[str]:
+        """
+        Reads many strings (wchar_t*) in a single batch. See `read_wstring()`.
+        """
+
+        data = run_steps(read_terminated_steps(addresses, WIDE_TERMINATOR, max_length), self.broker)
+        return [string.decode("utf-16-le") for string in data]
 
-    def _read_until(self, address, terminator: bytes) -> bytes:
+    @client_operation("read_unicode_string")
+    def read_unicode_string(self, address: int) -> str:
         """
-        Reads data from the machine until the terminator is found, in multiples of the terminator's size.
+        Reads the string a `UNICODE_STRING` describes.
+
+        :param address: The address of the `UNICODE_STRING` structure.
+
+        :return: The string.
+        """
+
+        return self.read_unicode_strings([address])[0]
+
+    @client_operation("read_unicode_strings")
+    def read_unicode_strings(self, addresses: List[int]) -> List[str]:
         """
+        Reads the strings many `UNICODE_STRING`s describe, in two batches.
 
-        total_data = []
-        while (byte := self.read_bytes(address, len(terminator))) != terminator:
-            total_data.append(byte)
-            address += len(terminator)
+        :param addresses: The addresses of the `UNICODE_STRING` structures.
+
+        :return: The strings.
+        """
 
-        return b"".join(total_data)
+        return run_steps(read_unicode_strings_steps(addresses, self.broker.get_pointer_size()), self.broker)
 
+    @client_operation("write_bytes")
     def write_bytes(self, address: int, data: bytes):
         """
         Writes bytes to memory on the machine.
         Note that this function does NOT validate the address.
 
         :param address: The address to write to.
-        :param data: The data to write.
+        :param data: The data to write. Any object that supports the buffer protocol (such as a `bytearray`, an `mmap`
+                     or a numpy array) is written without being copied.
+        """
+
+        return self.broker.write_bytes(WriteBytes(address, as_buffer(data)))
+
+    @client_operation("read_into")
+    def read_into(self, address: int, buffer) -> int:
+        """
+        Reads memory from the machine straight into a buffer, which saves copying large reads.
+        Note that this function does NOT validate the address.
+
+        :param address: The address to read from.
+        :param buffer: Any writable object that supports the buffer protocol, such as a `bytearray`, an `mmap` or a
+                       numpy array. As many bytes as it holds are read.
+
+        :return: The number of bytes read.
+        """
+
+        view = memoryview(buffer).cast("B")
+        self.broker.read_into(ReadBytes(address, len(view)), view)
+        return len(view)
+
+    def iter_dump(self,
+                  address: int,
+                  size: int,
+                  chunk_size: Optional[int] = None,
+                  window: int = DEFAULT_WINDOW) -> Iterator[DumpChunk]:
+        """
+        Reads a large region of memory in chunks, and yields the chunks in order. Several chunks are read at once, over
+        brokers that allow concurrent requests. Memory that can't be read is filled with zeros and reported in the
+        chunk, rather than failing the whole dump.
+        Note that this function does NOT validate the address.
+
+        :param address: The address to start reading at.
+        :param size: The number of bytes to read.
+        :param chunk_size: The size of each chunk, or None to adapt it to the throughput of the broker.
+        :param window: The maximal number of chunks that are read at once.
+
+        :return: The chunks, each with its address, its data and the ranges in it that couldn't be read.
+        """
+
+        return transfer.dump_chunks(self.broker, address, size, chunk_size, window)
+
+    @client_operation("dump")
+    def dump(self,
+             address: int,
+             size: int,
+             sink,
+             chunk_size: Optional[int] = None,
+             window: int = DEFAULT_WINDOW) -> TransferReport:
+        """
+        Dumps a large region of memory (such as a driver image) to a file or a stream, reading it like `iter_dump()`.
+        The data is written in order, with memory that can't be read written as zeros, so offsets in the sink match
+        offsets in the region.
+
+        :param sink: The object to write the data to, with a `write()` method (such as a file opened for writing).
+
+        :return: A report of the dump, including the ranges that couldn't be read.
+        """
+
+        return transfer.dump(self.broker, address, size, sink, chunk_size, window)
+
+    @client_operation("upload")
+    def upload(self,
+               address: int,
+               source,
+               size: Optional[int] = None,
+               chunk_size: Optional[int] = None,
+               window: int = DEFAULT_WINDOW) -> TransferReport:
+        """
+        Writes a large buffer or the contents of a stream to memory, in chunks that are written like the chunks of
+        `iter_dump()`. Unlike a dump, the upload stops at the first write that fails. Chunks after it that were
+        already in flight may still be written.
+        Note that this function does NOT validate the address.
+
+        :param address: The address to write to.
+        :param source: Any object that supports the buffer protocol (which is written without being copied), or an
+                       object with a `read()` method (such as a file opened for reading).
+        :param size: The maximal number of bytes to write, or None to write the whole source.
+
+        :return: A report of the upload.
+        :raises UploadError if a write fails. Its report tells how many bytes from the start were written.
+        """
+
+        return transfer.upload(self.broker, address, source, size, chunk_size, window)
+
+    @client_operation("read_many")
+    def read_many(self, ranges: List[Tuple[int, int]]) -> List[any]:
+        """
+        Reads many separate ranges of memory (such as the fields of a structure) in a single request.
+        Each range is read on its own, so a range that can't be read doesn't affect the rest.
+        Note that this function does NOT validate the addresses.
+
+        :param ranges: The address and size of each range.
+
+        :return: For each range, in order, either the data read or the exception reading it raised.
+        """
+
+        return self.broker.read_many(ReadMany([ReadBytes(address, size) for address, size in ranges]))
+
+    @client_operation("write_many")
+    def write_many(self, writes: List[Tuple[int, bytes]]) -> List[any]:
+        """
+        Writes to many separate ranges of memory in a single request.
+        Each write is done on its own, so a write that fails doesn't affect the rest.
+        Note that this function does NOT validate the addresses.
+
+        :param writes: The address to write to and the data to write, for each write. The data may be any object that
+                       supports the buffer protocol, like in `write_bytes()`.
+
+        :return: For each write, in order, either None or the exception it raised.
         """
-        data = bytes(data)
-        return self.broker.write_bytes(WriteBytes(address, data))
 
+        return self.broker.write_many(WriteMany([WriteBytes(address, as_buffer(data)) for address, data in writes]))
+
+    @client_operation("allocate")
     def allocate(self, size: int) -> BrokerAllocation:
         """
         Allocates memory on the machine.
@@ -229,4 +615,62 @@ class Client:
         :return: An allocation
         """
 
-        return BrokerAllocation(self.broker, size)
+        if self.arena is not None:
+            allocation = self.arena.allocate(size)
+        else:
+            allocation = BrokerAllocation(self.broker, size)
+
+        track_allocations(self, [allocation])
+        return allocation
+
+    @contextmanager
+    def session(self) -> Iterator[AllocationSession]:
+        """
+        Tracks every allocation the client makes inside the scope (including the ones `ex_call()` makes), and frees
+        them all in a single batch when the scope ends. Allocations that should outlive the scope can be excluded with
+        `AllocationSession.keep()`.
+
+        Sessions may be nested, and each thread has sessions of its own.
+        """
+
+        session = AllocationSession(self)
+        session.enter()
+        try:
+            yield session
+        finally:
+            session.exit()
+            run_steps(session.free_steps(), self.broker)
+
+    @contextmanager
+    def profile(self) -> Iterator[Profile]:
+        """
+        Records every request the client makes inside the scope (including the ones its arena makes), with the bytes
+        each would take over the remote protocol and its latency. Requests are also totalled by the client operation
+        that made them, such as `ex_call` or `read_wstring`. For example:
+
+            with client.profile() as profile:
+                client.ex_call("ntoskrnl", "RtlInitUnicodeString", ctypes.pointer(string), source)
+            profile.print_report()
+
+        A client can only be profiled by one scope at a time.
+        """
+
+        if self._profile is not None:
+            raise RuntimeError("The client is already being profiled")
+
+        profile = Profile()
+        broker = self.broker
+        self.broker = ProfilingBroker(broker, profile)
+        arena_broker = None
+        if self.arena is not None:
+            arena_broker = self.arena.broker
+            self.arena.broker = ProfilingBroker(arena_broker, profile)
+        self._profile = profile
+        try:
+            yield profile
+        finally:
+            self._profile = None
+            self.broker = broker
+            if arena_broker is not None:
+                self.arena.broker = arena_broker
+            profile.recording = False
@@ -1,6 +1,6 @@
-from collections import Iterable
+from typing import Iterable
 
-from pykeval.frontend.ctypes_shim.utils import is_pointer_type, get_pointer_address, is_struct, STRUCT_FIELD_NAME_INDEX
+from pykeval.frontend.ctypes_shim.utils import get_pointer_address, get_type_descriptor, TypeKind
 
 
 def gather_pointers(root_object, is_valid_address, state=None) -> Iterable:
@@ -17,7 +17,8 @@ def gather_pointers(root_object, is_valid_address, state=None) -> Iterable:
     if state is None:
         state = {}
 
-    if is_pointer_type(type(root_object)):
+    descriptor = get_type_descriptor(type(root_object))
+    if descriptor.kind is TypeKind.POINTER:
         address = get_pointer_address(root_object)
 
         if not is_valid_address(address) or address in state:
@@ -26,11 +27,10 @@ def gather_pointers(root_object, is_valid_address, state=None) -> Iterable:
         state[address] = root_object
         return gather_pointers(root_object.contents, is_valid_address, state)
 
-    if not is_struct(root_object):
+    if descriptor.kind is not TypeKind.STRUCT:
         return state.values()
 
-    for field in root_object._fields_:
-        field_name = field[STRUCT_FIELD_NAME_INDEX]
+    for field_name, _ in descriptor.fields:
         field_value = getattr(root_object, field_name)
         gather_pointers(field_value, is_valid_address, state)
 
@@ -1,10 +1,9 @@
 import ctypes
 from dataclasses import dataclass
-from typing import Dict
+from typing import Dict, Tuple
 
-from pykeval.frontend.ctypes_shim.utils import (is_pointer_type, is_struct, get_pointer_address,
-                                                get_struct_instance_field_type, STRUCT_FIELD_TYPE_INDEX,
-                                                STRUCT_FIELD_NAME_INDEX)
+from pykeval.frontend.ctypes_shim.utils import (get_pointer_address, get_type_descriptor, TypeKind,
+                                                STRUCT_FIELD_TYPE_INDEX, STRUCT_FIELD_NAME_INDEX)
 
 
 @dataclass
@@ -13,10 +12,16 @@ class AlteredField:
     to_type: any
 
 
+# Native types that were created, by (type, native pointer type, pack). Creating a type is slow, and the same type
+# should be used for values of the same type anyway.
+_native_types = {}  # type: Dict[Tuple[any, any, int], any]
+
+
 def get_native_type(data_type, native_pointer_type):
     """
     Gets the type that natively represents the given type.
-    This mainly replaces pointers to be their native type. For structs, a new type may be returned.
+    This mainly replaces pointers to be their native type. For structs, a new type may be returned. The same type is
+    returned every time it is requested for the same struct and native pointer type.
 
     :param data_type: A type
     :param native_pointer_type: A type that is able to represent a native pointer.
@@ -24,21 +29,40 @@ def get_native_type(data_type, native_pointer_type):
     :return: The native representation of the given type.
     """
 
-    if is_pointer_type(data_type):
+    kind = get_type_descriptor(data_type).kind
+    if kind is TypeKind.POINTER:
         return native_pointer_type
 
-    if not is_struct(data_type):
+    if kind is not TypeKind.STRUCT:
         return data_type
 
+    pack = getattr(data_type, "_pack_", ctypes.sizeof(native_pointer_type))
+    key = (data_type, native_pointer_type, pack)
+    native_type = _native_types.get(key)
+    if native_type is None:
+        # Another thread may create the same type concurrently. Either way, only the first one is ever returned.
+        native_type = _native_types.setdefault(key, _create_native_type(data_type, native_pointer_type, pack))
+
+    return native_type
+
+
+def _create_native_type(data_type, native_pointer_type, pack: int):
+    """
+    Creates the native type of a struct. See `get_native_type()`.
+
+    :param pack: The packing of the native type, if it has to be created.
+    """
+
     altered_fields = {}
     native_fields = []  # The new fields for the native struct, passed to ctypes
     for existing_field in data_type._fields_:
         field = list(existing_field)
 
-        native_field_type = get_native_type(field[STRUCT_FIELD_TYPE_INDEX], native_pointer_type)
-        if native_field_type is not field[STRUCT_FIELD_TYPE_INDEX]:
+        field_type = field[STRUCT_FIELD_TYPE_INDEX]
+        native_field_type = get_native_type(field_type, native_pointer_type)
+        if native_field_type is not field_type:
             field[STRUCT_FIELD_TYPE_INDEX] = native_field_type
-            altered_fields[field[STRUCT_FIELD_NAME_INDEX]] = AlteredField(from_type=field[STRUCT_FIELD_TYPE_INDEX],
+            altered_fields[field[STRUCT_FIELD_NAME_INDEX]] = AlteredField(from_type=field_type,
                                                                           to_type=native_field_type)
 
         native_fields.append(tuple(field))
@@ -50,14 +74,12 @@ def get_native_type(data_type, native_pointer_type):
     # Declare a new struct with the native fields.
     native_type_attributes = dict(
         _fields_=native_fields,
-        _pack_=ctypes.sizeof(native_pointer_type) if not hasattr(data_type, "_pack_") else getattr(data_type, "_pack_"),
+        _pack_=pack,
         _altered_fields=altered_fields
     )
-    native_type = type(data_type.__class__.__name__ + "_NATIVE",
-                       (ctypes.Structure,),
-                       native_type_attributes)
-
-    return native_type
+    return type(data_type.__name__ + "_NATIVE",
+                (ctypes.Structure,),
+                native_type_attributes)
 
 
 def get_as_native_value(data, native_type, local_to_native_address_map: Dict[int, int]):
@@ -71,27 +93,29 @@ def get_as_native_value(data, native_type, local_to_native_address_map: Dict[int
     :return: The native value.
     """
 
-    if is_pointer_type(type(data)):
+    descriptor = get_type_descriptor(type(data))
+    if descriptor.kind is TypeKind.POINTER:
         address = get_pointer_address(data)
         if address in local_to_native_address_map:
             address = local_to_native_address_map[address]
 
         return native_type(address)
 
-    if not is_struct(data):
+    if descriptor.kind is not TypeKind.STRUCT:
+        if descriptor.kind in (TypeKind.SCALAR, TypeKind.ARRAY):
+            # The contents of a pointer, such as `c_int` for `POINTER(c_int)`. Its type has no pointers to translate.
+            return native_type.from_buffer_copy(data)
         return native_type(data)
 
     native_value = native_type()
-    for field in data._fields_:
-        field_name = field[STRUCT_FIELD_NAME_INDEX]
-        field_type = field[STRUCT_FIELD_TYPE_INDEX]
-
+    native_field_types = get_type_descriptor(native_type).field_types
+    for field_name, field_type in descriptor.fields:
         field_value = getattr(data, field_name)
         if field_value is None:
             # Pointers are `None` if they aren't initialized.
-            assert is_pointer_type(field_type)
+            assert get_type_descriptor(field_type).kind is TypeKind.POINTER
             field_value = 0
-        field_native_type = get_struct_instance_field_type(native_value, field_name)
+        field_native_type = native_field_types[field_name]
 
         field_native_value = get_as_native_value(field_value, field_native_type, local_to_native_address_map)
         setattr(native_value, field_name, field_native_value)
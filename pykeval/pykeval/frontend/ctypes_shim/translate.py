@@ -1,13 +1,19 @@
 import ctypes
 from dataclasses import dataclass
-from typing import Tuple, List
-
-from pykeval.frontend.broker_allocation import BrokerAllocation
+from functools import partial
+from typing import Callable, List, Optional, Tuple
+
+from pykeval.broker.interface import raise_first_error
+from pykeval.broker.requests import BrokerRequest, BrokerRequestType, ReadBytes, ReadMany
+from pykeval.frontend.arena import Arena
+from pykeval.frontend.batch_steps import BatchSteps, run_steps, run_steps_async
+from pykeval.frontend.broker_allocation import BrokerAllocation, AsyncBrokerAllocation
 from pykeval.frontend.ctypes_shim.address import (get_native_pointer_type, get_is_valid_usermode_address,
                                                   get_is_kernel_address)
 from pykeval.frontend.ctypes_shim.collect import gather_pointers
 from pykeval.frontend.ctypes_shim.native import get_native_type, get_as_native_value
-from pykeval.frontend.ctypes_shim.utils import get_pointer_address, is_pointer_type
+from pykeval.frontend.ctypes_shim.utils import get_pointer_address, get_type_descriptor, is_pointer_type
+from pykeval.shared.tracing import start_span
 
 
 @dataclass
@@ -17,62 +23,161 @@ class PointerTranslationContext:
     """
 
     allocation: BrokerAllocation
+    # The offset of the pointed value in the allocation
+    offset: int
     local_pointer: any
     native_pointed_type: any
 
 
+def _get_layout(native_types: List[any]) -> Tuple[List[int], int]:
+    """
+    Lays out values of the given types one after the other, each aligned to its type.
+
+    :return: The offset of each value, and the total size.
+    """
+
+    offsets = []
+    size = 0
+    for native_type in native_types:
+        alignment = ctypes.alignment(native_type)
+        size = (size + alignment - 1) // alignment * alignment
+        offsets.append(size)
+        size += ctypes.sizeof(native_type)
+
+    return offsets, size
+
+
 class TranslatedArgs:
-    def __init__(self, broker, *args):
+    def __init__(self, broker, *args, arena: Optional[Arena] = None):
         """
         Translates arguments so they can be used natively on the broker's machine.
+        Everything a pointer argument refers to (directly or through other pointers) is laid out in a single native
+        image, which is copied to a single allocation. All allocations are made in one batch, and then all images are
+        copied in another.
 
         :param broker: A broker.
         :param args: The arguments to translate.
+        :param arena: If given, allocations are made from the arena instead of directly through the broker.
+        """
+
+        with start_span("translate_args", argument_count=len(args)) as span:
+            self._setup(broker, broker.get_pointer_size())
+            if arena is not None:
+                allocate_many_steps = arena.allocate_many_steps
+            else:
+                allocate_many_steps = partial(BrokerAllocation.allocate_many_steps, broker)
+            run_steps(self._translate_steps(args, allocate_many_steps), broker)
+            self._set_span_attributes(span)
+
+    @classmethod
+    async def create_async(cls, broker, *args) -> "TranslatedArgs":
+        """
+        Translates arguments using an `AsyncRemoteBroker`. See `__init__()`.
+        The resulting allocations are `AsyncBrokerAllocation`s, and `read_back_async()` should be used to read back.
         """
 
-        pointer_size = broker.get_pointer_size()
+        translated_args = cls.__new__(cls)
+        with start_span("translate_args", argument_count=len(args)) as span:
+            translated_args._setup(broker, await broker.get_pointer_size())
+            allocate_many_steps = partial(AsyncBrokerAllocation.allocate_many_steps, broker)
+            await run_steps_async(translated_args._translate_steps(args, allocate_many_steps), broker)
+            translated_args._set_span_attributes(span)
+        return translated_args
 
+    def _setup(self, broker, pointer_size: int):
         self._translated_args = []
+        # The number of bytes that were written to the broker's machine
+        self.bytes_marshalled = 0
 
         self._broker = broker
         self._native_pointer_type = get_native_pointer_type(pointer_size)
         self._is_valid_address = get_is_valid_usermode_address(get_is_kernel_address(pointer_size))
 
-        for arg in args:
-            self._translated_args.append(self._translate_argument(arg))
-
-    def _translate_argument(self, arg) -> Tuple[any, List[PointerTranslationContext]]:
-        contexts = []
+    def _translate_steps(self, args, allocate_many_steps: Callable[[List[int]], BatchSteps]) -> BatchSteps:
+        # 1. Collect what each argument refers to, and the native types it should be copied as.
+        gathered = [self._gather_argument(arg) for arg in args]
+
+        # 2. Lay out the native image of each argument, and allocate for the ones that need to be copied.
+        layouts = [_get_layout([native_type for _, native_type in pointers]) for pointers in gathered]
+        allocations = yield from allocate_many_steps([size for offsets, size in layouts if len(offsets) != 0])
+
+        # 3. Copy the images to the new (native) allocations
+        try:
+            remaining_allocations = iter(allocations)
+            write_requests = []
+            for arg, pointers, (offsets, _) in zip(args, gathered, layouts):
+                allocation = next(remaining_allocations) if len(offsets) != 0 else None
+                translated_arg, contexts = self._translate_argument(arg, pointers, allocation, offsets, write_requests)
+                self._translated_args.append((translated_arg, contexts))
+
+            self.bytes_marshalled = sum(len(request.data.data) for request in write_requests)
+            raise_first_error((yield write_requests))
+        except Exception:
+            yield from BrokerAllocation.free_many_steps(allocations)
+            raise
+
+    def _set_span_attributes(self, span):
+        if span.recording:
+            span.set_attributes(bytes_marshalled=self.bytes_marshalled, allocations=len(self.allocations))
+
+    def _gather_argument(self, arg) -> List[Tuple[any, any]]:
+        """
+        :return: For each value that must be copied to the broker's machine: the local pointer to it (or the bytes
+                 themselves) and its native type. The value the argument points to is first.
+        """
 
         if isinstance(arg, str):
             raise TypeError("Strings are not directly supported, please encode them.")
 
         if isinstance(arg, bytes):
-            return self._translate_bytes(arg)
+            return [(arg, ctypes.c_byte * len(arg))]
 
         if not is_pointer_type(type(arg)):
             # Currently translating only pointers, passing structs directly is not supported.
-            return arg, []
+            return []
+
+        # Collect all pointers this argument refers to (including itself).
+        return [(pointer, get_native_type(get_type_descriptor(type(pointer)).pointed_type, self._native_pointer_type))
+                for pointer in gather_pointers(arg, self._is_valid_address)]
+
+    def _translate_argument(self,
+                            arg,
+                            pointers: List[Tuple[any, any]],
+                            allocation: Optional[BrokerAllocation],
+                            offsets: List[int],
+                            write_requests: List) -> Tuple[any, List[PointerTranslationContext]]:
+        """
+        Builds the native image of the argument and prepares its write to the allocation.
 
-        # 1. Collect all pointers this argument refers to (including itself).
-        pointers = gather_pointers(arg, self._is_valid_address)
+        :param offsets: The offset of each pointed value in the image.
+        :return: The translated value of the argument and its translation contexts.
+        """
 
-        # 2. Create allocations of appropriate (native) size for each pointer's contents.
-        allocations = []  # (ctypes ptr, allocation, native type)
-        for pointer in pointers:
-            contents_native_type = get_native_type(pointer._type_, self._native_pointer_type)
-            allocation = BrokerAllocation(self._broker, ctypes.sizeof(contents_native_type))
-            allocations.append((pointer, allocation, contents_native_type))
+        if isinstance(arg, bytes):
+            write_requests.append(allocation.write_request(arg))
+            return allocation.address, [PointerTranslationContext(allocation=allocation,
+                                                                  offset=0,
+                                                                  local_pointer=None,
+                                                                  native_pointed_type=ctypes.c_byte * len(arg))]
 
-        flat_address_map = {get_pointer_address(ptr): allocation.address for ptr, allocation, _ in allocations}
+        if allocation is None:
+            # Either not a pointer, or a pointer that should be passed as is (such as NULL).
+            return (get_pointer_address(arg) if is_pointer_type(type(arg)) else arg), []
 
-        # 3. Copy the values to the new (native) allocations
-        for pointer, allocation, native_type in allocations:
+        # Internal pointers are fixed up to where their values are in the allocation.
+        flat_address_map = {get_pointer_address(pointer): allocation.address + offset
+                            for (pointer, _), offset in zip(pointers, offsets)}
+
+        image = bytearray(len(allocation))
+        contexts = []
+        for (pointer, native_type), offset in zip(pointers, offsets):
             native_value = get_as_native_value(pointer.contents, native_type, flat_address_map)
-            assert len(allocation) == ctypes.sizeof(native_value)
-            allocation.write(ctypes.string_at(ctypes.addressof(native_value), len(allocation)))
+            image[offset:offset + ctypes.sizeof(native_type)] = ctypes.string_at(ctypes.addressof(native_value),
+                                                                                 ctypes.sizeof(native_type))
 
-            contexts.append(PointerTranslationContext(allocation, pointer, native_type))
+            contexts.append(PointerTranslationContext(allocation, offset, pointer, native_type))
+
+        write_requests.append(allocation.write_request(bytes(image)))
 
         # Since the argument must be a pointer to reach here, and we have allocated for it, use the map to return its
         # allocated kernel address
@@ -80,14 +185,6 @@ class TranslatedArgs:
 
         return arg_address, contexts
 
-    def _translate_bytes(self, data: bytes) -> Tuple[int, List[PointerTranslationContext]]:
-        allocation = BrokerAllocation(self._broker, len(data))
-        allocation.write(data)
-
-        return allocation.address, [PointerTranslationContext(allocation=allocation,
-                                                              local_pointer=None,
-                                                              native_pointed_type=ctypes.c_byte * len(data))]
-
     @property
     def args(self):
         """
@@ -104,28 +201,56 @@ class TranslatedArgs:
 
         result = []
         for value, contexts in self._translated_args:
-            result.extend(context.allocation for context in contexts)
+            if len(contexts) != 0:
+                # All of the contexts of an argument share its allocation
+                result.append(contexts[0].allocation)
 
         return result
 
+    def _read_back_steps(self) -> BatchSteps:
+        # The context of the value each argument points to, if any
+        pointed_contexts = []
+        for arg, contexts in self._translated_args:
+            pointed_contexts.append(next((context for context in contexts
+                                          if context.allocation.address + context.offset == arg),
+                                         None))
+
+        # The whole image of each argument is read at once, and all images are read in a single request
+        read_contexts = [context for context in pointed_contexts if context is not None]
+        results = []
+        if len(read_contexts) != 0:
+            results, = yield [BrokerRequest(BrokerRequestType.READ_MANY,
+                                            ReadMany([ReadBytes(context.allocation.address, len(context.allocation))
+                                                      for context in read_contexts]))]
+            if isinstance(results, Exception):
+                raise results
+            raise_first_error(results)
+        image_by_context = {id(context): image for context, image in zip(read_contexts, results)}
+
+        values = []
+        for (arg, _), context in zip(self._translated_args, pointed_contexts):
+            value = arg
+            if context is not None:
+                value = context.native_pointed_type.from_buffer_copy(image_by_context[id(context)], context.offset)
+
+            values.append(value)
+
+        return values
+
     def read_back(self):
         """
-        Reads back the allocations that were made for each argument.
+        Reads back the allocations that were made for each argument, in a single batch.
 
         :return: The values of the arguments. For pointer arguments, the value of the pointer.
         """
 
-        values = []
-
-        for arg, contexts in self._translated_args:
-            value = arg
-            for context in contexts:
-                if context.allocation.address == arg:
-                    data = context.allocation.read()
-                    value = context.native_pointed_type()
-                    ctypes.memmove(ctypes.byref(value), data, len(data))
-                    break
+        with start_span("read_back_args", argument_count=len(self._translated_args)):
+            return run_steps(self._read_back_steps(), self._broker)
 
-            values.append(value)
+    async def read_back_async(self):
+        """
+        `read_back()` for arguments translated with `create_async()`.
+        """
 
-        return values
+        with start_span("read_back_args", argument_count=len(self._translated_args)):
+            return await run_steps_async(self._read_back_steps(), self._broker)
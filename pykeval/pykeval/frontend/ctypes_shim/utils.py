@@ -1,4 +1,7 @@
 import ctypes
+from dataclasses import dataclass, field
+from enum import Enum, auto
+from typing import Dict, List, Tuple
 
 """
 Utilities regarding ctypes objects.
@@ -7,14 +10,80 @@ Utilities regarding ctypes objects.
 STRUCT_FIELD_NAME_INDEX = 0
 STRUCT_FIELD_TYPE_INDEX = 1
 
+# The `_type_` codes of simple types that ctypes treats as pointers (see `cast_check_pointertype` in ctypes)
+_SIMPLE_POINTER_TYPE_CODES = "sPzUZXO"
+
+
+class TypeKind(Enum):
+    # Anything that is not one of the following, such as `bytes` or `int`
+    OTHER = 0
+    SCALAR = auto()
+    POINTER = auto()
+    STRUCT = auto()
+    ARRAY = auto()
+
+
+@dataclass
+class TypeDescriptor:
+    """
+    What the ctypes shim needs to know about a type. See `get_type_descriptor()`.
+    """
+
+    kind: TypeKind
+    # For pointers, the type they point to (None for simple pointers such as `c_void_p`)
+    pointed_type: any = None
+    # For structs (and unions), the name and type of each field, in order.
+    fields: List[Tuple[str, any]] = field(default_factory=list)
+    field_types: Dict[str, any] = field(default_factory=dict)
+
+
+# Descriptors by type. Types can't change once they are complete, so their descriptors never have to be invalidated.
+_type_descriptors = {}  # type: Dict[any, TypeDescriptor]
+
+
+def get_type_descriptor(obj_type) -> TypeDescriptor:
+    """
+    :param obj_type: A type, usually a ctypes type. Anything else is described as `TypeKind.OTHER`.
+    :return: The descriptor of the type. It is only built the first time it is requested.
+    """
+
+    if not isinstance(obj_type, type):
+        return TypeDescriptor(TypeKind.OTHER)
+
+    descriptor = _type_descriptors.get(obj_type)
+    if descriptor is not None:
+        return descriptor
+
+    descriptor = _describe(obj_type)
+    if issubclass(obj_type, (ctypes.Structure, ctypes.Union)) and not hasattr(obj_type, "_fields_"):
+        # An incomplete struct (whose fields are set after it is declared). Its descriptor may still change.
+        return descriptor
+
+    return _type_descriptors.setdefault(obj_type, descriptor)
+
+
+def _describe(obj_type) -> TypeDescriptor:
+    if issubclass(obj_type, (ctypes._Pointer, ctypes._CFuncPtr)):
+        return TypeDescriptor(TypeKind.POINTER, pointed_type=getattr(obj_type, "_type_", None))
+
+    if issubclass(obj_type, ctypes._SimpleCData):
+        if obj_type._type_ in _SIMPLE_POINTER_TYPE_CODES:
+            return TypeDescriptor(TypeKind.POINTER)
+        return TypeDescriptor(TypeKind.SCALAR)
+
+    if issubclass(obj_type, ctypes.Array):
+        return TypeDescriptor(TypeKind.ARRAY)
+
+    if issubclass(obj_type, (ctypes.Structure, ctypes.Union)) and hasattr(obj_type, "_fields_"):
+        fields = [(struct_field[STRUCT_FIELD_NAME_INDEX], struct_field[STRUCT_FIELD_TYPE_INDEX])
+                  for struct_field in obj_type._fields_]
+        return TypeDescriptor(TypeKind.STRUCT, fields=fields, field_types=dict(fields))
+
+    return TypeDescriptor(TypeKind.OTHER)
+
 
 def is_pointer_type(obj_type):
-    try:
-        # Cast only works for pointers.
-        ctypes.cast(0, obj_type)
-        return True
-    except TypeError:
-        return False
+    return get_type_descriptor(obj_type).kind is TypeKind.POINTER
 
 
 def has_address(obj):
@@ -30,7 +99,11 @@ def get_pointer_address(ptr):
 
 
 def is_struct(obj):
-    return hasattr(obj, "_fields_")
+    """
+    :param obj: A type or an instance.
+    """
+
+    return get_type_descriptor(obj if isinstance(obj, type) else type(obj)).kind is TypeKind.STRUCT
 
 
 def get_struct_instance_field_type(obj, field_name):
@@ -41,9 +114,4 @@ def get_struct_instance_field_type(obj, field_name):
     :return: The declared type of the field
     """
 
-    for field in obj._fields_:
-        current_field_name = field[0]
-        if current_field_name == field_name:
-            return field[1]
-
-    raise KeyError(field_name)
+    return get_type_descriptor(type(obj)).field_types[field_name]
@@ -0,0 +1,159 @@
+import logging
+import queue
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from pykeval.broker.requests import BrokerRequest
+
+"""
+Allocations that are garbage collected before they were freed are freed by a background thread. Freeing them right away
+would send a request from inside the garbage collector, blocking whatever code happened to trigger it (or hanging at
+shutdown, once the connection to the broker is gone).
+
+Brokers that are not thread safe are only used by the thread that made the allocation: their queued frees are sent
+once that thread starts its next client operation (see `free_owned_allocations()`), so they never race its other
+requests. If that thread exits first, the frees are dropped and the memory is not freed, so allocations made through
+such brokers on short-lived threads should be freed explicitly (or made in a `Client.session()`).
+
+Requests that are queued together are sent in a single batch per broker. Allocations that are still queued when the
+interpreter exits are not freed.
+"""
+
+logger = logging.getLogger(__name__)
+
+_queue = queue.SimpleQueue()  # `put()` is reentrant, so it is safe to call from `__del__`
+_thread = None
+_thread_lock = threading.Lock()
+
+# Frees that wait for the thread that owns their allocations. Filled by the background thread.
+_owned = {}  # type: Dict[threading.Thread, List[Tuple[any, BrokerRequest]]]
+_owned_lock = threading.Lock()
+# Holds an `_OwnerExitWatch` in each thread that owns allocations
+_owners = threading.local()
+
+
+class _OwnerExitWatch:
+    """
+    Lives in a thread that owns allocations. Once the thread exits its thread-local data is dropped, and the frees that
+    wait for it are dropped as well.
+    """
+
+    def __init__(self, thread: threading.Thread):
+        self.thread = thread
+
+    def __del__(self):
+        _queue.put((None, None, self.thread))
+
+
+def start_deferred_frees():
+    """
+    Starts the thread that frees the queued allocations, if it is not running yet. This is called whenever an
+    allocation is made, since starting a thread from inside the garbage collector is not safe.
+    """
+
+    global _thread
+    if _thread is not None:
+        return
+
+    with _thread_lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_free_queued, name="DeferredFrees", daemon=True)
+            _thread.start()
+
+
+def get_owner_thread(broker) -> Optional[threading.Thread]:
+    """
+    :return: The thread that must free allocations made through the broker, which is the current thread, or None if any
+             thread may.
+    """
+
+    if getattr(broker, "thread_safe", False):
+        return None
+
+    thread = threading.current_thread()
+    if not hasattr(_owners, "exit_watch"):
+        _owners.exit_watch = _OwnerExitWatch(thread)
+    return thread
+
+
+def defer_free(broker, request: BrokerRequest, owner_thread: Optional[threading.Thread] = None):
+    """
+    Queues a request to free memory. Does not block.
+
+    :param owner_thread: The thread that must send the request, from `get_owner_thread()`.
+    """
+
+    _queue.put((broker, request, owner_thread))
+
+
+def free_owned_allocations():
+    """
+    Frees the queued allocations that must be freed by the current thread. Called at the start of every client
+    operation, so this is cheap when nothing is queued.
+    """
+
+    if len(_owned) == 0:
+        return
+
+    with _owned_lock:
+        queued = _owned.pop(threading.current_thread(), None)
+
+    if queued is not None:
+        _free(queued)
+
+
+def _free_queued():
+    while True:
+        queued = [_queue.get()]
+        # Whatever was queued in the meantime is freed in the same batch
+        try:
+            while True:
+                queued.append(_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        free_now = []
+        for broker, request, owner_thread in queued:
+            if owner_thread is None:
+                free_now.append((broker, request))
+            elif broker is None or not owner_thread.is_alive():
+                _drop_owned(owner_thread, 0 if broker is None else 1)
+            else:
+                with _owned_lock:
+                    _owned.setdefault(owner_thread, []).append((broker, request))
+
+        _free(free_now)
+        del queued, free_now  # Don't keep the brokers alive while waiting
+
+
+def _drop_owned(owner_thread: threading.Thread, count: int):
+    """
+    Drops the frees that wait for a thread that exited.
+
+    :param count: The number of frees for the thread that were not queued for it yet.
+    """
+
+    with _owned_lock:
+        count += len(_owned.pop(owner_thread, ()))
+
+    if count != 0:
+        logger.warning(f"Not freeing {count} garbage collected allocations, since {owner_thread.name} (which must free "
+                       f"them) exited")
+
+
+def _free(queued: List[Tuple[any, BrokerRequest]]):
+    requests_by_broker = {}  # type: Dict[int, Tuple[any, List[BrokerRequest]]]
+    for broker, request in queued:
+        requests_by_broker.setdefault(id(broker), (broker, []))[1].append(request)
+
+    for broker, requests in requests_by_broker.values():
+        logger.info(f"Freeing {len(requests)} garbage collected allocations")
+        try:
+            results = broker.execute_batch(requests)
+        except Exception:
+            logger.exception("Failed to free garbage collected allocations")
+            continue
+
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning(f"Failed to free a garbage collected allocation: {result}")
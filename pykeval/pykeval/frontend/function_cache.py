@@ -1,4 +1,5 @@
 import logging
+from typing import List
 
 from pykeval.shared.ffi import FfiFunction
 
@@ -27,6 +28,9 @@ class FunctionCache:
     def get(self, module_name: str, function_name: str) -> FfiFunction:
         return self._cache[module_name][function_name]
 
+    def get_function_names(self, module_name: str) -> List[str]:
+        return list(self._cache.get(module_name, {}))
+
     def exists(self, module_name: str, function_name: str) -> bool:
         try:
             self.get(module_name, function_name)
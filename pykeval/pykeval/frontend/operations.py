@@ -0,0 +1,57 @@
+import time
+from contextvars import ContextVar
+from functools import wraps
+from typing import Optional
+
+from pykeval.frontend.deferred_free import free_owned_allocations
+from pykeval.shared.tracing import get_tracer, start_span
+
+"""
+High-level client operations (such as `ex_call` or `read_wstring`), which are profiled and traced as a whole.
+"""
+
+_current_operation = ContextVar("_current_operation", default=None)  # type: ContextVar[Optional[str]]
+
+
+def get_current_operation() -> Optional[str]:
+    """
+    :return: The outermost operation that is being profiled in this context, or None.
+    """
+
+    return _current_operation.get()
+
+
+def client_operation(operation_name: str):
+    """
+    Marks a client method as a high-level operation.
+
+    While the client is profiled, the requests the method makes are attributed to it, unless it was called by another
+    operation. While a tracer is installed, the method runs in a "client.<operation name>" span. Otherwise, this only
+    costs a couple of lookups.
+    """
+
+    span_name = f"client.{operation_name}"
+
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            free_owned_allocations()
+            profile = self._profile
+            if profile is None and get_tracer() is None:
+                return method(self, *args, **kwargs)
+
+            with start_span(span_name):
+                if profile is None or _current_operation.get() is not None:
+                    return method(self, *args, **kwargs)
+
+                token = _current_operation.set(operation_name)
+                start = time.perf_counter()
+                try:
+                    return method(self, *args, **kwargs)
+                finally:
+                    profile.record_operation(operation_name, time.perf_counter() - start)
+                    _current_operation.reset(token)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,207 @@
+import hashlib
+import json
+import logging
+import os
+import zlib
+from enum import Enum, auto
+from pathlib import Path
+from typing import List, Optional, Union
+
+from pykeval.shared.ffi import FfiType, FfiFunction, FfiNamedArgument
+
+"""
+An on-disk cache of functions parsed from C declarations, so that declaring from the same headers again doesn't need
+libclang.
+
+Entries are keyed by a hash of everything that affects the parse (the declarations themselves, the clang version and
+the parse options). The files the declarations include are recorded in the entry along with hashes of their contents,
+and an entry whose included files have changed is a miss.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the format of entries or the way functions are parsed changes
+CACHE_FORMAT_VERSION = 1
+DEFAULT_MAX_CACHE_SIZE = 64 * 1024 * 1024
+_ENTRY_SUFFIX = ".decl"
+
+
+class CacheMode(Enum):
+    # Use cached functions if there are any, and cache the functions that are parsed
+    USE = 0
+    # Parse even if there are cached functions, and cache the result
+    REFRESH = auto()
+    # Neither read nor write the cache
+    BYPASS = auto()
+
+
+def _hash_file(path: str) -> Optional[str]:
+    try:
+        return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+    except OSError:
+        return None
+
+
+def _function_to_json(function: FfiFunction) -> list:
+    return [function.name,
+            function.return_type.value,
+            [[argument.type.value, argument.name] for argument in function.arguments]]
+
+
+def _function_from_json(data: list) -> FfiFunction:
+    name, return_type, arguments = data
+    return FfiFunction(name,
+                       FfiType(return_type),
+                       [FfiNamedArgument(FfiType(argument_type), argument_name)
+                        for argument_type, argument_name in arguments])
+
+
+def get_default_cache_directory() -> Path:
+    """
+    :return: The directory in `PYKEVAL_CACHE_DIR` if it is set, or under the user's local cache directory otherwise.
+    """
+
+    if "PYKEVAL_CACHE_DIR" in os.environ:
+        return Path(os.environ["PYKEVAL_CACHE_DIR"]) / "declarations"
+
+    base = os.environ.get("LOCALAPPDATA") or Path.home() / ".cache"
+    return Path(base) / "pykeval" / "declarations"
+
+
+class ParseCache:
+    """
+    A directory of cached parse results. Once the directory grows beyond its maximal size, the least recently used
+    entries are removed.
+
+    The cache is shared safely between processes: entries are replaced atomically, and a broken entry is a miss.
+    """
+
+    def __init__(self, directory: Union[str, Path, None] = None, max_size: int = DEFAULT_MAX_CACHE_SIZE):
+        """
+        :param directory: The directory to keep the entries in. Defaults to `get_default_cache_directory()`.
+        :param max_size: The maximal total size of the entries, in bytes.
+        """
+
+        self.directory = Path(directory) if directory is not None else get_default_cache_directory()
+        self.max_size = max_size
+
+    @staticmethod
+    def get_key(*parts: Union[str, bytes]) -> str:
+        """
+        :param parts: Everything that affects the parse.
+        :return: The key of the entry of the parse.
+        """
+
+        digest = hashlib.sha256(str(CACHE_FORMAT_VERSION).encode())
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode("utf-8")
+            # Prefix each part with its size, so different splits of the same bytes don't collide
+            digest.update(len(part).to_bytes(8, "little"))
+            digest.update(part)
+
+        return digest.hexdigest()
+
+    def load(self, key: str) -> Optional[List[FfiFunction]]:
+        """
+        :return: The cached functions, or None if there is no valid entry for the key.
+        """
+
+        path = self._get_entry_path(key)
+        try:
+            entry = json.loads(zlib.decompress(path.read_bytes()))
+            functions = [_function_from_json(function) for function in entry["functions"]]
+            includes = entry["includes"]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError, zlib.error) as e:
+            logger.warning(f"Ignoring a broken declarations cache entry {path}: {e}")
+            return None
+
+        for include_path, include_hash in includes:
+            if _hash_file(include_path) != include_hash:
+                logger.debug(f"Declarations cache entry {key} is stale, {include_path} has changed")
+                return None
+
+        try:
+            # Marks the entry as recently used
+            os.utime(path)
+        except OSError:
+            pass
+
+        return functions
+
+    def store(self, key: str, functions: List[FfiFunction], included_paths: List[str]):
+        """
+        Caches functions. Failures are logged rather than raised, since the cache is only an optimization.
+
+        :param included_paths: The files that were included by the parsed declarations.
+        """
+
+        includes = []
+        for include_path in included_paths:
+            include_hash = _hash_file(include_path)
+            if include_hash is None:
+                logger.debug(f"Not caching declarations that include {include_path}, which can't be read")
+                return
+            includes.append([include_path, include_hash])
+
+        data = zlib.compress(json.dumps({"functions": [_function_to_json(function) for function in functions],
+                                         "includes": includes},
+                                        separators=(",", ":")).encode("utf-8"))
+
+        import tempfile  # Only needed after parsing, which is much slower than importing it
+
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(file_descriptor, "wb") as temp_file:
+                    temp_file.write(data)
+                os.replace(temp_path, self._get_entry_path(key))
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+
+            self._evict()
+        except OSError as e:
+            logger.warning(f"Failed to cache declarations in {self.directory}: {e}")
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+
+        for path in self.directory.glob(f"*{_ENTRY_SUFFIX}"):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def _get_entry_path(self, key: str) -> Path:
+        return self.directory / (key + _ENTRY_SUFFIX)
+
+    def _evict(self):
+        """
+        Removes the least recently used entries until the cache fits its maximal size.
+        """
+
+        entries = []
+        for path in self.directory.glob(f"*{_ENTRY_SUFFIX}"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total_size -= size
+            logger.debug(f"Evicted declarations cache entry {path.name}")
@@ -1,12 +1,32 @@
 import logging
-from typing import List
-
-from clang.cindex import Index, Cursor, TypeKind, Type, TranslationUnit
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
 
+from pykeval.frontend.parse_cache import ParseCache, CacheMode
 from pykeval.shared.ffi import FfiType, FfiFunction, FfiNamedArgument
 
+# libclang is only imported once something is actually parsed, since importing it is slow and declarations are often
+# cached.
+if TYPE_CHECKING:
+    from clang.cindex import Cursor, Type
+
 logger = logging.getLogger(__name__)
 
+# Describes the options declarations are parsed with, for the cache key
+_PARSE_OPTIONS_DESCRIPTION = "skip-function-bodies"
+# The name C strings are parsed under. Its extension determines the language.
+_STRING_HEADER_NAME = "header.hpp"
+
+
+def _get_clang_version() -> str:
+    from importlib.metadata import version, PackageNotFoundError
+
+    try:
+        return version("libclang")
+    except PackageNotFoundError:
+        return "unknown"
+
 
 class CParser:
     """
@@ -14,25 +34,81 @@ class CParser:
     """
 
     @staticmethod
-    def get_functions_from_c_header(header_file_path) -> List[FfiFunction]:
-        index = Index.create()
-        translation_unit = index.parse(header_file_path, options=TranslationUnit.PARSE_SKIP_FUNCTION_BODIES)
-        root = translation_unit.cursor
+    def get_functions_from_c_header(header_file_path,
+                                    cache: Optional[ParseCache] = None,
+                                    cache_mode: CacheMode = CacheMode.USE) -> List[FfiFunction]:
+        """
+        :param cache: The cache to use for the parse, or None to not cache it.
+        :param cache_mode: How to use the cache.
+        """
+
+        header_path = Path(header_file_path).resolve()
+        # Includes are resolved relative to the header, so its location is part of the key
+        return CParser._parse_cached(lambda: CParser._parse(str(header_file_path)),
+                                     cache,
+                                     cache_mode,
+                                     lambda: [str(header_path), header_path.read_bytes()])
 
-        return CParser._translation_unit_to_ffi_functions(root)
+    @staticmethod
+    def get_functions_from_c_string(c_string: str,
+                                    cache: Optional[ParseCache] = None,
+                                    cache_mode: CacheMode = CacheMode.USE) -> List[FfiFunction]:
+        """
+        :param cache: The cache to use for the parse, or None to not cache it.
+        :param cache_mode: How to use the cache.
+        """
+
+        # Includes are resolved relative to the working directory, so it is part of the key
+        return CParser._parse_cached(lambda: CParser._parse(_STRING_HEADER_NAME,
+                                                            unsaved_files=[(_STRING_HEADER_NAME, c_string)]),
+                                     cache,
+                                     cache_mode,
+                                     lambda: [_STRING_HEADER_NAME, os.getcwd(), c_string])
 
     @staticmethod
-    def get_functions_from_c_string(c_string: str) -> List[FfiFunction]:
+    def _parse_cached(parse: Callable[[], Tuple[List[FfiFunction], List[str]]],
+                      cache: Optional[ParseCache],
+                      cache_mode: CacheMode,
+                      get_key_parts: Callable[[], list]) -> List[FfiFunction]:
+        """
+        :param parse: Parses the declarations. Returns the functions and the files that were included.
+        :param get_key_parts: Returns what identifies the declarations, for the cache key.
+        """
+
+        if cache is None or cache_mode is CacheMode.BYPASS:
+            return parse()[0]
+
+        key = ParseCache.get_key(_get_clang_version(), _PARSE_OPTIONS_DESCRIPTION, *get_key_parts())
+        if cache_mode is CacheMode.USE:
+            functions = cache.load(key)
+            if functions is not None:
+                logger.debug(f"Loaded {len(functions)} cached functions")
+                return functions
+
+        functions, included_paths = parse()
+        cache.store(key, functions, included_paths)
+        return functions
+
+    @staticmethod
+    def _parse(path: str, unsaved_files=None) -> Tuple[List[FfiFunction], List[str]]:
+        """
+        :return: The functions that are declared, and the files that were included.
+        """
+
+        from clang.cindex import Index, TranslationUnit
+
         index = Index.create()
-        translation_unit = index.parse("header.hpp",
-                                       unsaved_files=[("header.hpp", c_string)],
+        translation_unit = index.parse(path,
+                                       unsaved_files=unsaved_files,
                                        options=TranslationUnit.PARSE_SKIP_FUNCTION_BODIES)
         root = translation_unit.cursor
 
-        return CParser._translation_unit_to_ffi_functions(root)
+        functions = CParser._translation_unit_to_ffi_functions(root)
+        included_paths = sorted({inclusion.include.name for inclusion in translation_unit.get_includes()})
+        return functions, included_paths
 
     @staticmethod
-    def _translation_unit_to_ffi_functions(root: Cursor) -> List[FfiFunction]:
+    def _translation_unit_to_ffi_functions(root: "Cursor") -> List[FfiFunction]:
         functions = []
         for node in root.get_children():  # TODO: does this need to be recursive?
             try:
@@ -47,7 +123,7 @@ class CParser:
         return functions
 
     @staticmethod
-    def _create_ffi_function(cursor: Cursor) -> FfiFunction:
+    def _create_ffi_function(cursor: "Cursor") -> FfiFunction:
         name = cursor.spelling
         canonical_return_type = cursor.result_type.get_canonical()
         arguments = cursor.get_arguments()
@@ -62,42 +138,53 @@ class CParser:
         return FfiFunction(name, ffi_return_type, ffi_arguments)
 
 
-_CLANG_TYPE_TO_FFI_TYPE_MAP = {
-    TypeKind.ATOMIC: FfiType.POINTER,  # Assuming atomic is sized as size_t
-    TypeKind.BOOL: FfiType.UINT8,
-    TypeKind.CHAR_S: FfiType.SCHAR,
-    TypeKind.CHAR_U: FfiType.UCHAR,
-    TypeKind.CHAR16: FfiType.UINT16,
-    TypeKind.CHAR32: FfiType.UINT32,
-    TypeKind.DOUBLE: FfiType.DOUBLE,
-    TypeKind.FLOAT: FfiType.FLOAT,
-    TypeKind.INT: FfiType.SINT,
-    TypeKind.LONG: FfiType.SLONG,
-    TypeKind.LONGLONG: FfiType.SINT64,  # Assuming MSVC
-    TypeKind.NULLPTR: FfiType.POINTER,
-    TypeKind.POINTER: FfiType.POINTER,
-    TypeKind.SCHAR: FfiType.SCHAR,
-    TypeKind.SHORT: FfiType.SSHORT,
-    TypeKind.UCHAR: FfiType.UCHAR,
-    TypeKind.UINT: FfiType.UINT,
-    TypeKind.ULONG: FfiType.ULONG,
-    TypeKind.ULONGLONG: FfiType.UINT64,  # Assuming MSVC
-    TypeKind.USHORT: FfiType.USHORT,
-    TypeKind.VOID: FfiType.VOID,
-    TypeKind.WCHAR: FfiType.UINT16  # Assuming MSVC
-}
-
-
-def translate_clang_type_to_ffi_type(clang_type: Type) -> FfiType:
+_clang_type_to_ffi_type_map = None  # type: Optional[Dict[any, FfiType]]
+
+
+def _get_clang_type_to_ffi_type_map() -> Dict[any, FfiType]:
+    global _clang_type_to_ffi_type_map
+    if _clang_type_to_ffi_type_map is None:
+        from clang.cindex import TypeKind
+
+        _clang_type_to_ffi_type_map = {
+            TypeKind.ATOMIC: FfiType.POINTER,  # Assuming atomic is sized as size_t
+            TypeKind.BOOL: FfiType.UINT8,
+            TypeKind.CHAR_S: FfiType.SCHAR,
+            TypeKind.CHAR_U: FfiType.UCHAR,
+            TypeKind.CHAR16: FfiType.UINT16,
+            TypeKind.CHAR32: FfiType.UINT32,
+            TypeKind.DOUBLE: FfiType.DOUBLE,
+            TypeKind.FLOAT: FfiType.FLOAT,
+            TypeKind.INT: FfiType.SINT,
+            TypeKind.LONG: FfiType.SLONG,
+            TypeKind.LONGLONG: FfiType.SINT64,  # Assuming MSVC
+            TypeKind.NULLPTR: FfiType.POINTER,
+            TypeKind.POINTER: FfiType.POINTER,
+            TypeKind.SCHAR: FfiType.SCHAR,
+            TypeKind.SHORT: FfiType.SSHORT,
+            TypeKind.UCHAR: FfiType.UCHAR,
+            TypeKind.UINT: FfiType.UINT,
+            TypeKind.ULONG: FfiType.ULONG,
+            TypeKind.ULONGLONG: FfiType.UINT64,  # Assuming MSVC
+            TypeKind.USHORT: FfiType.USHORT,
+            TypeKind.VOID: FfiType.VOID,
+            TypeKind.WCHAR: FfiType.UINT16  # Assuming MSVC
+        }
+
+    return _clang_type_to_ffi_type_map
+
+
+def translate_clang_type_to_ffi_type(clang_type: "Type") -> FfiType:
     """
     :raises KeyError if the clang type can't be represented as an FFI type.
     """
 
-    if clang_type.kind not in _CLANG_TYPE_TO_FFI_TYPE_MAP:
+    clang_type_to_ffi_type_map = _get_clang_type_to_ffi_type_map()
+    if clang_type.kind not in clang_type_to_ffi_type_map:
         message = f"Type '{clang_type.spelling}' could not be resolved ({clang_type.kind})"
-        if clang_type.kind is TypeKind.RECORD:
+        if clang_type.kind.name == "RECORD":
             message += ". Please note that struct definitions are currently not supported."
 
         raise KeyError(message)
 
-    return _CLANG_TYPE_TO_FFI_TYPE_MAP[clang_type.kind]
+    return clang_type_to_ffi_type_map[clang_type.kind]
@@ -0,0 +1,92 @@
+from typing import List
+
+from pykeval.broker.requests import CallFunction, CallAddress
+from pykeval.shared.ffi import FfiArgument, FfiFunction
+
+
+class PreparedFunction:
+    """
+    A declared function bound to a client, created by `prepare()`. Calling it is like calling `call()` on the client
+    (so for an `AsyncClient`, it returns a coroutine), and `ex_call()` is like the client's `ex_call()`.
+
+    The signature is resolved once, when the function is prepared, which saves looking it up on every call.
+    Declaring the function again does not affect functions that were already prepared.
+    """
+
+    def __init__(self, client, module_name: str, function: FfiFunction):
+        """
+        :param client: The client to call the function with.
+        :param module_name: The name of the function's module.
+        :param function: The declaration of the function.
+        """
+
+        self.client = client
+        self.module_name = module_name
+        self.function = function
+        self._argument_types = [argument.type for argument in function.arguments]
+
+    @property
+    def name(self) -> str:
+        return self.function.name
+
+    def create_request(self, args) -> CallFunction:
+        """
+        :return: A request to call the function with the given arguments.
+        """
+
+        return CallFunction(self.module_name, self.function.name, self.function.return_type, self._get_arguments(args))
+
+    def create_address_request(self, address: int, args) -> CallAddress:
+        """
+        :param address: The address the function was resolved to.
+        :return: A request to call the function by its address with the given arguments.
+        """
+
+        return CallAddress(address, self.function.return_type, self._get_arguments(args))
+
+    def _get_arguments(self, args) -> List[FfiArgument]:
+        if len(args) != len(self._argument_types):
+            raise TypeError(f"{self.function.name}() takes exactly {len(self._argument_types)} arguments "
+                            f"({len(args)} given)")
+
+        return list(map(FfiArgument, self._argument_types, args))
+
+    def __call__(self, *args, **kwargs):
+        return self.client._call_prepared(self, args, **kwargs)
+
+    def ex_call(self, *args, **kwargs):
+        return self.client._ex_call_prepared(self, args, **kwargs)
+
+    def __repr__(self):
+        return f"<PreparedFunction {self.module_name}!{self.function.name}>"
+
+
+class ModuleProxy:
+    """
+    Exposes the functions that are declared in a module as attributes, created by `module()`. For example:
+
+        nt = client.module("ntoskrnl")
+        nt.RtlInitUnicodeString.ex_call(ctypes.pointer(string), "Hello\\0".encode("UTF-16LE"))
+
+    Each attribute is the function's `PreparedFunction`. Functions that are declared after the proxy is created are
+    available through it as well.
+    """
+
+    def __init__(self, client, module_name: str):
+        self._client = client
+        self._module_name = module_name
+
+    def __getattr__(self, name: str) -> PreparedFunction:
+        if name.startswith("__"):
+            raise AttributeError(name)
+
+        try:
+            return self._client.prepare(self._module_name, name)
+        except KeyError:
+            raise AttributeError(f"{self._module_name}!{name} is not declared") from None
+
+    def __dir__(self) -> List[str]:
+        return self._client._function_cache.get_function_names(self._module_name)
+
+    def __repr__(self):
+        return f"<ModuleProxy {self._module_name}>"
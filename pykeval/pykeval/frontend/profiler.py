@@ -0,0 +1,306 @@
+import threading
+import time
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from pykeval.broker.interface import Broker
+from pykeval.broker.messaging import LENGTH_PREFIX_SIZE
+from pykeval.broker.remote_protocol import encode_request_parts, encode_response_parts
+from pykeval.broker.requests import BrokerRequest, BrokerRequestType, BrokerResponse, BrokerResponseType, Batch
+from pykeval.frontend.operations import get_current_operation
+
+"""
+Profiling of the requests a client makes, created by `Client.profile()`.
+
+Every request is measured as if it went over the remote protocol: its size is the size of its encoded message (before
+it is compressed), whatever the broker actually is. Requests are attributed to the outermost client operation (such as
+`ex_call` or `read_wstring`) they were made by, so the cost of an operation includes the requests of the operations it
+is built on.
+"""
+
+# The upper bounds of the buckets of latency histograms, in seconds. The last bucket has no upper bound.
+LATENCY_BUCKETS = (50e-6, 100e-6, 250e-6, 500e-6,
+                   1e-3, 2.5e-3, 5e-3, 10e-3, 25e-3, 50e-3, 100e-3, 250e-3, 500e-3,
+                   1.0)
+# The operation requests that aren't made by a client operation (such as deferred frees) are attributed to
+NO_OPERATION = "(other)"
+
+
+def _get_size(parts: tuple) -> int:
+    return sum(len(part) for part in parts)
+
+
+def _format_latency(seconds: float) -> str:
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.0f}us"
+    if seconds < 1:
+        return f"{seconds * 1e3:.1f}ms"
+    return f"{seconds:.2f}s"
+
+
+@dataclass
+class RequestStatistics:
+    """
+    The statistics of the requests of a single type.
+
+    Requests that are part of a batch are counted under their own type, but their bytes and their latency are recorded
+    under `BATCH`, since the whole batch takes a single round trip.
+    """
+
+    count: int = 0
+    round_trips: int = 0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    # The total latency of the round trips, in seconds
+    total_time: float = 0
+    # The number of round trips whose latency fell in each of `LATENCY_BUCKETS`, with one more bucket for the rest
+    latency_histogram: List[int] = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+
+    def add_round_trip(self, bytes_sent: int, bytes_received: int, latency: float):
+        self.count += 1
+        self.round_trips += 1
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        self.total_time += latency
+        self.latency_histogram[bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def get_latency_percentile(self, percentile: float) -> Optional[float]:
+        """
+        :param percentile: The percentile, between 0 and 100.
+        :return: The upper bound of the bucket the percentile falls in (which is approximate, since only buckets are
+                 kept), the maximal bucket's lower bound if it falls beyond it, or None if there were no round trips.
+        """
+
+        if self.round_trips == 0:
+            return None
+
+        threshold = self.round_trips * percentile / 100
+        seen = 0
+        for index, count in enumerate(self.latency_histogram):
+            seen += count
+            if seen >= threshold and count != 0:
+                return LATENCY_BUCKETS[min(index, len(LATENCY_BUCKETS) - 1)]
+
+        return LATENCY_BUCKETS[-1]
+
+
+@dataclass
+class OperationStatistics:
+    """
+    The totals of a high-level client operation, such as `ex_call`.
+    """
+
+    # The number of times the operation was done
+    count: int = 0
+    round_trips: int = 0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    # The total time spent in the operation, including the time spent in the client, in seconds
+    total_time: float = 0
+
+
+class Profile:
+    """
+    The requests a client made while it was profiled, by request type and by the client operation that made them.
+    The profile may be inspected while it is being recorded.
+    """
+
+    def __init__(self):
+        self.requests = {}  # type: Dict[BrokerRequestType, RequestStatistics]
+        self.operations = {}  # type: Dict[str, OperationStatistics]
+        # Whether requests are still recorded. Allocations made while profiling may still free themselves afterwards.
+        self.recording = True
+        self._lock = threading.Lock()
+
+    def record_round_trip(self,
+                          request_type: BrokerRequestType,
+                          bytes_sent: int,
+                          bytes_received: int,
+                          latency: float,
+                          batched_types: List[BrokerRequestType] = ()):
+        """
+        :param batched_types: If the round trip was a batch, the types of the requests in it.
+        """
+
+        operation_name = get_current_operation() or NO_OPERATION
+        with self._lock:
+            if not self.recording:
+                return
+
+            self._get_request_statistics(request_type).add_round_trip(bytes_sent, bytes_received, latency)
+            for batched_type in batched_types:
+                self._get_request_statistics(batched_type).count += 1
+
+            operation = self._get_operation_statistics(operation_name)
+            operation.round_trips += 1
+            operation.bytes_sent += bytes_sent
+            operation.bytes_received += bytes_received
+            if operation_name == NO_OPERATION:
+                operation.count += 1
+                operation.total_time += latency
+
+    def record_operation(self, operation_name: str, duration: float):
+        with self._lock:
+            if not self.recording:
+                return
+
+            operation = self._get_operation_statistics(operation_name)
+            operation.count += 1
+            operation.total_time += duration
+
+    def to_dict(self) -> dict:
+        """
+        :return: The profile as plain values that can be serialized as JSON. Request types are keyed by their name.
+        """
+
+        with self._lock:
+            return {
+                "latency_buckets": list(LATENCY_BUCKETS),
+                "requests": {request_type.name: vars(statistics).copy()
+                             for request_type, statistics in self.requests.items()},
+                "operations": {name: vars(statistics).copy() for name, statistics in self.operations.items()},
+            }
+
+    def report(self) -> str:
+        """
+        :return: A table of the request types and a table of the operations, each sorted by the time spent in them.
+                 Latency percentiles are the upper bounds of their histogram buckets.
+        """
+
+        with self._lock:
+            requests = sorted(self.requests.items(), key=lambda item: (-item[1].total_time, -item[1].count))
+            operations = sorted(self.operations.items(), key=lambda item: (-item[1].total_time, -item[1].count))
+
+        lines = [f"{'request':<18}{'count':>8}{'trips':>8}{'sent':>11}{'received':>11}"
+                 f"{'total':>10}{'mean':>10}{'p50':>10}{'p99':>10}"]
+        for request_type, statistics in requests:
+            if statistics.round_trips != 0:
+                timing = (f"{_format_latency(statistics.total_time):>10}"
+                          f"{_format_latency(statistics.total_time / statistics.round_trips):>10}"
+                          f"{'<' + _format_latency(statistics.get_latency_percentile(50)):>10}"
+                          f"{'<' + _format_latency(statistics.get_latency_percentile(99)):>10}")
+            else:
+                timing = f"{'-':>10}" * 4
+            lines.append(f"{request_type.name:<18}{statistics.count:>8}{statistics.round_trips:>8}"
+                         f"{statistics.bytes_sent:>11}{statistics.bytes_received:>11}{timing}")
+
+        lines.append("")
+        lines.append(f"{'operation':<26}{'count':>8}{'trips':>8}{'sent':>11}{'received':>11}{'total':>10}{'mean':>10}")
+        for name, statistics in operations:
+            mean = _format_latency(statistics.total_time / statistics.count) if statistics.count != 0 else "-"
+            lines.append(f"{name:<26}{statistics.count:>8}{statistics.round_trips:>8}"
+                         f"{statistics.bytes_sent:>11}{statistics.bytes_received:>11}"
+                         f"{_format_latency(statistics.total_time):>10}{mean:>10}")
+
+        return "\n".join(lines)
+
+    def print_report(self):
+        print(self.report())
+
+    def _get_request_statistics(self, request_type: BrokerRequestType) -> RequestStatistics:
+        statistics = self.requests.get(request_type)
+        if statistics is None:
+            statistics = self.requests[request_type] = RequestStatistics()
+        return statistics
+
+    def _get_operation_statistics(self, operation_name: str) -> OperationStatistics:
+        statistics = self.operations.get(operation_name)
+        if statistics is None:
+            statistics = self.operations[operation_name] = OperationStatistics()
+        return statistics
+
+    def __repr__(self):
+        return f"<Profile of {sum(statistics.round_trips for statistics in self.requests.values())} round trips>"
+
+
+class ProfilingBroker(Broker):
+    """
+    Passes requests to another broker, and records each of them in a profile.
+    """
+
+    def __init__(self, broker: Broker, profile: Profile):
+        self.broker = broker
+        self.profile = profile
+
+    @property
+    def thread_safe(self) -> bool:
+        return self.broker.thread_safe
+
+    def get_pointer_size(self) -> int:
+        return self.broker.get_pointer_size()
+
+    def call_function(self, request_data):
+        return self._forward(BrokerRequestType.CALL_FUNCTION, request_data, self.broker.call_function)
+
+    def resolve_routine(self, request_data):
+        return self._forward(BrokerRequestType.RESOLVE_ROUTINE, request_data, self.broker.resolve_routine)
+
+    def call_address(self, request_data):
+        return self._forward(BrokerRequestType.CALL_ADDRESS, request_data, self.broker.call_address)
+
+    def read_bytes(self, request_data):
+        return self._forward(BrokerRequestType.READ_BYTES, request_data, self.broker.read_bytes)
+
+    def read_into(self, request_data, buffer):
+        return self._forward(BrokerRequestType.READ_BYTES,
+                             request_data,
+                             lambda data: self.broker.read_into(data, buffer),
+                             get_response_data=lambda result: memoryview(buffer).cast("B")[:request_data.size])
+
+    def read_until(self, request_data):
+        return self._forward(BrokerRequestType.READ_UNTIL, request_data, self.broker.read_until)
+
+    def write_bytes(self, request_data):
+        return self._forward(BrokerRequestType.WRITE_BYTES, request_data, self.broker.write_bytes)
+
+    def read_many(self, request_data):
+        return self._forward(BrokerRequestType.READ_MANY, request_data, self.broker.read_many)
+
+    def write_many(self, request_data):
+        return self._forward(BrokerRequestType.WRITE_MANY, request_data, self.broker.write_many)
+
+    def allocate(self, request_data):
+        return self._forward(BrokerRequestType.ALLOCATE, request_data, self.broker.allocate)
+
+    def free(self, request_data):
+        return self._forward(BrokerRequestType.FREE, request_data, self.broker.free)
+
+    def execute_batch(self, requests: List[BrokerRequest]) -> List[any]:
+        return self._forward(BrokerRequestType.BATCH,
+                             Batch(requests),
+                             lambda batch: self.broker.execute_batch(batch.requests),
+                             [request.type for request in requests])
+
+    def _forward(self,
+                 request_type: BrokerRequestType,
+                 request_data,
+                 method: Callable,
+                 batched_types: List[BrokerRequestType] = (),
+                 get_response_data: Callable[[any], any] = None) -> any:
+        """
+        :param get_response_data: Returns the data that would be sent in response to the request, if it isn't the
+                                  result of the method.
+        """
+
+        start = time.perf_counter()
+        try:
+            result = method(request_data)
+            response_data = get_response_data(result) if get_response_data is not None else result
+            response = BrokerResponse(BrokerResponseType.SUCCESS, response_data)
+        except Exception as e:
+            response = BrokerResponse(BrokerResponseType.EXCEPTION, e)
+            raise
+        finally:
+            latency = time.perf_counter() - start
+            # Encoding is left out of the latency, since it isn't part of the request when the broker is local.
+            # Only the parts are encoded, so bulk data isn't copied to be measured.
+            self.profile.record_round_trip(
+                request_type,
+                LENGTH_PREFIX_SIZE + _get_size(encode_request_parts(0, BrokerRequest(request_type, request_data))),
+                LENGTH_PREFIX_SIZE + _get_size(encode_response_parts(0, response)),
+                latency,
+                batched_types)
+
+        return result
+
@@ -0,0 +1,74 @@
+from contextvars import ContextVar
+from typing import List, Optional
+
+from pykeval.frontend.batch_steps import BatchSteps
+from pykeval.frontend.broker_allocation import BrokerAllocation
+
+_current_session = ContextVar("_current_session", default=None)  # type: ContextVar[Optional[AllocationSession]]
+
+
+class AllocationSession:
+    """
+    Tracks the allocations a client makes, so they can all be freed at once in a single batch.
+    Sessions are created by `Client.session()` and `AsyncClient.session()`.
+    """
+
+    def __init__(self, owner):
+        """
+        :param owner: The client the session tracks the allocations of.
+        """
+
+        self.owner = owner
+        self.parent = None  # type: Optional[AllocationSession]
+        self._allocations = []  # type: List[BrokerAllocation]
+        self._token = None
+
+    @property
+    def allocations(self) -> List[BrokerAllocation]:
+        """
+        :return: The allocations that will be freed when the session ends.
+        """
+
+        return list(self._allocations)
+
+    def track(self, allocations: List[BrokerAllocation]):
+        self._allocations.extend(allocations)
+
+    def keep(self, allocation: BrokerAllocation):
+        """
+        Stops tracking an allocation, so it outlives the session. It should then be freed explicitly.
+        """
+
+        self._allocations.remove(allocation)
+
+    def free_steps(self) -> BatchSteps:
+        """
+        Frees all of the tracked allocations that were not freed yet.
+        """
+
+        allocations, self._allocations = self._allocations, []
+        yield from BrokerAllocation.free_many_steps(allocations)
+
+    def enter(self):
+        """
+        Makes this the session of the current context (thread or task), until `exit()`.
+        """
+
+        self.parent = _current_session.get()
+        self._token = _current_session.set(self)
+
+    def exit(self):
+        _current_session.reset(self._token)
+
+
+def track_allocations(owner, allocations: List[BrokerAllocation]):
+    """
+    Tracks allocations by the innermost session of the given client in the current context, if there is one.
+    """
+
+    session = _current_session.get()
+    while session is not None and session.owner is not owner:
+        session = session.parent
+
+    if session is not None:
+        session.track(allocations)
@@ -0,0 +1,76 @@
+import ctypes
+from typing import List
+
+from pykeval.broker.interface import raise_first_error
+from pykeval.broker.requests import BrokerRequest, BrokerRequestType, ReadBytes, ReadUntil
+from pykeval.frontend.batch_steps import BatchSteps
+from pykeval.frontend.ctypes_shim.address import get_native_pointer_type
+
+"""
+Reading strings from the broker's machine. Many strings are read in a single batch.
+"""
+
+# The maximal number of characters read from a NUL-terminated string
+DEFAULT_MAX_STRING_LENGTH = 0x8000
+
+ASCII_TERMINATOR = b"\0"
+WIDE_TERMINATOR = b"\0\0"
+
+_unicode_string_types = {}
+
+
+def get_unicode_string_type(pointer_size: int):
+    """
+    :return: A ctypes structure with the layout of `UNICODE_STRING` on a machine with the given pointer size.
+    """
+
+    if pointer_size not in _unicode_string_types:
+        class UNICODE_STRING(ctypes.Structure):
+            _fields_ = [
+                ("Length", ctypes.c_uint16),
+                ("MaximumLength", ctypes.c_uint16),
+                ("Buffer", get_native_pointer_type(pointer_size)),
+            ]
+
+        _unicode_string_types[pointer_size] = UNICODE_STRING
+
+    return _unicode_string_types[pointer_size]
+
+
+def read_terminated_steps(addresses: List[int], terminator: bytes, max_length: int) -> BatchSteps:
+    """
+    Reads NUL-terminated strings.
+
+    :param max_length: The maximal number of characters to read from each string. Longer strings are truncated.
+    :return: The raw data of each string, without the terminator.
+    """
+
+    results = yield [BrokerRequest(BrokerRequestType.READ_UNTIL,
+                                   ReadUntil(address, terminator, max_length * len(terminator)))
+                     for address in addresses]
+    raise_first_error(results)
+    return results
+
+
+def read_unicode_strings_steps(addresses: List[int], pointer_size: int) -> BatchSteps:
+    """
+    Reads `UNICODE_STRING` structures and the strings they describe: first all of the structures and then all of the
+    buffers.
+
+    :return: The strings.
+    """
+
+    unicode_string_type = get_unicode_string_type(pointer_size)
+    results = yield [BrokerRequest(BrokerRequestType.READ_BYTES, ReadBytes(address, ctypes.sizeof(unicode_string_type)))
+                     for address in addresses]
+    raise_first_error(results)
+    headers = [unicode_string_type.from_buffer_copy(data) for data in results]
+
+    # Empty strings may have a NULL buffer, so they are not read at all
+    non_empty = [header for header in headers if header.Length != 0]
+    results = yield [BrokerRequest(BrokerRequestType.READ_BYTES, ReadBytes(header.Buffer, header.Length))
+                     for header in non_empty]
+    raise_first_error(results)
+    data_by_header = {id(header): data for header, data in zip(non_empty, results)}
+
+    return [data_by_header[id(header)].decode("utf-16-le") if header.Length != 0 else "" for header in headers]
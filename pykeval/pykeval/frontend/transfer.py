@@ -0,0 +1,384 @@
+import logging
+import time
+from collections import deque
+from contextvars import copy_context
+from dataclasses import dataclass, field
+from typing import Callable, Iterator, List, Optional
+
+from pykeval.broker.interface import Broker
+from pykeval.broker.read_until import PAGE_SIZE
+from pykeval.broker.requests import ReadBytes, ReadMany, WriteBytes, as_buffer
+from pykeval.shared.tracing import start_span
+
+"""
+Bulk transfers of large memory regions, such as dumping a driver image or uploading a large buffer.
+
+The region is transferred in chunks, with several chunks in flight at once (over brokers that allow concurrent
+requests), while the chunks are consumed in order. Unless a chunk size is forced, it adapts to the observed throughput:
+it grows while growing it makes the transfer faster.
+"""
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 0x10000
+MIN_CHUNK_SIZE = PAGE_SIZE
+MAX_CHUNK_SIZE = 0x400000
+# The number of chunks in flight at once
+DEFAULT_WINDOW = 4
+
+# Chunks that take longer than this are halved, so a slow link doesn't hit request timeouts
+_MAX_CHUNK_TIME = 1.0
+# The factor a larger chunk size must improve throughput by to be kept
+_GROWTH_THRESHOLD = 1.1
+
+
+@dataclass
+class SkippedRange:
+    """
+    A range of memory that couldn't be read, and was filled with zeros instead.
+    """
+
+    address: int
+    size: int
+    error: Exception
+
+
+@dataclass
+class DumpChunk:
+    """
+    A chunk of a dump, as yielded by `Client.iter_dump()`.
+    """
+
+    address: int
+    # The data of the chunk. Unreadable ranges in it are zeros.
+    data: bytearray
+    # The ranges in the chunk that couldn't be read
+    skipped: List[SkippedRange] = field(default_factory=list)
+
+
+@dataclass
+class TransferReport:
+    """
+    The outcome of `Client.dump()` or `Client.upload()`.
+    """
+
+    address: int
+    size: int
+    chunks: int = 0
+    # The time the transfer took, in seconds
+    elapsed: float = 0
+    # The ranges that couldn't be read, in order. Always empty for uploads.
+    skipped: List[SkippedRange] = field(default_factory=list)
+
+    @property
+    def bytes_skipped(self) -> int:
+        return sum(skipped_range.size for skipped_range in self.skipped)
+
+    @property
+    def throughput(self) -> float:
+        """
+        :return: The transfer rate in bytes per second.
+        """
+
+        return self.size / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class UploadError(Exception):
+    """
+    Raised when a chunk of an upload fails to be written. The error of the chunk is the cause of this exception.
+    """
+
+    def __init__(self, report: TransferReport):
+        """
+        :param report: The report of the upload so far. Its size is the number of bytes from the start of the upload
+                       that are known to be written.
+        """
+
+        self.report = report
+
+    def __str__(self):
+        return (f"Upload to {self.report.address:#x} failed after writing {self.report.size:#x} bytes: "
+                f"{self.__cause__}")
+
+
+class _ChunkSizer:
+    """
+    Picks the size of the next chunk.
+
+    Each size is tried for a full window of chunks. The size is doubled as long as doing so improves throughput, and
+    goes back to the best size it saw once it stops improving. Chunks that take too long halve the size.
+    """
+
+    def __init__(self, chunk_size: int, window: int, adaptive: bool):
+        self.chunk_size = chunk_size
+        self._window = window
+        self._adaptive = adaptive
+        self._best_size = chunk_size
+        self._best_throughput = 0.0
+        self._settled = not adaptive
+        self._round_start = time.perf_counter()
+        self._round_bytes = 0
+        self._round_chunks = 0
+
+    def record(self, size: int, elapsed: float):
+        """
+        Records a chunk that completed.
+
+        :param elapsed: The time the chunk's request took, in seconds.
+        """
+
+        if not self._adaptive:
+            return
+
+        if elapsed > _MAX_CHUNK_TIME and self.chunk_size > MIN_CHUNK_SIZE:
+            self.chunk_size = max(self.chunk_size // 2, MIN_CHUNK_SIZE)
+            self._best_size = min(self._best_size, self.chunk_size)
+            self._start_round()
+            return
+
+        self._round_bytes += size
+        self._round_chunks += 1
+        if self._settled or self._round_chunks < self._window:
+            return
+
+        throughput = self._round_bytes / max(time.perf_counter() - self._round_start, 1e-9)
+        if throughput > self._best_throughput * _GROWTH_THRESHOLD and self.chunk_size < MAX_CHUNK_SIZE:
+            self._best_throughput = throughput
+            self._best_size = self.chunk_size
+            self.chunk_size = min(self.chunk_size * 2, MAX_CHUNK_SIZE)
+        else:
+            if throughput > self._best_throughput:
+                self._best_size = self.chunk_size
+            self.chunk_size = self._best_size
+            self._settled = True
+            logger.debug(f"Settled on chunks of {self.chunk_size:#x} bytes")
+
+        self._start_round()
+
+    def _start_round(self):
+        self._round_start = time.perf_counter()
+        self._round_bytes = 0
+        self._round_chunks = 0
+
+
+def _get_chunk_end(address: int, end_address: int, chunk_size: int) -> int:
+    """
+    :return: The end of the chunk that starts at the address. Chunks end on page boundaries, so a page is never split
+             between chunks.
+    """
+
+    chunk_end = min(address + chunk_size, end_address)
+    page_end = chunk_end & ~(PAGE_SIZE - 1)
+    return page_end if address < page_end < end_address else chunk_end
+
+
+def _read_chunk(broker: Broker, address: int, size: int) -> DumpChunk:
+    """
+    Reads a chunk of a dump. If the chunk can't be read as a whole, its pages are read one by one (in a single request)
+    to find the ones that can't be read.
+    """
+
+    chunk = DumpChunk(address, bytearray(size))
+    try:
+        broker.read_into(ReadBytes(address, size), chunk.data)
+        return chunk
+    except Exception as e:
+        # Brokers report unreadable memory differently. If this was a failure of the broker itself rather than of the
+        # memory, reading the pages fails as well and raises.
+        logger.debug(f"Failed to read chunk at {address:#x} ({e}), reading it page by page")
+
+    view = memoryview(chunk.data)
+    pages = []
+    page_address = address
+    while page_address < address + size:
+        page_end = min((page_address & ~(PAGE_SIZE - 1)) + PAGE_SIZE, address + size)
+        pages.append(ReadBytes(page_address, page_end - page_address))
+        page_address = page_end
+
+    for page, result in zip(pages, broker.read_many(ReadMany(pages))):
+        offset = page.address - address
+        if not isinstance(result, Exception):
+            view[offset:offset + page.size] = result
+        elif len(chunk.skipped) != 0 and chunk.skipped[-1].address + chunk.skipped[-1].size == page.address:
+            chunk.skipped[-1].size += page.size
+        else:
+            chunk.skipped.append(SkippedRange(page.address, page.size, result))
+
+    return chunk
+
+
+def _write_chunk(broker: Broker, request: WriteBytes) -> int:
+    broker.write_bytes(request)
+    return len(request.data)
+
+
+def _timed(method: Callable, *args):
+    start = time.perf_counter()
+    result = method(*args)
+    return result, time.perf_counter() - start
+
+
+def _pipeline(broker: Broker, window: int, submit_next: Callable, on_done: Callable) -> Iterator:
+    """
+    Runs tasks with up to `window` of them in flight, and yields their results in order.
+
+    :param submit_next: Called with a function that runs a task (like `Executor.submit()`) to submit the next task.
+                        Returns False once there are no more tasks.
+    :param on_done: Called with the result of each task and the time it took, in order.
+    """
+
+    if not broker.thread_safe:
+        window = 1
+
+    if window == 1:
+        def run(method: Callable, *args):
+            pending.append(_timed(method, *args))
+
+        pending = deque()
+        while submit_next(run):
+            result, elapsed = pending.popleft()
+            on_done(result, elapsed)
+            yield result
+        return
+
+    # Imported here, since it is only needed by bulk transfers
+    from concurrent.futures import ThreadPoolExecutor
+
+    def submit(method: Callable, *args):
+        # Each task runs in a copy of the current context, so its requests are traced and profiled under the transfer
+        futures.append(executor.submit(copy_context().run, _timed, method, *args))
+
+    futures = deque()
+    with ThreadPoolExecutor(window, thread_name_prefix="Transfer") as executor:
+        try:
+            while len(futures) < window and submit_next(submit):
+                pass
+
+            while len(futures) != 0:
+                result, elapsed = futures.popleft().result()
+                on_done(result, elapsed)
+                submit_next(submit)
+                yield result
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def dump_chunks(broker: Broker,
+                address: int,
+                size: int,
+                chunk_size: Optional[int] = None,
+                window: int = DEFAULT_WINDOW) -> Iterator[DumpChunk]:
+    """
+    Reads a region of memory in chunks, with up to `window` chunks in flight. See `Client.iter_dump()`.
+    """
+
+    if size < 0 or window < 1:
+        raise ValueError(f"Invalid dump of {size} bytes with a window of {window}")
+
+    sizer = _ChunkSizer(chunk_size or DEFAULT_CHUNK_SIZE, window, adaptive=chunk_size is None)
+    end_address = address + size
+    next_address = address
+
+    def submit_next(submit: Callable) -> bool:
+        nonlocal next_address
+        if next_address >= end_address:
+            return False
+
+        chunk_end = _get_chunk_end(next_address, end_address, sizer.chunk_size)
+        submit(_read_chunk, broker, next_address, chunk_end - next_address)
+        next_address = chunk_end
+        return True
+
+    def on_done(chunk: DumpChunk, elapsed: float):
+        sizer.record(len(chunk.data), elapsed)
+        for skipped_range in chunk.skipped:
+            logger.warning(f"Skipped {skipped_range.size:#x} unreadable bytes at {skipped_range.address:#x}: "
+                           f"{skipped_range.error}")
+
+    yield from _pipeline(broker, window, submit_next, on_done)
+
+
+def dump(broker: Broker,
+         address: int,
+         size: int,
+         sink,
+         chunk_size: Optional[int] = None,
+         window: int = DEFAULT_WINDOW) -> TransferReport:
+    """
+    Writes a region of memory to a sink, in order. See `Client.dump()`.
+    """
+
+    report = TransferReport(address, size)
+    start = time.perf_counter()
+    with start_span("transfer.dump", address=address, size=size, window=window) as span:
+        for chunk in dump_chunks(broker, address, size, chunk_size, window):
+            sink.write(chunk.data)
+            report.chunks += 1
+            report.skipped.extend(chunk.skipped)
+
+        span.set_attributes(chunks=report.chunks, bytes_skipped=report.bytes_skipped)
+
+    report.elapsed = time.perf_counter() - start
+    return report
+
+
+def upload(broker: Broker,
+           address: int,
+           source,
+           size: Optional[int] = None,
+           chunk_size: Optional[int] = None,
+           window: int = DEFAULT_WINDOW) -> TransferReport:
+    """
+    Writes a buffer or the contents of a stream to memory, in chunks. See `Client.upload()`.
+    """
+
+    if window < 1:
+        raise ValueError(f"Invalid window of {window}")
+
+    if hasattr(source, "read"):
+        read = source.read
+    else:
+        view = as_buffer(source)
+        if not isinstance(view, memoryview):
+            view = memoryview(view)
+        size = len(view) if size is None else min(size, len(view))
+
+        def read(read_size: int):
+            nonlocal view
+            data, view = view[:read_size], view[read_size:]
+            return data
+
+    sizer = _ChunkSizer(chunk_size or DEFAULT_CHUNK_SIZE, window, adaptive=chunk_size is None)
+    report = TransferReport(address, 0)
+    next_address = address
+
+    def submit_next(submit: Callable) -> bool:
+        nonlocal next_address
+        remaining = sizer.chunk_size if size is None else min(sizer.chunk_size, address + size - next_address)
+        data = read(remaining) if remaining > 0 else b""
+        if len(data) == 0:
+            return False
+
+        submit(_write_chunk, broker, WriteBytes(next_address, as_buffer(data)))
+        next_address += len(data)
+        return True
+
+    def on_done(written: int, elapsed: float):
+        sizer.record(written, elapsed)
+        report.chunks += 1
+        report.size += written
+
+    start = time.perf_counter()
+    with start_span("transfer.upload", address=address, size=size, window=window) as span:
+        try:
+            for _ in _pipeline(broker, window, submit_next, on_done):
+                pass
+        except Exception as e:
+            report.elapsed = time.perf_counter() - start
+            raise UploadError(report) from e
+        finally:
+            span.set_attributes(chunks=report.chunks)
+
+    report.elapsed = time.perf_counter() - start
+    return report
@@ -1,5 +1,3 @@
-from IPython import embed
-
 import pykeval.broker
 import pykeval.log
 import pykeval.server
@@ -17,6 +15,8 @@ def get_remote_client(*args, **kwargs):
 
 
 def start_interactive_shell():
+    from IPython import embed  # Only needed by the shell itself, and slow to import
+
     pykeval.log.setup_root_logger()
 
     embed(header="\n".join((
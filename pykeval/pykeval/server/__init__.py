@@ -1,7 +1,8 @@
 from argparse import ArgumentParser
 
-from pykeval.broker import LocalBroker, RemoteBrokerServer
+from pykeval.broker import RemoteBrokerServer
 from pykeval.broker.remote import DEFAULT_SERVER_PORT
+from pykeval.broker.remote_server import DEFAULT_IDLE_TIMEOUT, DEFAULT_WORKERS
 from pykeval.log import setup_root_logger
 
 
@@ -13,9 +14,24 @@ def main():
     parser.add_argument("-a", "--address", help="The address of the server.", default="0.0.0.0")
     parser.add_argument("-p", "--port", help="The port of the server.", type=int, default=DEFAULT_SERVER_PORT)
     parser.add_argument("-d", "--device", help="The name of the Keval driver's device.", default="\\??\\keval")
+    parser.add_argument("-t", "--idle-timeout", help="Seconds after which an idle connection is closed.", type=float,
+                        default=DEFAULT_IDLE_TIMEOUT)
+    parser.add_argument("-w", "--workers", help="The number of requests that may be executed at the same time.",
+                        type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("-s", "--simulate", metavar="LATENCY", choices=("none", "ioctl", "lan", "wan"),
+                        help="Serve a simulated machine instead of the driver, with the given latency profile "
+                             "(none, ioctl, lan or wan). This is useful for testing clients.")
+    parser.add_argument("--pointer-size", help="The pointer size of the simulated machine.", type=int, choices=(4, 8),
+                        default=8)
 
     args = parser.parse_args()
 
-    local_broker = LocalBroker(args.device)
-    server = RemoteBrokerServer(local_broker, args.address, args.port)
+    if args.simulate is not None:
+        from pykeval.broker.simulated import SimulatedBroker, LATENCY_PROFILES
+        local_broker = SimulatedBroker(args.pointer_size, LATENCY_PROFILES[args.simulate])
+    else:
+        from pykeval.broker.local import LocalBroker
+        local_broker = LocalBroker(args.device)
+
+    server = RemoteBrokerServer(local_broker, args.address, args.port, args.idle_timeout, args.workers)
     server.start()
@@ -0,0 +1,186 @@
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional
+
+"""
+Spans of the work pykeval does, for feeding a tracing backend.
+
+Clients, argument translation, allocations and brokers start spans around what they do, with attributes such as the
+function that is called or the number of bytes that are marshalled. Spans that start while another span is active are
+its children. A `Tracer` that is installed with `set_tracer()` is notified as each span starts and ends.
+
+While no tracer is installed, spans are not created at all, so tracing costs only a check of the installed tracer.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    """
+    A timed part of an operation. Times are from `time.perf_counter()`.
+    """
+
+    # Whether the span is recorded, so attributes that are costly to compute are worth computing
+    recording = True
+
+    def __init__(self, tracer: "Tracer", name: str, attributes: Dict[str, any]):
+        self.name = name
+        self.attributes = attributes
+        self.parent = None  # type: Optional[Span]
+        self.start_time = None  # type: Optional[float]
+        self.end_time = None  # type: Optional[float]
+        # The exception the span ended with, if any
+        self.error = None  # type: Optional[BaseException]
+        self._tracer = tracer
+        self._token = None
+
+    @property
+    def duration(self) -> Optional[float]:
+        """
+        :return: The duration of the span in seconds, or None if it hasn't ended.
+        """
+
+        if self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> "Span":
+        self.parent = _current_span.get()
+        self._token = _current_span.set(self)
+        self.start_time = time.perf_counter()
+        _notify(self._tracer.on_start, self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.end_time = time.perf_counter()
+        self.error = exc_val
+        _current_span.reset(self._token)
+        _notify(self._tracer.on_end, self)
+
+    def __repr__(self):
+        return f"<Span {self.name} {self.attributes}>"
+
+
+class _NullSpan:
+    """
+    Stands in for a span while there is no tracer.
+    """
+
+    recording = False
+    name = None
+    attributes = {}  # type: Dict[str, any]
+    parent = None
+
+    def set_attributes(self, **attributes):
+        pass
+
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+_current_span = ContextVar("_current_span", default=None)  # type: ContextVar[Optional[Span]]
+_tracer = None  # type: Optional[Tracer]
+
+
+class Tracer:
+    """
+    Is notified of spans as they start and end. Subclass it to pass spans to a tracing backend.
+
+    Callbacks are called on the thread (and in the context) that runs the span, so they should be quick. Exceptions they
+    raise are logged and don't affect the operation.
+    """
+
+    def on_start(self, span: Span):
+        pass
+
+    def on_end(self, span: Span):
+        pass
+
+
+class RecordingTracer(Tracer):
+    """
+    Keeps every span that ends, for inspecting where time is spent without a tracing backend.
+    """
+
+    def __init__(self):
+        self.spans = []  # type: List[Span]
+        self._lock = threading.Lock()
+
+    def on_end(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def get_totals(self) -> Dict[str, float]:
+        """
+        :return: The total duration of the spans of each name, in seconds, from the longest.
+        """
+
+        totals = {}  # type: Dict[str, float]
+        with self._lock:
+            for span in self.spans:
+                totals[span.name] = totals.get(span.name, 0) + span.duration
+
+        return dict(sorted(totals.items(), key=lambda item: -item[1]))
+
+    def clear(self):
+        with self._lock:
+            self.spans.clear()
+
+
+def _notify(callback: Callable[[Span], None], span: Span):
+    try:
+        callback(span)
+    except Exception:
+        logger.exception(f"Tracer failed to handle span {span.name}")
+
+
+def set_tracer(tracer: Optional[Tracer]) -> Optional[Tracer]:
+    """
+    Installs a tracer for all threads.
+
+    :param tracer: The tracer, or None to stop tracing.
+    :return: The tracer that was installed before.
+    """
+
+    global _tracer
+    previous, _tracer = _tracer, tracer
+    return previous
+
+
+def get_tracer() -> Optional[Tracer]:
+    return _tracer
+
+
+def start_span(name: str, **attributes) -> Span:
+    """
+    Creates a span to be used as a context manager, which starts when entered and ends when exited. For example:
+
+        with start_span("client.read_back", size=size) as span:
+            ...
+            span.set_attributes(bytes_read=len(data))
+
+    :return: The span, or a span that records nothing if there is no tracer.
+    """
+
+    tracer = _tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return Span(tracer, name, attributes)
+
+
+def get_current_span() -> Span:
+    """
+    :return: The innermost active span, or a span that records nothing if there is none.
+    """
+
+    span = _current_span.get()
+    return span if span is not None else _NULL_SPAN